@@ -0,0 +1,329 @@
+# Typed, columnar copy of the analyzed model for ad hoc queries.
+#
+# With analytic_format set, output_files also writes each year's
+# students, rosters and teachers, and the rostered courses, from the
+# same in-memory store as the DataDirector files, so nobody has to parse
+# those files again.  Values are typed: ids and codes stay text, school
+# ids, grade levels and fluency codes are integers, dates are dates and
+# Y/N flags are booleans; '' is NULL.  school_code and course_id repeat
+# on nearly every row, so they are dictionary-encoded.
+#
+# 'sqlite' writes one SQLite file.  Each table's rows go into
+# <table>_data with a leading, indexed year column (its partition) and
+# dictionary columns stored as ids into a lookup table, and a view named
+# for the table joins the values back.  'parquet' writes a hive-style
+# directory per table, <table>/year=<year>/part-0.parquet, with
+# dictionary-typed columns; it needs pyarrow.  Either is written under a
+# temporary name unique to the process and renamed into place when
+# complete, so concurrent runs don't write into each other's files.
+
+from __future__ import print_function
+
+from datetime import date
+import itertools
+import os
+import shutil
+import sqlite3
+import tempfile
+
+try:
+  import pyarrow
+  import pyarrow.parquet
+except ImportError:
+  pyarrow = None
+
+FORMATS = [ 'sqlite', 'parquet' ]
+
+# rows converted and written at a time, and rows per parquet row group
+BATCH_ROWS = 65536
+
+# (column, type) of each table, in row order; 'dict' is text stored
+# dictionary-encoded
+
+# the year's enrollment, then the student record
+ENROLLMENT_COLUMNS = [
+  ('school_id', 'int'), ('school_code', 'dict'), ('grade_level', 'int') ]
+
+STUDENT_COLUMNS = [
+  ('ssid', 'text'), ('student_id', 'text'), ('first_name', 'text'),
+  ('last_name', 'text'), ('birthdate', 'date'), ('gender', 'text'),
+  ('parent', 'text'), ('street', 'text'), ('city', 'text'), ('state', 'text'),
+  ('zip', 'text'), ('phone_number', 'text'), ('primary_language', 'text'),
+  ('ethnicity', 'text'), ('language_fluency', 'int'),
+  ('date_entered_school', 'date'), ('date_entered_district', 'date'),
+  ('first_us_entry_date', 'date'), ('gate', 'flag'),
+  ('primary_disability', 'text'), ('nslp', 'flag'),
+  ('parent_education', 'text'), ('migrant_ed', 'flag'), ('date_rfep', 'date'),
+  ('special_program', 'flag'), ('title_1', 'flag') ]
+
+# in the importer's ROSTER_FIELDS order
+ROSTER_COLUMNS = [
+  ('ssid', 'text'), ('student_id', 'text'), ('teacher_id', 'text'),
+  ('employee_id', 'text'), ('school_id', 'int'), ('school_code', 'dict'),
+  ('grade_level', 'int'), ('period', 'text'), ('term', 'text'),
+  ('course_id', 'dict'), ('section_id', 'text') ]
+
+USER_COLUMNS = [
+  ('employee_id', 'text'), ('teacher_id', 'text'), ('school_id', 'int'),
+  ('school_code', 'dict'), ('first_name', 'text'), ('last_name', 'text'),
+  ('email_address', 'text') ]
+
+COURSE_COLUMNS = [
+  ('course_id', 'dict'), ('abbreviation', 'text'), ('name', 'text'),
+  ('credits', 'text'), ('subject_code', 'text'), ('a_to_g', 'text'),
+  ('school_id', 'int'), ('school_code', 'dict') ]
+
+# table -> (columns, partitioned by year)
+TABLES = {
+  'students': (ENROLLMENT_COLUMNS + STUDENT_COLUMNS, True),
+  'rosters':  (ROSTER_COLUMNS, True),
+  'users':    (USER_COLUMNS, True),
+  'courses':  (COURSE_COLUMNS, False)
+}
+
+
+def names(columns):
+  return [ name for name, kind in columns ]
+
+
+def to_text(value):
+  if value == '':
+    return None
+  return str(value)
+
+
+# kind -> [ count, first value ] of values that couldn't be typed and
+# were written as NULL; reported and reset when an export is closed
+rejected = { }
+
+
+def reject(kind, value):
+  if not kind in rejected:
+    rejected[kind] = [ 0, value ]
+  rejected[kind][0] += 1
+  return None
+
+
+def report_rejected():
+  for kind in sorted(rejected):
+    count, value = rejected[kind]
+    print('%d values not a valid %s, written as NULL (e.g. %r)' % (count, kind, value))
+  rejected.clear()
+
+
+def to_int(value):
+  if value == '':
+    return None
+  try:
+    return int(value)
+  except ValueError:
+    return reject('int', value)
+
+
+def to_date(value):
+  # 'MM/DD/YYYY', as dd_normalize.clean_date leaves it; clean_date
+  # doesn't check the day exists, so e.g. 02/30/2010 is rejected here
+  if value == '':
+    return None
+  try:
+    mo, da, yr = value.split('/')
+    return date(int(yr), int(mo), int(da))
+  except ValueError:
+    return reject('date', value)
+
+
+def to_flag(value):
+  if value == '':
+    return None
+  return value == 'Y'
+
+
+CONVERTERS = {
+  'text': to_text,
+  'dict': to_text,
+  'int':  to_int,
+  'date': to_date,
+  'flag': to_flag
+}
+
+
+def typed_batches(columns, rows):
+  # lists of at most BATCH_ROWS rows, each a list of typed values
+  converters = [ CONVERTERS[kind] for name, kind in columns ]
+  rows = iter(rows)
+  while True:
+    batch = [ [ convert(value) for convert, value in zip(converters, row) ]
+      for row in itertools.islice(rows, BATCH_ROWS) ]
+    if not batch:
+      break
+    yield batch
+
+
+def check_format(analytic_format):
+  if not analytic_format in FORMATS:
+    raise Exception('unknown analytic_format %s' % analytic_format)
+  if analytic_format == 'parquet' and pyarrow is None:
+    raise Exception('analytic_format parquet needs pyarrow')
+
+
+def open_export(analytic_format, base_dir):
+  check_format(analytic_format)
+  if not os.path.isdir(base_dir):
+    os.makedirs(base_dir)
+  if analytic_format == 'sqlite':
+    return SqliteExport(os.path.join(base_dir, 'datadirector.sqlite'))
+  return ParquetExport(os.path.join(base_dir, 'datadirector'))
+
+
+SQLITE_TYPES = {
+  'text': 'TEXT',
+  'dict': 'INTEGER',
+  'int':  'INTEGER',
+  'date': 'DATE',
+  'flag': 'BOOLEAN'
+}
+
+
+class SqliteExport(object):
+  def __init__(self, path):
+    self.path = path
+    fd, self.tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.',
+      suffix='.tmp', dir=os.path.dirname(path))
+    os.close(fd)
+    # mkstemp and mkdtemp make them private to the owner
+    os.chmod(self.tmp_path, 0o644)
+    self.connection = sqlite3.connect(self.tmp_path)
+    # a partial file is thrown away, so there is nothing to journal
+    self.connection.execute('PRAGMA journal_mode=OFF')
+    self.connection.execute('PRAGMA synchronous=OFF')
+    self.tables = set()
+    # dictionary column -> { value: id }
+    self.dictionaries = { }
+
+  def create(self, table, columns, partitioned):
+    definitions = [ ]
+    if partitioned:
+      definitions.append('year TEXT NOT NULL')
+    selected = [ ]
+    joins = [ ]
+    if partitioned:
+      selected.append('t.year')
+    for name, kind in columns:
+      if kind == 'dict':
+        self.create_dictionary(name)
+        definitions.append('%s_id INTEGER' % name)
+        joins.append('LEFT OUTER JOIN %ss %s ON %s.id=t.%s_id' % (name, name, name, name))
+        selected.append('%s.value AS %s' % (name, name))
+      else:
+        definitions.append('%s %s' % (name, SQLITE_TYPES[kind]))
+        selected.append('t.%s' % name)
+    self.connection.execute('CREATE TABLE %s_data (%s)' % (table, ', '.join(definitions)))
+    self.connection.execute('CREATE VIEW %s AS SELECT %s FROM %s_data t %s' % (table,
+      ', '.join(selected), table, ' '.join(joins)))
+    self.tables.add(table)
+
+  def create_dictionary(self, name):
+    if not name in self.dictionaries:
+      self.connection.execute('CREATE TABLE %ss (id INTEGER PRIMARY KEY, value TEXT UNIQUE)' % name)
+      self.dictionaries[name] = { }
+
+  def dictionary_id(self, name, value):
+    if value is None:
+      return None
+    ids = self.dictionaries[name]
+    key = ids.get(value)
+    if key is None:
+      key = ids[value] = len(ids) + 1
+      self.connection.execute('INSERT INTO %ss (id, value) VALUES (?, ?)' % name, (key, value))
+    return key
+
+  def write(self, table, year, rows):
+    columns, partitioned = TABLES[table]
+    if not table in self.tables:
+      self.create(table, columns, partitioned)
+    prefix = [ year ] if partitioned else [ ]
+    sql = 'INSERT INTO %s_data VALUES (%s)' % (table,
+      ', '.join([ '?' ] * (len(prefix) + len(columns))))
+    dictionaries = [ (i, name) for i, (name, kind) in enumerate(columns) if kind == 'dict' ]
+    dates = [ i for i, (name, kind) in enumerate(columns) if kind == 'date' ]
+    for batch in typed_batches(columns, rows):
+      for row in batch:
+        for i, name in dictionaries:
+          row[i] = self.dictionary_id(name, row[i])
+        for i in dates:
+          if row[i] is not None:
+            row[i] = row[i].isoformat()
+      self.connection.executemany(sql, [ prefix + row for row in batch ])
+
+  def close(self):
+    # indexes are cheaper to build once the rows are in
+    for table in sorted(self.tables):
+      columns, partitioned = TABLES[table]
+      if partitioned:
+        self.connection.execute('CREATE INDEX %s_year ON %s_data (year)' % (table, table))
+      for name, kind in columns:
+        if kind == 'dict':
+          self.connection.execute('CREATE INDEX %s_%s ON %s_data (%s_id)' % (table, name, table, name))
+    self.connection.commit()
+    self.connection.close()
+    if os.path.exists(self.path):
+      os.remove(self.path)
+    os.rename(self.tmp_path, self.path)
+    report_rejected()
+    print('Wrote analytic tables to %s' % self.path)
+
+  def discard(self):
+    self.connection.close()
+    os.remove(self.tmp_path)
+    rejected.clear()
+
+
+def arrow_type(kind):
+  if kind == 'dict':
+    return pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+  return {
+    'text': pyarrow.string(),
+    'int':  pyarrow.int64(),
+    'date': pyarrow.date32(),
+    'flag': pyarrow.bool_()
+  }[kind]
+
+
+class ParquetExport(object):
+  def __init__(self, path):
+    self.path = path
+    self.tmp_path = tempfile.mkdtemp(prefix=os.path.basename(path) + '.',
+      suffix='.tmp', dir=os.path.dirname(path))
+    os.chmod(self.tmp_path, 0o755)
+
+  def write(self, table, year, rows):
+    columns, partitioned = TABLES[table]
+    dir_name = os.path.join(self.tmp_path, table)
+    if partitioned:
+      # the year is in the path, not the file
+      dir_name = os.path.join(dir_name, 'year=%s' % year)
+    os.makedirs(dir_name)
+    schema = pyarrow.schema([ pyarrow.field(name, arrow_type(kind)) for name, kind in columns ])
+    writer = pyarrow.parquet.ParquetWriter(os.path.join(dir_name, 'part-0.parquet'), schema)
+    try:
+      for batch in typed_batches(columns, rows):
+        arrays = [ ]
+        for values, (name, kind) in zip(zip(*batch), columns):
+          if kind == 'dict':
+            arrays.append(pyarrow.array(values, pyarrow.string()).dictionary_encode())
+          else:
+            arrays.append(pyarrow.array(values, arrow_type(kind)))
+        writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+    finally:
+      writer.close()
+
+  def close(self):
+    if os.path.isdir(self.path):
+      shutil.rmtree(self.path)
+    os.rename(self.tmp_path, self.path)
+    report_rejected()
+    print('Wrote analytic tables to %s' % self.path)
+
+  def discard(self):
+    shutil.rmtree(self.tmp_path, ignore_errors=True)
+    rejected.clear()
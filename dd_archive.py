@@ -0,0 +1,254 @@
+from __future__ import print_function
+
+# Content-addressed archive of the daily exports.
+#
+# With archive_store set, each delivered export is archived as its
+# output files rather than as another copy of the zip.  A file's
+# contents are stored once, zlib-compressed, under objects/ by their
+# sha256, so a file that didn't change since the day before costs
+# nothing but hashing it.  Each day gets a manifest (manifests/<date>.json)
+# naming the sha256 of each of its files, and index.json lists the
+# archived dates in order, so the export as of any date is a bisect
+# away without listing the share.  archive_retention thins old days to
+# one per week and then one per month, and objects no kept day refers
+# to are removed.  Each run's metrics are kept in metrics/<date>.json,
+# thinned the same way.
+#
+#   python dd_archive.py list
+#   python dd_archive.py restore <YYYY-MM-DD> <dir>
+#
+# lists the archived dates, or writes the files of the export as of a
+# date to dir.
+
+from datetime import datetime
+import bisect
+import hashlib
+import json
+import os
+import zlib
+
+# bytes read from a file at a time
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_sha256(path):
+  h = hashlib.sha256()
+  with open(path, 'rb') as f:
+    while True:
+      chunk = f.read(CHUNK_SIZE)
+      if not chunk:
+        break
+      h.update(chunk)
+  return h.hexdigest()
+
+
+def write_json(path, value):
+  # readers never see a partial file
+  tmp_path = path + '.tmp'
+  with open(tmp_path, 'w') as f:
+    json.dump(value, f, indent=2, sort_keys=True)
+  if os.path.exists(path):
+    os.remove(path)
+  os.rename(tmp_path, path)
+
+
+def parse_day(s):
+  return datetime.strptime(s, '%Y-%m-%d').date()
+
+
+def retained(days, today, daily=0, weekly=0, monthly=0):
+  # The days to keep: every day of the last daily days, the newest day
+  # of each of the last weekly weeks (Monday to Sunday) and of each of
+  # the last monthly months, and always the newest day.
+  keep = set()
+  newest = { }
+  monday = today.toordinal() - today.weekday()
+  for day in sorted(days):
+    if (today - day).days < daily:
+      keep.add(day)
+    weeks_ago = (monday - (day.toordinal() - day.weekday())) // 7
+    if weeks_ago < weekly:
+      newest[('week', weeks_ago)] = day
+    months_ago = (today.year * 12 + today.month) - (day.year * 12 + day.month)
+    if months_ago < monthly:
+      newest[('month', months_ago)] = day
+  keep.update(newest.values())
+  if days:
+    keep.add(max(days))
+  return keep
+
+
+class ArchiveStore(object):
+  def __init__(self, base_dir):
+    self.base_dir = base_dir
+    self.objects_dir = os.path.join(base_dir, 'objects')
+    self.manifests_dir = os.path.join(base_dir, 'manifests')
+    self.metrics_dir = os.path.join(base_dir, 'metrics')
+    self.index_path = os.path.join(base_dir, 'index.json')
+    for dir_name in [ self.objects_dir, self.manifests_dir, self.metrics_dir ]:
+      if not os.path.isdir(dir_name):
+        os.makedirs(dir_name)
+
+  def object_path(self, sha256):
+    return os.path.join(self.objects_dir, sha256[:2], sha256[2:])
+
+  def manifest_path(self, day):
+    return os.path.join(self.manifests_dir, '%s.json' % day.isoformat())
+
+  def metrics_path(self, day):
+    return os.path.join(self.metrics_dir, '%s.json' % day.isoformat())
+
+  def load_index(self):
+    # [ [ 'YYYY-MM-DD', manifest sha256 ], ... ] in date order
+    if not os.path.exists(self.index_path):
+      return [ ]
+    with open(self.index_path, 'r') as f:
+      return json.load(f)['exports']
+
+  def save_index(self, exports):
+    write_json(self.index_path, { 'exports': exports })
+
+  def store_object(self, path, sha256):
+    # true if the contents were new
+    object_path = self.object_path(sha256)
+    if os.path.exists(object_path):
+      return False
+    dir_name = os.path.dirname(object_path)
+    if not os.path.isdir(dir_name):
+      os.makedirs(dir_name)
+    tmp_path = object_path + '.tmp'
+    compressor = zlib.compressobj(6)
+    with open(path, 'rb') as f:
+      with open(tmp_path, 'wb') as out:
+        while True:
+          chunk = f.read(CHUNK_SIZE)
+          if not chunk:
+            break
+          out.write(compressor.compress(chunk))
+        out.write(compressor.flush())
+    os.rename(tmp_path, object_path)
+    return True
+
+  def add(self, day, paths):
+    # archives the files in paths as the export of day; returns the
+    # manifest's path
+    files = { }
+    new_objects = 0
+    new_bytes = 0
+    for path in sorted(paths):
+      sha256 = file_sha256(path)
+      size = os.path.getsize(path)
+      if self.store_object(path, sha256):
+        new_objects += 1
+        new_bytes += size
+      files[os.path.basename(path)] = { 'sha256': sha256, 'size': size }
+    manifest = { 'date': day.isoformat(), 'files': files }
+    manifest_path = self.manifest_path(day)
+    write_json(manifest_path, manifest)
+
+    digest = hashlib.sha256(json.dumps(files, sort_keys=True).encode('utf-8')).hexdigest()
+    exports = [ entry for entry in self.load_index() if entry[0] != day.isoformat() ]
+    unchanged = len(exports) > 0 and exports[-1][1] == digest
+    exports.append([ day.isoformat(), digest ])
+    exports.sort()
+    self.save_index(exports)
+    if unchanged:
+      print('Archived export of %s; unchanged since %s' % (day.isoformat(), exports[-2][0]))
+    else:
+      print('Archived export of %s: %d files, %d new (%d bytes)' % (day.isoformat(),
+        len(files), new_objects, new_bytes))
+    return manifest_path
+
+  def days(self):
+    return [ parse_day(day) for day, digest in self.load_index() ]
+
+  def as_of(self, day):
+    # manifest of the newest export on or before day, or None
+    exports = self.load_index()
+    i = bisect.bisect_right([ entry[0] for entry in exports ], day.isoformat())
+    if i == 0:
+      return None
+    with open(self.manifest_path(parse_day(exports[i - 1][0])), 'r') as f:
+      return json.load(f)
+
+  def restore(self, day, dest_dir):
+    # writes the files of the export as of day to dest_dir
+    manifest = self.as_of(day)
+    if manifest is None:
+      raise Exception('no export archived on or before %s' % day.isoformat())
+    if not os.path.isdir(dest_dir):
+      os.makedirs(dest_dir)
+    for fname, entry in sorted(manifest['files'].items()):
+      decompressor = zlib.decompressobj()
+      with open(self.object_path(entry['sha256']), 'rb') as f:
+        with open(os.path.join(dest_dir, fname), 'wb') as out:
+          while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+              break
+            out.write(decompressor.decompress(chunk))
+          out.write(decompressor.flush())
+    print('Restored the export of %s to %s' % (manifest['date'], dest_dir))
+    return manifest
+
+  def prune(self, today, daily=0, weekly=0, monthly=0):
+    # drops the days retention doesn't keep, then the objects no kept
+    # day refers to
+    self.prune_metrics(today, daily, weekly, monthly)
+    exports = self.load_index()
+    keep = retained([ parse_day(day) for day, digest in exports ], today,
+      daily, weekly, monthly)
+    dropped = [ entry for entry in exports if not parse_day(entry[0]) in keep ]
+    if not dropped:
+      return
+    self.save_index([ entry for entry in exports if parse_day(entry[0]) in keep ])
+    for day, digest in dropped:
+      os.remove(self.manifest_path(parse_day(day)))
+    print('Pruned %d archived exports' % len(dropped))
+    self.collect_garbage()
+
+  def prune_metrics(self, today, daily=0, weekly=0, monthly=0):
+    # metrics are saved for failed runs too, so they are thinned by their
+    # own days
+    days = [ parse_day(fname[:-5]) for fname in os.listdir(self.metrics_dir)
+      if fname.endswith('.json') ]
+    keep = retained(days, today, daily, weekly, monthly)
+    for day in days:
+      if not day in keep:
+        os.remove(self.metrics_path(day))
+
+  def collect_garbage(self):
+    referenced = set()
+    for day in self.days():
+      with open(self.manifest_path(day), 'r') as f:
+        for entry in json.load(f)['files'].values():
+          referenced.add(entry['sha256'])
+    removed = 0
+    for prefix in os.listdir(self.objects_dir):
+      dir_name = os.path.join(self.objects_dir, prefix)
+      for fname in os.listdir(dir_name):
+        if not prefix + fname in referenced:
+          os.remove(os.path.join(dir_name, fname))
+          removed += 1
+    print('Removed %d unreferenced archive objects' % removed)
+
+
+if __name__ == '__main__':
+  import argparse
+  import app_config
+
+  parser = argparse.ArgumentParser(description='DataDirector export archive')
+  parser.add_argument('command', choices=[ 'list', 'restore' ])
+  parser.add_argument('date', nargs='?', help='YYYY-MM-DD, for restore')
+  parser.add_argument('dest_dir', nargs='?', help='where restore writes the files')
+  args = parser.parse_args()
+
+  store = ArchiveStore(os.path.join(os.path.realpath(app_config.output_base_dir),
+    'archives', 'store'))
+  if args.command == 'list':
+    for day, digest in store.load_index():
+      print('%s %s' % (day, digest[:12]))
+  else:
+    if not args.date or not args.dest_dir:
+      parser.error('restore needs a date and a directory')
+    store.restore(parse_day(args.date), args.dest_dir)
@@ -0,0 +1,238 @@
+from __future__ import print_function
+
+# Scaling benchmark for the importer.
+#
+# For each size, generates (once) a synthetic extract with dd_synth and
+# runs the importer on it in a fresh process with its own app_config, so
+# every size starts cold and reports its own peak memory.  Prints wall
+# time, rows/sec and peak RSS for the analyze, output and package stages,
+# and checks the output files against a stored baseline.
+#
+#   python dd_bench.py --students 1000,10000,100000
+#   python dd_bench.py --students 100000 --set roster_sort_budget_mb=16
+#
+# The baseline holds each output file's row count, the md5 of the file
+# as written, and the md5 of its sorted rows.  A file matches only if
+# its bytes do; when only the sorted digest matches, the rows are right
+# but in a different order, and that is reported as well.
+# --save-baseline records the current output as the baseline.
+
+import argparse
+import ast
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+  import resource
+except ImportError:
+  resource = None # windows
+
+import dd_synth
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'dd_bench_baseline.json')
+
+APP_CONFIG = '''# written by dd_bench.py
+school_year = %(school_year)r
+source_dir = %(source_dir)r
+output_base_dir = %(output_base_dir)r
+do_uploads = False
+zip_file_name = 'datadirector'
+username = ''
+password = ''
+sftp_host = ''
+sftp_path = ''
+webdav_host = ''
+webdav_protocol = 'https'
+webdav_path = ''
+webdav_use_digest_auth = False
+'''
+
+
+def count_rows(path):
+  n = 0
+  with open(path, 'rb') as f:
+    for line in f:
+      n += 1
+  return n
+
+
+def output_digest(path):
+  # [ rows, md5 of the file, md5 of its header and sorted rows ]
+  with open(path, 'rb') as f:
+    header = f.readline()
+    rows = f.readlines()
+  h = hashlib.md5(header)
+  for row in rows:
+    h.update(row)
+  written = h.hexdigest()
+  rows.sort()
+  h = hashlib.md5(header)
+  for row in rows:
+    h.update(row)
+  return [ len(rows), written, h.hexdigest() ]
+
+
+def peak_rss_mb():
+  # high-water mark of this process and its finished worker processes
+  if resource is None:
+    return None
+  peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+  if sys.platform == 'darwin':
+    return peak / (1024.0 * 1024.0)
+  return peak / 1024.0
+
+
+def run_stages(run_dir, flags, input_rows):
+  # runs in the child process; app_config.py is in run_dir
+  sys.path.insert(0, run_dir)
+  import dd_importer
+
+  importer = dd_importer.DdImporter()
+  importer.use_race_file = 'race' in flags
+  importer.use_program_file = 'prog' in flags
+
+  def output_paths():
+    return sorted([ os.path.join(importer.output_dir, fname)
+      for fname in os.listdir(importer.output_dir) if fname.endswith('.txt') ])
+
+  stages = [ ]
+  def stage(name, func, rows):
+    started = time.time()
+    func()
+    seconds = time.time() - started
+    if callable(rows):
+      rows = rows()
+    stages.append({ 'name': name, 'seconds': seconds, 'rows': rows,
+      'rows_per_sec': rows / seconds if seconds > 0 else None,
+      'peak_rss_mb': peak_rss_mb() })
+
+  output_rows = lambda: sum([ count_rows(path) - 1 for path in output_paths() ])
+  stage('analyze', importer.process_files, input_rows)
+  stage('output', importer.output_files, output_rows)
+  stage('package', importer.package_and_archive_files, output_rows)
+
+  outputs = dict([ (os.path.basename(path), output_digest(path)) for path in output_paths() ])
+  return { 'stages': stages, 'outputs': outputs }
+
+
+def run_size(args, students, settings):
+  extract_dir = os.path.join(args.work_dir, 'extract-%d-%s-%d' % (students, args.year, args.years))
+  rows_path = os.path.join(extract_dir, 'rows.json')
+  if not os.path.exists(rows_path):
+    print('Generating %d students in %s' % (students, extract_dir))
+    rows = dd_synth.Synth(students, extract_dir, args.year, args.years).generate()
+    with open(rows_path, 'w') as f:
+      json.dump(rows, f)
+  with open(rows_path, 'r') as f:
+    input_rows = sum(json.load(f).values())
+
+  run_dir = tempfile.mkdtemp(prefix='bench-%d-' % students, dir=args.work_dir)
+  os.makedirs(os.path.join(run_dir, 'out'))
+  with open(os.path.join(run_dir, 'app_config.py'), 'w') as f:
+    f.write(APP_CONFIG % {
+      'school_year': args.year if args.years == 1 else None,
+      'source_dir': extract_dir,
+      'output_base_dir': os.path.join(run_dir, 'out') })
+    for name, value in settings:
+      f.write('%s = %r\n' % (name, value))
+
+  result_path = os.path.join(run_dir, 'result.json')
+  log_path = os.path.join(run_dir, 'importer.log')
+  with open(log_path, 'w') as log:
+    status = subprocess.call([ sys.executable, os.path.abspath(__file__),
+      '--child', run_dir, '--flags', args.flags, '--input-rows', str(input_rows) ],
+      stdout=log, stderr=subprocess.STDOUT, cwd=BENCH_DIR)
+  if status != 0:
+    raise Exception('importer failed on %d students, see %s' % (students, log_path))
+  with open(result_path, 'r') as f:
+    result = json.load(f)
+  shutil.rmtree(run_dir, ignore_errors=True)
+  return result
+
+
+def parse_setting(setting):
+  # name=value, where value is a python literal or else a string
+  name, value = setting.split('=', 1)
+  try:
+    value = ast.literal_eval(value)
+  except (ValueError, SyntaxError):
+    pass
+  return name.strip(), value
+
+
+def format_number(value, fmt):
+  return fmt % value if value is not None else '-'
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='DataDirector importer benchmark')
+  parser.add_argument('--students', default='1000,10000,100000',
+    help='comma separated extract sizes (default 1000,10000,100000)')
+  parser.add_argument('--year', default='16-17')
+  parser.add_argument('--years', type=int, default=1,
+    help='years of schedules; more than 1 runs the importer for all years')
+  parser.add_argument('--flags', default='', help='race and/or prog, e.g. race,prog')
+  parser.add_argument('--set', action='append', default=[ ], metavar='NAME=VALUE',
+    help='extra app_config setting, e.g. --set analysis_workers=3')
+  parser.add_argument('--work-dir', default=os.path.join(tempfile.gettempdir(), 'dd_bench'))
+  parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+  parser.add_argument('--save-baseline', action='store_true')
+  parser.add_argument('--child', help=argparse.SUPPRESS)
+  parser.add_argument('--input-rows', type=int, help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.child:
+    result = run_stages(args.child, args.flags, args.input_rows)
+    with open(os.path.join(args.child, 'result.json'), 'w') as f:
+      json.dump(result, f)
+    sys.exit(0)
+
+  if not os.path.isdir(args.work_dir):
+    os.makedirs(args.work_dir)
+  settings = [ parse_setting(s) for s in args.set ]
+  baseline = { }
+  if os.path.exists(args.baseline):
+    with open(args.baseline, 'r') as f:
+      baseline = json.load(f)
+
+  mismatches = 0
+  print('%9s  %-8s %9s %12s %12s' % ('students', 'stage', 'seconds', 'rows/sec', 'peak RSS MB'))
+  for students in [ int(n) for n in args.students.split(',') ]:
+    result = run_size(args, students, settings)
+    for s in result['stages']:
+      print('%9d  %-8s %9.2f %12s %12s' % (students, s['name'], s['seconds'],
+        format_number(s['rows_per_sec'], '%.0f'), format_number(s['peak_rss_mb'], '%.1f')))
+
+    # settings may change speed, never output, so they aren't in the key
+    key = '%d-%s-%d-%s' % (students, args.year, args.years, args.flags or 'none')
+    if args.save_baseline:
+      baseline[key] = result['outputs']
+    elif key in baseline:
+      expected = baseline[key]
+      differs = sorted([ fname for fname in set(expected) | set(result['outputs'])
+        if expected.get(fname) != result['outputs'].get(fname) ])
+      if differs:
+        mismatches += 1
+        print('%9d  output differs from baseline: %s' % (students, ', '.join(differs)))
+        reordered = [ fname for fname in differs if fname in expected and
+          fname in result['outputs'] and expected[fname][-1] == result['outputs'][fname][-1] ]
+        if reordered:
+          print('%9d  same rows in a different order: %s' % (students, ', '.join(reordered)))
+      else:
+        print('%9d  output matches baseline' % students)
+    else:
+      print('%9d  no baseline for %s' % (students, key))
+
+  if args.save_baseline:
+    with open(args.baseline, 'w') as f:
+      json.dump(baseline, f, indent=2, sort_keys=True)
+    print('Saved baseline to %s' % args.baseline)
+  sys.exit(1 if mismatches else 0)
@@ -0,0 +1,104 @@
+# On-disk cache of analyzed input state.
+#
+# An entry holds the pickled, zlib-compressed state that process_files
+# builds.  Its key is derived from every input file's size and content
+# hash plus the settings that shape the analysis, so any change to the
+# inputs or settings misses the cache.  Content hashes are only recomputed
+# when a file's size or mtime moves.  Entries are evicted least recently
+# used first once the cache grows past its size limit.
+
+import hashlib
+import json
+import os
+import pickle
+import zlib
+
+
+def file_hash(path):
+  h = hashlib.sha1()
+  with open(path, 'rb') as f:
+    while True:
+      chunk = f.read(1024 * 1024)
+      if not chunk:
+        break
+      h.update(chunk)
+  return h.hexdigest()
+
+
+class InputCache(object):
+  def __init__(self, cache_dir, max_bytes):
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+    self.fingerprints_path = os.path.join(cache_dir, 'fingerprints.json')
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+
+  def fingerprints(self, paths):
+    # path -> [size, mtime, sha1], rehashing only files whose size or
+    # mtime changed since they were last seen
+    known = { }
+    if os.path.exists(self.fingerprints_path):
+      with open(self.fingerprints_path, 'r') as f:
+        known = json.load(f)
+    current = { }
+    for path in paths:
+      st = os.stat(path)
+      entry = known.get(path)
+      if entry is None or entry[0] != st.st_size or entry[1] != st.st_mtime:
+        entry = [ st.st_size, st.st_mtime, file_hash(path) ]
+      current[path] = entry
+    known.update(current)
+    with open(self.fingerprints_path, 'w') as f:
+      json.dump(known, f)
+    return current
+
+  def key(self, paths, settings):
+    fingerprints = self.fingerprints(paths)
+    inputs = [ (os.path.basename(path), fingerprints[path][0], fingerprints[path][2])
+      for path in sorted(paths) ]
+    blob = json.dumps({ 'inputs': inputs, 'settings': settings }, sort_keys=True)
+    return hashlib.sha1(blob.encode('utf-8')).hexdigest()
+
+  def entry_path(self, key):
+    return os.path.join(self.cache_dir, key + '.pickle.z')
+
+  def load(self, key):
+    path = self.entry_path(key)
+    if not os.path.exists(path):
+      return None
+    try:
+      with open(path, 'rb') as f:
+        state = pickle.loads(zlib.decompress(f.read()))
+    except Exception as e:
+      print('Discarding unreadable cache entry: %s' % e)
+      os.remove(path)
+      return None
+    # mark as recently used
+    os.utime(path, None)
+    return state
+
+  def store(self, key, state):
+    path = self.entry_path(key)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+      f.write(zlib.compress(pickle.dumps(state, pickle.HIGHEST_PROTOCOL), 1))
+    if os.path.exists(path):
+      os.remove(path)
+    os.rename(tmp_path, path)
+    self.evict()
+
+  def evict(self):
+    entries = [ ]
+    for fname in os.listdir(self.cache_dir):
+      if fname.endswith('.pickle.z'):
+        path = os.path.join(self.cache_dir, fname)
+        st = os.stat(path)
+        entries.append((st.st_mtime, st.st_size, path))
+    entries.sort()
+    total = sum([ size for mtime, size, path in entries ])
+    # always keep the newest entry, even if it alone is over the limit
+    while total > self.max_bytes and len(entries) > 1:
+      mtime, size, path = entries.pop(0)
+      print('Evicting cache entry %s' % os.path.basename(path))
+      os.remove(path)
+      total -= size
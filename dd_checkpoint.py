@@ -0,0 +1,97 @@
+# Checkpoints of a run's stages, for dd_importer.py --resume.
+#
+# With checkpoint_stages set, or with --resume, after each stage past
+# the analysis (output, package, archive and deliver) the importer
+# records what it produced: the files and their size and mtime, and for
+# delivery the destinations that got the zip.
+# A --resume run with the same key (the input files' hashes and the
+# analysis settings, as for the input cache) skips every stage whose
+# record is still valid and retries the rest, so a failed upload is
+# retried without re-reading or re-writing anything.  A stage that runs
+# again drops the records of the stages after it.  The analyzed state
+# itself is checkpointed by the input cache, when input_cache_mb is set.
+
+from __future__ import print_function
+
+import json
+import os
+
+import dd_watch
+
+STAGES = [ 'output', 'package', 'archive', 'deliver' ]
+
+
+class Checkpoints(object):
+  def __init__(self, path, key, resume):
+    self.path = path
+    self.key = key
+    self.stages = { }
+    if resume:
+      self.load()
+    self.write()
+
+  def load(self):
+    if not os.path.exists(self.path):
+      print('No checkpoints to resume from')
+      return
+    with open(self.path, 'r') as f:
+      state = json.load(f)
+    if state.get('key') != self.key:
+      print('Inputs or settings changed since the checkpoints were saved; starting over')
+      return
+    self.stages = state['stages']
+    for i, stage in enumerate(STAGES):
+      record = self.record(stage)
+      if record is None:
+        # the later stages were built on this one
+        for later in STAGES[i + 1:]:
+          self.stages.pop(later, None)
+        break
+      if stage == 'deliver':
+        if record['destinations']:
+          print('Checkpoint: delivered to %s' % ', '.join(record['destinations']))
+      else:
+        print('Checkpoint: %s done' % stage)
+
+  def record(self, stage):
+    # what stage saved, or None if it hasn't run or its files changed
+    record = self.stages.get(stage)
+    if record is None:
+      return None
+    for path, signature in record.get('files', { }).items():
+      current = dd_watch.signature(path)
+      if current is None or list(current) != signature:
+        print('Checkpoint: %s changed since %s; redoing it' % (path, stage))
+        del self.stages[stage]
+        return None
+    return record
+
+  def save(self, stage, files=None, **record):
+    # records stage with the signatures of files, and drops the stages
+    # after it
+    if files is not None:
+      record['files'] = dict([ (path, list(dd_watch.signature(path))) for path in files ])
+    self.stages[stage] = record
+    for later in STAGES[STAGES.index(stage) + 1:]:
+      self.stages.pop(later, None)
+    self.write()
+
+  def write(self):
+    dir_name = os.path.dirname(self.path)
+    if not os.path.isdir(dir_name):
+      os.makedirs(dir_name)
+    tmp_path = self.path + '.tmp'
+    with open(tmp_path, 'w') as f:
+      json.dump({ 'key': self.key, 'stages': self.stages }, f, indent=2, sort_keys=True)
+    if os.path.exists(self.path):
+      os.remove(self.path)
+    os.rename(tmp_path, self.path)
+
+
+class NoCheckpoints(object):
+  # checkpointing is off: nothing is recorded and every stage runs
+  def record(self, stage):
+    return None
+
+  def save(self, stage, files=None, **record):
+    pass
@@ -0,0 +1,81 @@
+# Row-level change detection between two exports.
+#
+# Each output row is keyed by the fields that identify it in DataDirector
+# and stored with a short hash of the whole line, so the next run can tell
+# which rows were added, changed or deleted without keeping old files.
+
+import hashlib
+import json
+import os
+
+# fields that identify a row in each kind of output file
+KEY_FIELDS = {
+  'rosters': [ 'student_id', 'course_id', 'teacher_id' ],
+  'users':   [ 'employee_id' ],
+  'demo':    [ 'ssid' ],
+  'courses': [ 'course_id' ]
+}
+
+
+def file_kind(fname):
+  for kind in KEY_FIELDS:
+    if kind in fname:
+      return kind
+  return None
+
+
+def row_hashes(path):
+  # key -> hash for every data row; a repeated key gets a '#n' suffix
+  hashes = { }
+  seen = { }
+  with open(path, 'rb') as f:
+    headers = f.readline().rstrip(b'\r\n').split(b'\t')
+    key_fields = KEY_FIELDS.get(file_kind(os.path.basename(path)))
+    if key_fields:
+      indexes = [ headers.index(k.encode('ascii')) for k in key_fields ]
+    else:
+      indexes = list(range(len(headers)))
+    for line in f:
+      line = line.rstrip(b'\r\n')
+      fields = line.split(b'\t')
+      key = b'\t'.join([ fields[i] for i in indexes if i < len(fields) ]).decode('latin-1')
+      n = seen.get(key, 0) + 1
+      seen[key] = n
+      if n > 1:
+        key = '%s#%d' % (key, n)
+      hashes[key] = hashlib.md5(line).hexdigest()[:16]
+  return hashes
+
+
+def export_hashes(paths):
+  return dict([ (os.path.basename(path), row_hashes(path)) for path in paths ])
+
+
+def compare(old_files, new_files):
+  # fname -> (added, changed, deleted) row counts, for files that differ
+  changes = { }
+  for fname in set(old_files.keys()) | set(new_files.keys()):
+    old = old_files.get(fname, { })
+    new = new_files.get(fname, { })
+    added = len([ k for k in new if not k in old ])
+    deleted = len([ k for k in old if not k in new ])
+    changed = len([ k for k in new if k in old and new[k] != old[k] ])
+    if added or changed or deleted:
+      changes[fname] = (added, changed, deleted)
+  return changes
+
+
+def load_state(path):
+  if not os.path.exists(path):
+    return None
+  with open(path, 'r') as f:
+    return json.load(f)
+
+
+def save_state(path, files):
+  tmp_path = path + '.tmp'
+  with open(tmp_path, 'w') as f:
+    json.dump({ 'files': files }, f)
+  if os.path.exists(path):
+    os.remove(path)
+  os.rename(tmp_path, path)
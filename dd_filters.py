@@ -0,0 +1,95 @@
+# Declarative row filters, evaluated on the raw fields of a source row.
+#
+# A FilterSpec is a list of filters, each naming a column and the reason
+# a row is rejected.  bind() resolves the columns against a file's
+# headers once, and the check it returns runs on every split row before
+# it is projected, normalized or turned into a record.  The first
+# filter that rejects a row is counted under its reason, so a run can
+# report how many rows were dropped for what.  Filters are plain
+# objects, so a spec can be pickled and sent to worker processes.
+#
+# bind() asks each filter for a test closure over its column's index,
+# so a row costs one call per filter and no attribute lookups.
+
+
+class Exclude(object):
+  # rejects rows whose value is one of values
+  def __init__(self, reason, column, values):
+    self.reason = reason
+    self.column = column
+    self.values = frozenset(values)
+
+  def test(self, i):
+    # true for a row whose field i passes
+    values = self.values
+    return lambda fields: not fields[i] in values
+
+
+class Require(object):
+  # rejects rows whose value isn't in values, any container (a dict
+  # keyed by id is checked as it stands when the row is read); with
+  # normalize, a module-level function so the spec still pickles, the
+  # value is normalize(value)
+  def __init__(self, reason, column, values, normalize=None):
+    self.reason = reason
+    self.column = column
+    self.values = values
+    self.normalize = normalize
+
+  def test(self, i):
+    values = self.values
+    normalize = self.normalize
+    if normalize is None:
+      return lambda fields: fields[i] in values
+    return lambda fields: normalize(fields[i]) in values
+
+
+class RejectNegative(object):
+  # rejects rows whose value is empty or negative, e.g. the termid or
+  # sectionid of a dropped section
+  def __init__(self, reason, column):
+    self.reason = reason
+    self.column = column
+
+  def test(self, i):
+    # '' or starting with '-'
+    return lambda fields: not fields[i][:1] in ('', '-')
+
+
+class FilterSpec(object):
+  def __init__(self, filters):
+    self.filters = filters
+    self.rejected = { }
+
+  def count(self, reason, n=1):
+    # also used for rows rejected after projection
+    self.rejected[reason] = self.rejected.get(reason, 0) + n
+
+  def merge(self, rejected):
+    for reason, n in rejected.items():
+      self.count(reason, n)
+
+  def bind(self, headers):
+    # Returns check(fields), True for rows that pass, and the row width
+    # it needs.  Columns the file doesn't have read as ''.
+    index = dict([ (h, i) for i, h in enumerate(headers) ])
+    tests = [ ]
+    width = 0
+    for f in self.filters:
+      i = index.get(f.column, len(headers))
+      width = max(width, i + 1)
+      tests.append((f.test(i), f.reason))
+    count = self.count
+
+    def check(fields):
+      # the first test a row fails is counted
+      for test, reason in tests:
+        if not test(fields):
+          count(reason)
+          return False
+      return True
+    return check, width
+
+  def report(self, label):
+    for reason in sorted(self.rejected):
+      print('%d %s rejected: %s' % (self.rejected[reason], label, reason))
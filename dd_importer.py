@@ -6,19 +6,47 @@ from app_config import (
   sftp_host, sftp_path, webdav_host, webdav_protocol,
   webdav_path, webdav_use_digest_auth 
 )
+import app_config
 
-import csv
+import argparse
+import collections
 from datetime import date
 import glob
+import itertools
+import locale
+import mmap
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import operator
 import os
+import pickle
 import re
 import shutil
-import sys
-import zipfile
+import time
+import traceback
 
-import easywebdav
 import pysftp
 
+import dd_analytic
+import dd_archive
+from dd_records import (
+  intern, Student, User, Course, Enrollment, TeacherYear, Roster
+)
+from dd_spool import RosterSpool
+import dd_delta
+import dd_cache
+import dd_checkpoint
+import dd_normalize
+import dd_package
+import dd_upload
+import dd_metrics
+import dd_output
+import dd_pipeline
+import dd_filters
+import dd_store
+import dd_watch
+import ps_exporter
+
 STUDENTS_HEADERS = [s.strip() for s in '''
 id
 student_number
@@ -95,6 +123,57 @@ section_number
 sectionid
 '''.split('\n')[1:-1]]
 
+# the headers each kind of source file is checked for; a first line
+# without all of them is read as data, in this column order
+SOURCE_HEADERS = {
+  'students': STUDENTS_HEADERS,
+  'teachers': TEACHERS_HEADERS,
+  'courses':  COURSES_HEADERS,
+  'rosters':  STUDENT_SCHEDULES_HEADERS
+}
+
+# columns each analyze_* method projects out of its source file
+STUDENT_COLUMNS = [
+  'id', 'student_number', 'state_studentnumber', 'schoolid',
+  'first_name', 'last_name', 'dob', 'fedethnicity', 'gender',
+  'enroll_status', 'grade_level', 'mother_first', 'mother',
+  'father_first', 'father', 'street', 'city', 'state', 'zip',
+  'home_phone', 'schoolentrydate', 'districtentrydate', 'entrydate',
+  'alternate_school_number', 'ca_parented', 'ca_primarylanguage',
+  'ca_elastatus', 'ca_daterfep', 'ca_firstusaschooling', 'ca_gate',
+  'ca_migranted', 'ca_primdisability', 'ca_titlei_targeted', 'ethnicity' ]
+
+TEACHER_COLUMNS = [
+  'id', 'teachernumber', 'schoolid', 'alternate_school_number',
+  'first_name', 'last_name', 'email_addr', 'status', 'staffstatus',
+  'datadirector_access' ]
+
+COURSE_COLUMNS = [
+  'course_number', 'course_name', 'credit_hours', 'credittype',
+  'schoolid', 'alternate_school_number' ]
+
+# dd_row only exists in the per-school roster files written for sharding
+ROSTER_COLUMNS = [
+  'studentid', 'teacherid', 'schoolid', 'termid',
+  'alternate_school_number', 'expression', 'abbreviation',
+  'course_number', 'sectionid', 'dd_row' ]
+
+# bytes of roster file per parse_roster_chunk job
+ROSTER_CHUNK_BYTES = 4 * 1024 * 1024
+
+RACE_COLUMNS = [ 'studentid', 'racecd' ]
+
+# the program codes analyze_program_data imports
+PROGRAM_CODES = frozenset([ 122, 127, 135, 144, 175 ])
+
+PROGRAM_COLUMNS = [
+  'foreignkey', 'user_defined_text', 'custom',
+  'user_defined_date', 'user_defined_date2' ]
+
+ROSTER_FIELDS = [
+  'ssid', 'student_id', 'teacher_id', 'employee_id', 
+  'school_id', 'school_code', 'grade_level', 'period', 'term', 'course_id', 'section_id' ]
+
 FLUENCY_CODES = {
   'EO': 1,
   'IFEP': 2,
@@ -161,12 +240,28 @@ CO_TEACHERS = {
 	'597': [ '1913' ],   # CJ -> Swan
 }
 
+# destinations the zip can be delivered to, and the method that sends it
+DELIVERY_DESTINATIONS = {
+  'webdav': 'upload_file_by_webdav',
+  'sftp':   'upload_file_by_sftp',
+  'mirror': 'copy_file_to_mirror'
+}
+
 class DdImporter:
   def __init__(self):
+    # optional: keep the analyzed students, teachers, courses, enrollments
+    # and rosters under this many MB, moving them to an indexed SQLite
+    # file under output_base_dir once they grow past it
+    memory_mb = getattr(app_config, 'memory_budget_mb', None)
+    self.store = None
+    if memory_mb:
+      self.store = dd_store.SpillStore(os.path.realpath(output_base_dir),
+        int(memory_mb * 1024 * 1024))
+
     self.rosters = { }
-    self.users = { }
-    self.courses = { }
-    self.students = { }
+    self.users = self.new_store(300)
+    self.courses = self.new_store(300)
+    self.students = self.new_store(1000)
     self.enrollments = { }
     self.teacher_years = { }
     self.custom_fields = { }
@@ -176,10 +271,19 @@ class DdImporter:
     self.use_program_file = False
     self.data_dir = os.path.realpath(output_base_dir)
     self.input_dir = os.path.realpath(source_dir)
+    # teachers and courses are district-wide, even when sharding by school
+    self.reference_dir = self.input_dir
     self.output_dir = os.path.join(self.data_dir, 'datafiles')
     self.archive_dir = os.path.join(self.data_dir, 'archives', self.today.strftime('%Y-%m-%d'))
     self.zip_file_name = zip_file_name
 
+    # optional: archive each export's files content-addressed under
+    # archives/store instead of a copy of the zip per day, thinned to
+    # archive_retention, e.g. { 'daily': 14, 'weekly': 8, 'monthly': 24 }
+    self.archive_store = getattr(app_config, 'archive_store', False)
+    self.archive_retention = getattr(app_config, 'archive_retention', None)
+    self.archive_store_dir = os.path.join(self.data_dir, 'archives', 'store')
+
     self.single_school = None
     self.single_year = school_year
     if self.single_year == 'auto':
@@ -195,182 +299,681 @@ class DdImporter:
 
     self.uploads = do_uploads
 
+    # optional: read the sources straight from PowerSchool instead of the
+    # dd-*.txt files; db_driver is a DB-API module (e.g. 'cx_Oracle'),
+    # db_connect_args its connect() arguments, and rows are fetched
+    # db_batch_size at a time
+    self.input_source = getattr(app_config, 'input_source', 'files')
+    self.db_driver = getattr(app_config, 'db_driver', None)
+    self.db_connect_args = getattr(app_config, 'db_connect_args', { })
+    self.db_batch_size = getattr(app_config, 'db_batch_size', 1000)
+    self.ps_exporter = None
+
+    # optional: read, parse and analyze source files, and write output
+    # files, on separate threads joined by queues of at most this many
+    # blocks; 0 runs everything on the main thread
+    self.pipeline_depth = getattr(app_config, 'pipeline_depth', 0)
+    # source stages started before the analyze_* method that reads them
+    self.prefetched = { }
+
+    # optional: seconds between progress lines, and the stages (e.g.
+    # 'rosters', 'output' or 'all') to run under cProfile or tracemalloc;
+    # their reports go to output_base_dir/profiles
+    self.metrics = dd_metrics.Metrics(
+      getattr(app_config, 'progress_interval', 5),
+      getattr(app_config, 'profile_stages', None),
+      getattr(app_config, 'trace_memory_stages', None),
+      os.path.join(self.data_dir, 'profiles'))
+
+    # optional: zip member compression ('deflate', 'bzip2', 'lzma' or
+    # 'stored') and level; members are compressed as the files are written
+    self.zip_compression = getattr(app_config, 'zip_compression', 'deflate')
+    self.zip_compression_level = getattr(app_config, 'zip_compression_level', None)
+    self.packager = None
+
+    # optional: WebDAV upload attempts, first retry delay in seconds
+    # (doubled on each retry) and per-request timeout in seconds
+    self.upload_retries = getattr(app_config, 'upload_retries', 5)
+    self.upload_retry_delay = getattr(app_config, 'upload_retry_delay', 2)
+    self.upload_timeout = getattr(app_config, 'upload_timeout', 120)
+    self.upload_last_sent = 0
+    # optional: WebDAV port, when it isn't the protocol's default
+    self.webdav_port = getattr(app_config, 'webdav_port', 0)
+
+    # optional: where to deliver the zip ('webdav', 'sftp' and/or
+    # 'mirror'); all destinations are sent to at the same time
+    self.delivery_destinations = getattr(app_config, 'delivery_destinations', [ 'webdav' ])
+    self.mirror_dir = getattr(app_config, 'mirror_dir', None)
+    for destination in self.delivery_destinations:
+      if not destination in DELIVERY_DESTINATIONS:
+        raise Exception('unknown delivery destination %s' % destination)
+    if 'mirror' in self.delivery_destinations and not self.mirror_dir:
+      raise Exception('mirror delivery needs mirror_dir')
+
+    # optional: compare each export with the last successful one and skip
+    # packaging and upload when no row changed
+    self.incremental_export = getattr(app_config, 'incremental_export', False)
+    self.export_state_path = os.path.join(self.data_dir, 'archives', 'export-state.json')
+    self.export_hashes = None
+
+    # optional: also write the analyzed students, rosters, teachers and
+    # courses as a typed, columnar dataset ('sqlite' or 'parquet') under
+    # analytic_dir, for querying without parsing the output files
+    self.analytic_format = getattr(app_config, 'analytic_format', None)
+    self.analytic_dir = os.path.realpath(getattr(app_config, 'analytic_dir',
+      os.path.join(self.data_dir, 'analytic')))
+    if self.analytic_format:
+      dd_analytic.check_format(self.analytic_format)
+
+    # optional: cache the analyzed inputs under output_base_dir/cache, up
+    # to this many MB, so a re-run on unchanged inputs skips the analysis
+    cache_mb = getattr(app_config, 'input_cache_mb', None)
+    self.input_cache_bytes = int(cache_mb * 1024 * 1024) if cache_mb else None
+    self.cache_dir = os.path.join(self.data_dir, 'cache')
+
+    # optional: record each stage a run finishes (see dd_checkpoint), so
+    # that a failed run can be picked up with --resume, which records them
+    # too
+    self.checkpoint_stages = getattr(app_config, 'checkpoint_stages', False)
+    # with --resume, skip the stages a failed run with the same inputs
+    # already finished
+    self.resume = False
+    self.checkpoint_path = os.path.join(self.data_dir, 'checkpoints.json')
+
+    # optional: keep roster output memory under this many MB by spilling
+    # sorted runs to disk and merging them when the roster file is written
+    budget = getattr(app_config, 'roster_sort_budget_mb', None)
+    self.roster_sort_budget = int(budget * 1024 * 1024) if budget else None
+    self.roster_spool = None
+
+    # optional: parse the course, teacher and student files in this many
+    # worker processes
+    self.analysis_workers = getattr(app_config, 'analysis_workers', 1) or 1
+    if self.store is not None:
+      # worker results come back whole, in memory
+      self.analysis_workers = 1
+
+    # optional: parse and filter the roster files in this many worker
+    # processes, each taking newline-aligned chunks of the mapped file
+    self.roster_parse_workers = getattr(app_config, 'roster_parse_workers', 1) or 1
+
+    # optional: split the district into one shard per school, analyze the
+    # shards in parallel and merge them into the district files
+    self.shard_by_school = getattr(app_config, 'shard_by_school', False)
+    self.shard_workers = getattr(app_config, 'shard_workers', None)
+    self.shard_dir = os.path.join(self.data_dir, 'shards')
+    self.rerun_school = None
+    # (year, userid) -> (dd_row, n) for teachers first activated by a
+    # roster row in a shard; used to restore district order when merging
+    self.roster_activations = { }
+    if self.shard_by_school and self.input_source == 'db':
+      raise Exception('shard_by_school splits the dd-*.txt files; export them with ps_exporter.py instead of using input_source db')
+    if self.shard_by_school and self.store is not None:
+      raise Exception('shard_by_school merges whole shards in memory; use memory_budget_mb without it')
+
+    # optional: with --watch, seconds between looks at source_dir, and
+    # seconds a source file's size and mtime must hold before it is read
+    self.watch_interval = getattr(app_config, 'watch_interval', 10)
+    self.watch_settle_seconds = getattr(app_config, 'watch_settle_seconds', 60)
+    # source file -> (size, mtime) of what a watch run has analyzed
+    self.watched = { }
+
    
   def perform(self):
     print('Starting job')
 
-    self.process_files()
-    if self.output_files():
+    try:
+      self.export_and_deliver()
+    finally:
+      self.save_metrics()
+
+
+  def export_and_deliver(self):
+    checkpoints = self.open_checkpoints()
+    if checkpoints.record('output') is None:
+      with self.metrics.stage('analyze'):
+        self.load_or_process_files()
+    self.deliver_export(checkpoints)
+
+
+  def open_checkpoints(self):
+    # with --resume, the stages a failed run with the same inputs and
+    # settings finished; query results have no files to fingerprint, so
+    # db runs are only keyed on the settings and the date.  Without
+    # checkpointing there is no key to compute and nothing to write.
+    if not self.checkpoint_stages and not self.resume:
+      return dd_checkpoint.NoCheckpoints()
+    inputs = [ ] if self.input_source == 'db' else self.input_files()
+    key = dd_cache.InputCache(self.cache_dir, self.input_cache_bytes).key(inputs,
+      self.cache_settings())
+    return dd_checkpoint.Checkpoints(self.checkpoint_path, key, self.resume)
+
+
+  def deliver_export(self, checkpoints):
+    # writes, packages and delivers the analyzed state, skipping the
+    # stages checkpoints says are done
+    output = checkpoints.record('output')
+    if output is None:
       if self.uploads:
-        self.package_and_archive_files()
-        self.upload_file_by_webdav()
+        self.packager = dd_package.ZipPackager(self.zip_file_path(),
+          self.zip_compression, self.zip_compression_level)
+      with self.metrics.stage('output'):
+        files_written = self.output_files()
+      checkpoints.save('output', glob.glob(os.path.join(self.output_dir, '*.txt')),
+        files_written=files_written)
+    else:
+      files_written = output['files_written']
+    if files_written:
+      changed = True
+      if self.incremental_export:
+        with self.metrics.stage('compare'):
+          changed = self.compare_with_last_export()
+      if self.uploads:
+        if not changed:
+          print('Nothing changed since the last export; skipping upload')
+          if self.packager is not None:
+            self.packager.discard()
+          return
+        if checkpoints.record('package') is None:
+          with self.metrics.stage('package'):
+            self.package_files()
+          checkpoints.save('package', [ self.zip_file_path() ])
+        if checkpoints.record('archive') is None:
+          with self.metrics.stage('archive'):
+            archived = self.archive_package()
+          checkpoints.save('archive', [ archived ])
+        with self.metrics.stage('deliver'):
+          delivered = self.deliver_package(checkpoints)
+        if not delivered:
+          return
+      if self.incremental_export:
+        self.save_export_state()
+    elif self.packager is not None:
+      self.packager.discard()
+
+
+  def save_metrics(self):
+    # stage timings, row counts and memory, next to the day's archive;
+    # the run is over, so the RSS sampler is stopped
+    self.metrics.stop_sampler()
+    try:
+      if self.archive_store:
+        path = dd_archive.ArchiveStore(self.archive_store_dir).metrics_path(self.today)
+      else:
+        path = os.path.join(self.archive_dir, self.zip_file_name + '-metrics.json')
+      self.metrics.write(path)
+      print('Saved run metrics to %s' % path)
+    except Exception as e:
+      print('Saving run metrics failed: %s' % e)
+
+
+  def compare_with_last_export(self):
+    print('Comparing with last export')
+    self.export_hashes = dd_delta.export_hashes(
+      glob.glob(os.path.join(self.output_dir, '*.txt')))
+    state = dd_delta.load_state(self.export_state_path)
+    if state is None:
+      print('No previous export state')
+      return True
+    changes = dd_delta.compare(state['files'], self.export_hashes)
+    if len(changes) == 0:
+      print('No rows changed since the last export')
+      return False
+    for fname in sorted(changes.keys()):
+      print('%s: %d added, %d changed, %d deleted' % ((fname, ) + changes[fname]))
+    return True
+
+
+  def save_export_state(self):
+    archives_dir = os.path.dirname(self.export_state_path)
+    if not os.path.isdir(archives_dir):
+      os.makedirs(archives_dir)
+    dd_delta.save_state(self.export_state_path, self.export_hashes)
+
+
+  def zip_file_path(self):
+    return os.path.join(self.output_dir, self.zip_file_name + '.zip')
+
+
+  def open_output(self, fname):
+    # output file, teed into a zip member when packaging is streamed
+    out = open(os.path.join(self.output_dir, fname), 'w')
+    if self.pipeline_depth:
+      out = dd_pipeline.Writer(out, self.pipeline_depth)
+    if self.packager is None:
+      return out
+    return dd_package.TeeOutput(out, self.packager.open_member(fname))
 
 
   def package_and_archive_files(self):
+    self.package_files()
+    self.archive_package()
+
+
+  def package_files(self):
     print('Zipping files')
-    zip_file_path = os.path.join(self.output_dir, self.zip_file_name + '.zip')
+    zip_file_path = self.zip_file_path()
     if os.path.exists(zip_file_path):
       os.remove(zip_file_path)
-    with zipfile.ZipFile(zip_file_path, 'w') as zipf:
-      for fname in glob.glob(os.path.join(self.output_dir, "*.txt")):
-        # zip without paths '-j'
-        print("adding %s to zip file" % fname)
-        arcname = os.path.basename(fname)
-        zipf.write(fname, arcname)
-    
+    packager = self.packager
+    if packager is None:
+      # files weren't streamed into the zip as they were written
+      packager = dd_package.ZipPackager(zip_file_path,
+        self.zip_compression, self.zip_compression_level)
+      packager.add_files(glob.glob(os.path.join(self.output_dir, '*.txt')))
+    packager.close()
+    self.packager = None
+
+
+  def archive_package(self):
+    # returns the archived zip, or the export's manifest in the store
+    if self.archive_store:
+      store = dd_archive.ArchiveStore(self.archive_store_dir)
+      manifest_path = store.add(self.today, glob.glob(os.path.join(self.output_dir, '*.txt')))
+      if self.archive_retention:
+        store.prune(self.today, **self.archive_retention)
+      return manifest_path
     print('Archiving zip file')
     if not os.path.isdir(self.archive_dir):
       os.makedirs(self.archive_dir)
-    shutil.copy(zip_file_path, self.archive_dir)
+    return dd_package.link_or_copy(self.zip_file_path(), self.archive_dir)
+
+
+  def deliver_package(self, checkpoints=None):
+    # true only if every destination got the zip; each one is tried
+    # regardless of how the others do, except those checkpoints says
+    # already have it
+    delivered_to = [ ]
+    if checkpoints is not None and checkpoints.record('deliver') is not None:
+      delivered_to = checkpoints.record('deliver')['destinations']
+    destinations = [ d for d in self.delivery_destinations if not d in delivered_to ]
+    if len(destinations) == 0:
+      print('Already delivered to %s' % ', '.join(delivered_to))
+      return True
+    if len(destinations) == 1:
+      results = [ self.timed_delivery(destinations[0]) ]
+    else:
+      print('Delivering zip file to %s' % ', '.join(destinations))
+      pool = ThreadPool(len(destinations))
+      try:
+        results = pool.map(self.timed_delivery, destinations)
+      finally:
+        pool.close()
+        pool.join()
+
+    for destination, (delivered, elapsed) in zip(destinations, results):
+      print('%s: %s in %.1f seconds' % (destination,
+        'delivered' if delivered else 'failed', elapsed))
+      if delivered:
+        delivered_to.append(destination)
+    if checkpoints is not None:
+      checkpoints.save('deliver', destinations=delivered_to)
+    return all([ delivered for delivered, elapsed in results ])
+
+
+  def timed_delivery(self, destination):
+    started = time.time()
+    try:
+      delivered = getattr(self, DELIVERY_DESTINATIONS[destination])()
+    except Exception as e:
+      print('%s delivery failed: %s' % (destination, e))
+      delivered = False
+    return delivered, time.time() - started
 
 
   def upload_file_by_webdav(self):
     print('Uploading zip file via WebDAV')
     remote_path = self.zip_file_name + '.zip'
-    local_path = os.path.join(self.output_dir, self.zip_file_name + '.zip')
+    local_path = self.zip_file_path()
 
     try:
-      webdav = easywebdav.connect(webdav_host, protocol=webdav_protocol,
-        verify_ssl=True,
-        username=username, password=password, path=webdav_path)
-      # upload method doesn't give us response information
-      # webdav.upload(local_path, remote_path)
-      with open(local_path, 'rb') as f:
-        resp = webdav._send('PUT', remote_path, (200, 201, 204), data=f)
-        print('Upload successful, response was %d' % resp.status_code)
+      uploader = dd_upload.WebDavUploader(webdav_host, webdav_protocol,
+        webdav_path, username, password, webdav_use_digest_auth,
+        self.upload_retries, self.upload_retry_delay, self.upload_timeout,
+        self.webdav_port)
+      uploader.upload(local_path, remote_path, self.upload_progress)
+      print('Upload successful')
+      return True
     except Exception as e:
       print('Upload failed: %s' % e)
+      return False
+
+
+  def upload_progress(self, sent, total):
+    # report every 10%
+    step = max(total // 10, 1)
+    if sent == total or sent // step != self.upload_last_sent // step:
+      print('%d of %d bytes uploaded' % (sent, total))
+    self.upload_last_sent = sent
 
 
   def upload_file_by_sftp(self):
     print('Uploading zip file via SFTP')
-    local_fname = os.path.join(self.output_dir, self.zip_file_name + '.zip')
+    local_fname = self.zip_file_path()
 
     try:
       with pysftp.Connection(sftp_host, username=username, password=password) as sftp:
         with sftp.cd(sftp_path): 
           sftp.put(local_fname)
           print('Upload successful')
+      return True
     except Exception as e:
       print('Upload failed: %s' % e)
+      return False
 
 
-  def process_csv(self, path, hdr_check):
+  def copy_file_to_mirror(self):
+    print('Copying zip file to %s' % self.mirror_dir)
+    local_path = self.zip_file_path()
+    mirror_path = os.path.join(self.mirror_dir, os.path.basename(local_path))
+    tmp_path = mirror_path + '.tmp'
+
+    try:
+      if not os.path.isdir(self.mirror_dir):
+        os.makedirs(self.mirror_dir)
+      # readers of the mirror never see a partial zip
+      shutil.copy(local_path, tmp_path)
+      if os.path.exists(mirror_path):
+        os.remove(mirror_path)
+      os.rename(tmp_path, mirror_path)
+      print('Copy successful')
+      return True
+    except Exception as e:
+      print('Copy failed: %s' % e)
+      return False
+
+
+  def normalize_headers(self, headers):
+    # change '[39]Alternate School Number' to 'alternate_school_number'
+    new_headers = [ ]
+    for h in headers:
+      h = re.sub(r'[^_a-z0-9]', '', re.sub(r'^[^\]]+\]', '', h.lower().replace(' ', '_')))
+      new_headers.append(h)
+    return new_headers
+
+
+  def open_tsv(self, f, hdr_check):
+    # The first line is read exactly once.  If it holds the expected
+    # hdr_check columns it is the header row, otherwise it is data and
+    # hdr_check supplies the headers.  Returns the normalized headers and
+    # an iterator over the remaining data lines.
+    first_line = f.readline()
+    headers, is_header = self.tsv_headers(first_line, hdr_check)
+    if not is_header:
+      return headers, itertools.chain([ first_line ], f)
+    return headers, f
+
+
+  def tsv_headers(self, first_line, hdr_check):
+    # the normalized headers of a file, and whether first_line holds them
+    headers = self.normalize_headers(first_line.rstrip('\r\n').split('\t'))
+    if hdr_check is not None:
+      expected = self.normalize_headers(hdr_check)
+      if not set(expected).issubset(headers):
+        return expected, False
+    return headers, True
+
+
+  def reads_as_header(self, kind, names):
+    # whether names, as the first line of a kind of source file, would be
+    # taken for its header row rather than for data
+    headers, is_header = self.tsv_headers('\t'.join(names), SOURCE_HEADERS.get(kind))
+    return is_header
+
+
+  def column_projection(self, headers, columns):
+    # Returns a function that picks columns out of a split row, and the
+    # row width it needs.  Columns the file doesn't have read as ''.
+    index = dict([ (h, i) for i, h in enumerate(headers) ])
+    missing = len(headers)
+    indexes = [ index.get(c, missing) for c in columns ]
+    if len(indexes) == 1:
+      i = indexes[0]
+      project = lambda fields: (fields[i], )
+    else:
+      project = operator.itemgetter(*indexes)
+    return project, max(indexes) + 1
+
+
+  def process_tsv(self, path, hdr_check, columns, filters=None):
+    # yields a tuple holding just the wanted columns of each row that
+    # passes filters, a dd_filters.FilterSpec
     with open(path, 'r') as f:
-      headers = None
-      if hdr_check is not None:
-        test = f.read(len(hdr_check))
-        if test != hdr_check:
-          f.seek(0)
-          headers = hdr_check
-      reader = csv.DictReader(f, fieldnames=headers, delimiter='\t',
-        lineterminator='\n', quoting=csv.QUOTE_NONE)
-
-      # change '[39]Alternate School Number' to 'alternate_school_number'
-      new_headers = [ ]
-      for h in reader.fieldnames:
-        h = re.sub(r'[^_a-z0-9]', '', re.sub(r'^[^\]]+\]', '', h.lower().replace(' ', '_')))
-        new_headers.append(h)
-      reader.fieldnames = new_headers
-      for row in reader:
+      headers, lines = self.open_tsv(f, hdr_check)
+      project, width = self.column_projection(headers, columns)
+      check, width = self.bind_filters(filters, headers, width)
+      for line in lines:
+        line = line.rstrip('\r\n')
+        if line == '':
+          continue
+        fields = line.split('\t')
+        if len(fields) < width:
+          fields.extend([ '' ] * (width - len(fields)))
+        if check is not None and not check(fields):
+          continue
+        yield project(fields)
+
+
+  def bind_filters(self, filters, headers, width):
+    # the check for filters (None without any) and the row width that
+    # both it and a projection of the given width need
+    if filters is None:
+      return None, width
+    check, filter_width = filters.bind(headers)
+    return check, max(width, filter_width)
+
+
+  def read_source(self, kind, paths, hdr_check, columns, filters=None):
+    # projected rows of one kind of source: the dd-*.txt files in paths,
+    # or with input_source 'db' the matching PowerSchool query
+    if self.input_source == 'db':
+      return self.query_source(kind, columns, filters)
+    if self.pipeline_depth:
+      return self.pipelined_source(kind, paths, hdr_check, columns, filters)
+    return itertools.chain.from_iterable(
+      [ self.process_tsv(path, hdr_check, columns, filters) for path in paths ])
+
+
+  def pipelined_source(self, kind, paths, hdr_check, columns, filters):
+    prefetched = self.prefetched.pop(kind, None)
+    if prefetched is None:
+      stages = self.source_stages(kind, paths, hdr_check, columns, filters)
+      stage_filters = filters
+    else:
+      stages, stage_filters = prefetched
+    for rows in stages:
+      for row in rows:
         yield row
+    if stage_filters is not filters:
+      filters.merge(stage_filters.rejected)
+
+
+  def source_stages(self, kind, paths, hdr_check, columns, filters):
+    parse = lambda blocks: self.parse_blocks(blocks, hdr_check, columns, filters)
+    return dd_pipeline.source_stages(kind, paths, parse, self.pipeline_depth)
+
+
+  def parse_blocks(self, blocks, hdr_check, columns, filters):
+    # parser stage: the projected rows of each block of lines read
+    path = None
+    for block_path, lines in blocks:
+      if block_path != path:
+        path = block_path
+        headers, is_header = self.tsv_headers(lines[0], hdr_check)
+        project, width = self.column_projection(headers, columns)
+        check, width = self.bind_filters(filters, headers, width)
+        if is_header:
+          lines = lines[1:]
+      rows = [ ]
+      for line in lines:
+        line = line.rstrip('\r\n')
+        if line == '':
+          continue
+        fields = line.split('\t')
+        if len(fields) < width:
+          fields.extend([ '' ] * (width - len(fields)))
+        if check is not None and not check(fields):
+          continue
+        rows.append(project(fields))
+      yield rows
+
+
+  def prefetch_rosters(self):
+    # Rosters wait on students and teachers to be analyzed, but can be
+    # read and parsed in the meantime, with every filter but the
+    # current-student one. Parallel roster parsing reads the file itself.
+    if (self.pipeline_depth and self.input_source != 'db' and
+        self.roster_parse_workers <= 1):
+      filters = self.roster_filters(None)
+      stages = self.source_stages('rosters', self.source_paths(self.input_dir, 'rosters'),
+        STUDENT_SCHEDULES_HEADERS, ROSTER_COLUMNS, filters)
+      self.prefetched['rosters'] = (stages, filters)
+
+
+  def query_source(self, kind, columns, filters=None):
+    if self.ps_exporter is None:
+      connection = ps_exporter.connect(self.db_driver, self.db_connect_args)
+      self.ps_exporter = ps_exporter.PsExporter(connection, self.db_batch_size)
+    names, rows = self.ps_exporter.source_rows(kind, self.single_year)
+    headers = self.normalize_headers(names)
+    project, width = self.column_projection(headers, columns)
+    check, width = self.bind_filters(filters, headers, width)
+    pad = [ '' ] * (width - len(names))
+    for row in rows:
+      if pad:
+        row.extend(pad)
+      if check is not None and not check(row):
+        continue
+      yield project(row)
+
+
+  def close_sources(self):
+    for stages, filters in self.prefetched.values():
+      stages.stop()
+    self.prefetched = { }
+    if self.ps_exporter is not None:
+      self.ps_exporter.close()
+      self.ps_exporter = None
+
+
+  def process_csv(self, path, hdr_check):
+    # yields every column of each row as a dict
+    with open(path, 'r') as f:
+      headers, lines = self.open_tsv(f, hdr_check)
+      for line in lines:
+        line = line.rstrip('\r\n')
+        if line == '':
+          continue
+        yield dict(zip(headers, line.split('\t')))
 
 
-  def analyze_student_data(self, year):
-    num_rows = 0
+  def analyze_student_data(self, years):
+    # enrollments for every year in years are assigned in this one pass
+    year_set = set(years)
+    progress = self.metrics.counter('student records analyzed')
     path = os.path.join(self.input_dir, 'dd-students.txt')
-    for row in self.process_csv(path, STUDENTS_HEADERS):
-      studentid = row['id']
-      schoolid = int(row['schoolid'])
+    for (studentid, student_number, ssid, schoolid, first_name, last_name,
+        dob, fedethnicity, gender, enroll_status, grade_level,
+        mother_first, mother, father_first, father,
+        street, city, state, zip_code, home_phone,
+        schoolentrydate, districtentrydate, entrydate, school_code,
+        ca_parented, ca_primarylanguage, ca_elastatus, ca_daterfep,
+        ca_firstusaschooling, ca_gate, ca_migranted, ca_primdisability,
+        ca_titlei_targeted, ethnicity) in self.read_source('students', [ path ],
+          STUDENTS_HEADERS, STUDENT_COLUMNS):
+      schoolid = int(schoolid)
       if self.single_school and schoolid != self.single_school:
         print('Skipping student %s; wrong school' % studentid)
         continue
 
-      parent_name = ' '.join([ row['mother_first'], row['mother'] ]).strip()
+      parent_name = ' '.join([ mother_first, mother ]).strip()
       if parent_name == '':
-        parent_name = ' '.join([ row['father_first'], row['father'] ]).strip()
-
-      self.set_student(studentid, 'ssid',       row['state_studentnumber'])
-      self.set_student(studentid, 'student_id', row['student_number'])
-      self.set_student(studentid, 'first_name', row['first_name'])
-      self.set_student(studentid, 'last_name',  row['last_name'])
-      self.set_student(studentid, 'gender',     row['gender'])
-      self.set_student(studentid, 'parent',     parent_name)
-      self.set_student(studentid, 'street',     row['street'])
-      self.set_student(studentid, 'city',       row['city'])
-      self.set_student(studentid, 'state',      row['state'])
-      self.set_student(studentid, 'zip',        row['zip'])
-      self.set_student(studentid, 'phone_number',          row['home_phone'])
-      self.set_student(studentid, 'parent_education',      row['ca_parented'])
-      self.set_student(studentid, 'birthdate',             self.clean_date(row['dob']))
-      self.set_student(studentid, 'date_entered_school',   self.clean_date(row['schoolentrydate']))
-      self.set_student(studentid, 'date_entered_district', self.clean_date(row['districtentrydate']))
-      self.set_student(studentid, 'first_us_entry_date',   self.clean_date(row['ca_firstusaschooling']))
-      self.set_student(studentid, 'date_rfep',             self.clean_date(row['ca_daterfep']))
+        parent_name = ' '.join([ father_first, father ]).strip()
+
+      student = self.students.get(studentid)
+      if student is None:
+        student = Student()
+      student.ssid       = ssid
+      student.student_id = student_number
+      student.first_name = first_name
+      student.last_name  = last_name
+      student.gender     = intern(gender)
+      student.parent     = parent_name
+      student.street     = street
+      student.city       = intern(city)
+      student.state      = intern(state)
+      student.zip        = intern(zip_code)
+      student.phone_number          = home_phone
+      student.parent_education      = intern(ca_parented)
+      student.birthdate             = self.clean_date(dob)
+      student.date_entered_school   = self.clean_date(schoolentrydate)
+      student.date_entered_district = self.clean_date(districtentrydate)
+      student.first_us_entry_date   = self.clean_date(ca_firstusaschooling)
+      student.date_rfep             = self.clean_date(ca_daterfep)
 
       if self.use_race_file:
         # Before we update based on race codes, we set the 'primary' ethnicity
         # to '500' if the student is hispanic/latino
         hispanic_ethnicity = ''
-        if int(row['fedethnicity']) == 1:
+        if int(fedethnicity) == 1:
           hispanic_ethnicity = '500'
-        self.set_student(studentid, 'ethnicity', hispanic_ethnicity)
+        student.ethnicity = hispanic_ethnicity
       else:
-        self.set_student(studentid, 'ethnicity', row['ethnicity'])
+        student.ethnicity = intern(ethnicity)
 
-      primary_language = row['ca_primarylanguage']
-      self.set_student(studentid, 'primary_language',      primary_language)
+      student.primary_language = intern(ca_primarylanguage)
       
-      fluency = row['ca_elastatus']
+      fluency = ca_elastatus
       if fluency != '':
         fluency = FLUENCY_CODES.get(fluency.upper(), '')
-      self.set_student(studentid, 'language_fluency', fluency)
+      student.language_fluency = fluency
       
-      self.set_student(studentid, 'gate',       'N')
-      self.set_student(studentid, 'nslp',       'N')
-      self.set_student(studentid, 'migrant_ed', 'N')
-      self.set_student(studentid, 'special_program', 'N')
-      self.set_student(studentid, 'title_1',    'N')
+      student.gate            = 'N'
+      student.nslp            = 'N'
+      student.migrant_ed      = 'N'
+      student.special_program = 'N'
+      student.title_1         = 'N'
       if not self.use_program_file:
-        if re.match(r'Yes', row['ca_gate'], re.I):
-          self.set_student(studentid, 'gate',       'Y') 
+        if re.match(r'Yes', ca_gate, re.I):
+          student.gate = 'Y'
         # if re.match(r'Yes', ...
-        #   self.self.set_student(studentid, 'nslp',       'Y')
-        if re.match(r'Yes', row['ca_migranted'], re.I):
-          self.set_student(studentid, 'migrant_ed', 'Y')
+        #   student.nslp = 'Y'
+        if re.match(r'Yes', ca_migranted, re.I):
+          student.migrant_ed = 'Y'
         # Special Ed
-        if row['ca_primdisability'] != '' and row['ca_primdisability'] != '000':
-          self.set_student(studentid, 'special_program',   'Y')
-          self.set_student(studentid, 'primary_disability', row['ca_primdisability'])
-
-        if row['ca_titlei_targeted']:
-          self.set_student(studentid, 'title_1',    'Y') 
-
-      enroll_status = int(row['enroll_status'])
-      enroll_year = self.date_to_year_abbr(row['entrydate'])
-      # print 'student #{studentid} entrydate #{row['entrydate']} for year #{year}, enroll_year #{enroll_year}, enroll_status #{enroll_status}'
-      if enroll_status == 0 or (year == enroll_year and enroll_status > 0):
-        self.set_enrollment(year, studentid, 'school_id',   schoolid)
-        self.set_enrollment(year, studentid, 'school_code', row['alternate_school_number'])
-        self.set_enrollment(year, studentid, 'grade_level', row['grade_level'])
+        if ca_primdisability != '' and ca_primdisability != '000':
+          student.special_program    = 'Y'
+          student.primary_disability = ca_primdisability
+
+        if ca_titlei_targeted:
+          student.title_1 = 'Y'
+      self.students[intern(studentid)] = student
+
+      enroll_status = int(enroll_status)
+      enroll_year = self.date_to_year_abbr(entrydate)
+      # print 'student #{studentid} entrydate #{entrydate} for years #{years}, enroll_year #{enroll_year}, enroll_status #{enroll_status}'
+      enroll_years = None
+      if enroll_status == 0:
+        enroll_years = years
+      elif enroll_status > 0 and enroll_year in year_set:
+        enroll_years = [ enroll_year ]
+      if enroll_years:
+        enrollment = Enrollment(schoolid, intern(school_code), intern(grade_level))
+        self.set_enrollment_years(enroll_years, studentid, enrollment)
         # print 'enrolled'
       else:
         # print 'skipping enrollment'
         pass
 
-      num_rows += 1
-      if num_rows % 100 == 0:
-        print('%d student records analyzed' % num_rows)
+      progress.tick()
 
 
   def analyze_race_data(self):
     # we bail after we get the first race...
     path = os.path.join(self.input_dir, 'dd-races.txt')
-    for row in self.process_csv(path, None):
-      studentid = row['studentid']
+    for studentid, race in self.read_source('races', [ path ], None, RACE_COLUMNS):
       if not self.current_student(studentid):
         continue
-      race = row['racecd']
       if not self.student(studentid, 'ethnicity'):
         self.set_student(studentid, 'ethnicity', race)
 
@@ -380,18 +983,19 @@ class DdImporter:
 
 
   def analyze_program_data(self):
+    # rows are dropped before their dates are parsed
+    filters = dd_filters.FilterSpec([
+      dd_filters.Require('not a current student', 'foreignkey', self.students),
+      dd_filters.Require('program not imported', 'user_defined_text', PROGRAM_CODES,
+        parse_program_code) ])
     path = os.path.join(self.input_dir, 'dd-programs.txt')
-    for row in self.process_csv(path, None):
-      studentid = row['foreignkey']
-      if not self.current_student(studentid):
-        continue
-
-      start_date = row.get('user_defined_date', '')
+    for (studentid, program_code, custom,
+        start_date, end_date) in self.read_source('programs', [ path ], None,
+          PROGRAM_COLUMNS, filters):
       if self.nil_date(start_date):
         start_date = self.today
       else:
         start_date = self.parse_date(start_date)
-      end_date = row.get('user_defined_date2', '')
       if self.nil_date(end_date):
         end_date = self.today
       else:
@@ -400,7 +1004,7 @@ class DdImporter:
         # print 'skipping program record start #{start_date} end #{end_date}'
         continue
 
-      program_code = int(row['user_defined_text'])
+      program_code = int(program_code)
       if program_code == 122: # Title 1
         self.set_student(studentid, 'title_1',    'Y')
       elif program_code == 127: # GATE
@@ -412,7 +1016,7 @@ class DdImporter:
         # custom has these chars: 
         # either '\x11\x04\x03\x12\x00\x03320' for '320' primary
         # or '\x11\x04\x06\x12\x00\x03280\x11\x04\x03\x12\x00\x03320' for '280' secondary, '320' primary
-        m = re.search(r'\x11\x04\x03\x12\x00\x03([0-9]{3})', row['custom'])
+        m = re.search(r'\x11\x04\x03\x12\x00\x03([0-9]{3})', custom)
         if not m:
           raise Exception('Sped program custom didn\'t match')
         disability = m.group(1)
@@ -420,138 +1024,204 @@ class DdImporter:
         self.set_student(studentid, 'primary_disability', disability)
       elif program_code == 175: # NSLP
         self.set_student(studentid, 'nslp',       'Y')
+    filters.report('program rows')
 
 
-  def analyze_user_data(self, year):
-    num_rows = 0
-    path = os.path.join(self.input_dir, 'dd-teachers.txt')
-    for row in self.process_csv(path, TEACHERS_HEADERS):
-      userid = row['id']
-      teacherid = row['teachernumber']
-      
-      self.set_user(userid,  'employee_id',   teacherid)
-      self.set_user(userid,  'teacher_id',    teacherid)
-      self.set_user(userid,  'school_id',     row['schoolid'])
-      self.set_user(userid,  'school_code',   row['alternate_school_number'])
-      self.set_user(userid,  'first_name',    row['first_name'])
-      self.set_user(userid,  'last_name',     row['last_name'])
-      self.set_user(userid,  'email_address', row['email_addr'])
-
-      dd_access = row.get('datadirector_access', '')
-      
+  def analyze_user_data(self, years):
+    # teacher-years for every year in years are assigned in this one pass
+    if len(years) == 1:
+      years_label = years[0]
+    else:
+      years_label = '%s through %s' % (years[0], years[-1])
+    progress = self.metrics.counter('teacher records analyzed')
+    path = os.path.join(self.reference_dir, 'dd-teachers.txt')
+    for (userid, teacherid, schoolid, school_code, first_name, last_name,
+        email_addr, status, staffstatus,
+        dd_access) in self.read_source('teachers', [ path ], TEACHERS_HEADERS, TEACHER_COLUMNS):
+      self.users[intern(userid)] = User(teacherid, teacherid,
+        schoolid, school_code, first_name, last_name, email_addr)
+
       # current teachers or specified administrators
-      if int(row['status']) == 1 and (dd_access == '1' or int(row['staffstatus']) == 1):
-        self.set_teacher_year(year, userid, 'active', 'y')
-        print('teacher %s active for year %s' % (row['last_name'], year))
+      if int(status) == 1 and (dd_access == '1' or int(staffstatus) == 1):
+        for year in years:
+          self.set_teacher_year(year, userid, 'active', 'y')
+        print('teacher %s active for year %s' % (last_name, years_label))
 
-      num_rows += 1
-      if num_rows % 100 == 0:
-        print('%d teacher records analyzed' % num_rows)
+      progress.tick()
 
 
   def analyze_course_data(self):
-    num_rows = 0
-    for fname in ['dd-courses-all.txt', 'dd-courses-bacich.txt', 'dd-courses-kent.txt']:
-      path = os.path.join(self.input_dir, fname)
-      if not os.path.exists(path):
-        continue
-      for row in self.process_csv(path, COURSES_HEADERS):
-        courseid = row['course_number']
-        abbreviation = self.course_abbreviation(row['course_name'])
-        self.set_course(courseid, 'course_id',    courseid)
-        self.set_course(courseid, 'abbreviation', abbreviation)
-        self.set_course(courseid, 'name',         row['course_name'])
-        self.set_course(courseid, 'credits',      row['credit_hours'])
-        self.set_course(courseid, 'subject_code', row['credittype'])
-        self.set_course(courseid, 'a_to_g',       '')
-        self.set_course(courseid, 'school_id',    row['schoolid'])
-        self.set_course(courseid, 'school_code',  row['alternate_school_number'])
-      
-        num_rows += 1
-        if num_rows % 100 == 0:
-          print('%d courses analyzed' % num_rows)
-      if fname == 'dd-courses-all.txt':
-        break
+    progress = self.metrics.counter('courses analyzed')
+    paths = self.source_paths(self.reference_dir, 'courses')
+    for (courseid, course_name, credit_hours, credittype, schoolid,
+        school_code) in self.read_source('courses', paths, COURSES_HEADERS, COURSE_COLUMNS):
+      courseid = intern(courseid)
+      abbreviation = self.course_abbreviation(course_name)
+      self.courses[courseid] = Course(courseid, abbreviation,
+        course_name, credit_hours, credittype, '', schoolid, school_code)
+    
+      progress.tick()
+
+
+  def student_projection(self, year):
+    # studentid -> (ssid, student_id, grade_level) as of year
+    enrollments = self.enrollments.get(year, { })
+    index = self.new_store(100)
+    for studentid, student in self.students.items():
+      enrollment = enrollments.get(studentid)
+      grade_level = enrollment.grade_level if enrollment is not None else ''
+      index[studentid] = (student.ssid, student.student_id, grade_level)
+    return index
+
+
+  def user_projection(self):
+    # userid -> (teacher_id, employee_id)
+    index = { }
+    for userid, user in self.users.items():
+      index[userid] = (user.teacher_id, user.employee_id)
+    return index
 
 
   def analyze_roster_data(self):
-    num_rows = 0
-    for fname in ['dd-rosters-all.txt', 'dd-rosters-bacich.txt', 'dd-rosters-kent.txt']:
-      path = os.path.join(self.input_dir, fname)
-      if not os.path.exists(path):
-        continue
-      for row in self.process_csv(path, STUDENT_SCHEDULES_HEADERS):
-        courseid  = row['course_number']
-        if courseid in EXCLUDED_COURSES:
-          continue
-  
-        studentid = row['studentid']
-        if not self.current_student(studentid):
-          continue
-        
-        termid = row['termid']
-        # reject negative termid's - dropped sections
-        if termid == '' or termid[:1] == '-':
-          continue
-        
-        sectionid = row['sectionid']
-        # reject negative sectionid's - dropped sections
-        if sectionid == '' or sectionid[:1] == '-':
-          continue
-        
-        period = self.expression_to_period(row['expression'])
-        if period == '':
-          continue
-        
-        term  = self.term_abbreviation(row['abbreviation'])
-        if term == '':
-          continue
-        
-        year = self.term_to_year_abbr(termid)
-      
-        userid = row['teacherid']
-        self.set_teacher_year(year, userid, 'active', 'y')
-      
-        memberid = '-'.join([ courseid, studentid ])
-        self.set_roster(year, memberid, 'ssid',        self.student(studentid, 'ssid'))
-        self.set_roster(year, memberid, 'student_id',  self.student(studentid, 'student_id'))
-        self.set_roster(year, memberid, 'teacher_id',  self.user(userid, 'teacher_id'))
-        self.set_roster(year, memberid, 'employee_id', self.user(userid, 'employee_id'))
-        self.set_roster(year, memberid, 'school_id',   row['schoolid'])
-        self.set_roster(year, memberid, 'school_code', row['alternate_school_number'])
-        self.set_roster(year, memberid, 'grade_level', self.enrollment(year, studentid, 'grade_level'))
-        self.set_roster(year, memberid, 'period',      period)
-        self.set_roster(year, memberid, 'term',        term)
-        self.set_roster(year, memberid, 'course_id',   courseid)
-        self.set_roster(year, memberid, 'section_id',  sectionid)
+    # every roster row is joined against these indexes with one lookup
+    # per side instead of a getter call per denormalized field
+    student_indexes = { }
+    users = self.user_projection()
+    no_user = ('', '')
+    if self.roster_sort_budget:
+      self.roster_spool = RosterSpool(self.data_dir, self.roster_sort_budget)
+    progress = self.metrics.counter('roster records analyzed')
+    filters = self.roster_filters(self.students)
+    for (studentid, userid, schoolid, termid, school_code, period, term,
+        courseid, sectionid, dd_row) in self.filtered_roster_rows(filters):
+      year = self.term_to_year_abbr(termid)
+      students = student_indexes.get(year)
+      if students is None:
+        students = student_indexes[year] = self.student_projection(year)
+      ssid, student_id, grade_level = students[studentid]
+    
+      if dd_row:
+        self.note_roster_activation(year, userid, dd_row, 0)
+      self.set_teacher_year(year, userid, 'active', 'y')
+      teacher_id, employee_id = users.get(userid, no_user)
+    
+      courseid    = intern(courseid)
+      schoolid    = intern(schoolid)
+      school_code = intern(school_code)
+      term        = intern(term)
+      sectionid   = intern(sectionid)
+
+      memberid = '-'.join([ courseid, studentid ])
+      self.add_roster(year, memberid, Roster(ssid, student_id,
+        teacher_id, employee_id, schoolid, school_code, grade_level,
+        period, term, courseid, sectionid))
+    
+      progress.tick()
       
-        num_rows += 1
-        if num_rows % 100 == 0:
-          print('%d roster records analyzed' % num_rows) 
+      if userid in CO_TEACHERS:
+        for i, co_teacherid in enumerate(CO_TEACHERS[userid]):
+          if dd_row:
+            self.note_roster_activation(year, co_teacherid, dd_row, i + 1)
+          self.set_teacher_year(year, co_teacherid, 'active', 'y')
+        
+          # same student side, only the teacher side differs
+          teacher_id, employee_id = users.get(co_teacherid, no_user)
+          memberid = '-'.join([ courseid, studentid, co_teacherid ])
+          self.add_roster(year, memberid, Roster(ssid, student_id,
+            teacher_id, employee_id, schoolid, school_code, grade_level,
+            period, term, courseid, sectionid))
         
-        if userid in CO_TEACHERS:
-          for co_teacherid in CO_TEACHERS[userid]:
-            self.set_teacher_year(year, co_teacherid, 'active', 'y')
-          
-            memberid = '-'.join([ courseid, studentid, co_teacherid ])
-            self.set_roster(year, memberid, 'ssid',        self.student(studentid, 'ssid'))
-            self.set_roster(year, memberid, 'student_id',  self.student(studentid, 'student_id'))
-            self.set_roster(year, memberid, 'teacher_id',  self.user(co_teacherid, 'teacher_id'))
-            self.set_roster(year, memberid, 'employee_id', self.user(co_teacherid, 'employee_id'))
-            self.set_roster(year, memberid, 'school_id',   row['schoolid'])
-            self.set_roster(year, memberid, 'school_code', row['alternate_school_number'])
-            self.set_roster(year, memberid, 'grade_level', self.enrollment(year, studentid, 'grade_level'))
-            self.set_roster(year, memberid, 'period',      period)
-            self.set_roster(year, memberid, 'term',        term)
-            self.set_roster(year, memberid, 'course_id',   courseid)
-            self.set_roster(year, memberid, 'section_id',  sectionid)
-          
-            num_rows = num_rows + 1
-            if num_rows % 100 == 0:
-              print('%d roster records analyzed' % num_rows) 
-
-      if fname == 'dd-rosters-all.txt':
-        break 
+          progress.tick()
+    filters.report('roster rows')
+
+
+  def roster_filters(self, students):
+    # what a roster row is dropped for, checked in this order; students
+    # is None for rows read before the students are analyzed, which
+    # filter_rosters checks instead
+    filters = [
+      dd_filters.Exclude('excluded course', 'course_number', EXCLUDED_COURSES),
+      dd_filters.RejectNegative('dropped term', 'termid'),
+      dd_filters.RejectNegative('dropped section', 'sectionid') ]
+    if students is not None:
+      filters.append(dd_filters.Require('not a current student', 'studentid', students))
+    return dd_filters.FilterSpec(filters)
+
+
+  def filtered_roster_rows(self, filters):
+    # roster rows that pass filters and filter_rosters, in file order
+    paths = self.source_paths(self.input_dir, 'rosters')
+    if self.roster_parse_workers > 1 and self.input_source != 'db':
+      return self.parse_rosters_in_parallel(paths, filters)
+    students = self.students if 'rosters' in self.prefetched else None
+    return filter_rosters(self.read_source('rosters', paths,
+      STUDENT_SCHEDULES_HEADERS, ROSTER_COLUMNS, filters), filters, students)
+
+
+  def parse_rosters_in_parallel(self, paths, filters):
+    # Chunks are handed out a few at a time and their rows yielded in
+    # chunk order, so the result matches a serial parse and no more than
+    # a few chunks' rows wait in memory.  Workers get the filters once,
+    # with the current students as a set of ids.
+    jobs = iter([ job for path in paths for job in self.roster_chunks(path) ])
+    pool = multiprocessing.Pool(self.roster_parse_workers, init_roster_worker,
+      (self.roster_filters(frozenset(self.students)), ))
+    try:
+      pending = collections.deque()
+      for job in itertools.islice(jobs, 2 * self.roster_parse_workers):
+        pending.append(pool.apply_async(parse_roster_chunk, (job, )))
+      while pending:
+        rows, rejected = pending.popleft().get()
+        filters.merge(rejected)
+        for job in itertools.islice(jobs, 1):
+          pending.append(pool.apply_async(parse_roster_chunk, (job, )))
+        for row in rows:
+          yield row
+    finally:
+      pool.terminate()
+      pool.join()
+
+
+  def roster_chunks(self, path):
+    # (path, start, end, headers) for newline-aligned chunks of about
+    # ROSTER_CHUNK_BYTES, after the header row if the file has one
+    size = os.path.getsize(path)
+    if size == 0:
+      return [ ]
+    chunks = [ ]
+    with open(path, 'rb') as f:
+      m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      try:
+        start = m.find(b'\n') + 1 or size
+        headers, is_header = self.tsv_headers(decode_text(m[:start]),
+          STUDENT_SCHEDULES_HEADERS)
+        if not is_header:
+          start = 0
+        while start < size:
+          end = m.find(b'\n', min(start + ROSTER_CHUNK_BYTES, size) - 1) + 1 or size
+          chunks.append((path, start, end, headers))
+          start = end
+      finally:
+        m.close()
+    return chunks
+
+
+  def note_roster_activation(self, year, userid, dd_row, n):
+    if not userid in self.teacher_years.get(year, { }):
+      self.roster_activations[(year, userid)] = (int(dd_row), n)
+
+
+  def source_paths(self, source_dir, kind):
+    # the district-wide dd-<kind>-all.txt wins over the per-school files
+    paths = [ ]
+    for fname in ['dd-%s-all.txt' % kind, 'dd-%s-bacich.txt' % kind, 'dd-%s-kent.txt' % kind]:
+      path = os.path.join(source_dir, fname)
+      if not os.path.exists(path):
+        continue
+      paths.append(path)
+      if fname == 'dd-%s-all.txt' % kind:
+        break
+    return paths
 
   def output_files(self):
     files_written = 0
@@ -562,56 +1232,28 @@ class DdImporter:
     else:
       os.makedirs(self.output_dir)
 
-    roster_fields = [
-      'ssid', 'student_id', 'teacher_id', 'employee_id', 
-      'school_id', 'school_code', 'grade_level', 'period', 'term', 'course_id', 'section_id' ]
-      
     course_keys = { }
-    years = sorted(self.rosters.keys())
+    roster_years = self.roster_years()
+    years = list(roster_years)
     if len(years) == 0 and self.single_year:
       years.append(self.single_year)
     for year in years:
-      if year in self.rosters:
+      if year in roster_years:
         fname = 'rosters_Kentfield.txt' if self.single_year else ('%srosters.txt' % year)
-        num_rows = 0
-        path = os.path.join(self.output_dir, fname)
-        with open(path, 'w') as out:
+        progress = self.metrics.counter('roster records written for %s' % year)
+        with self.open_output(fname) as out:
           files_written += 1
-          header_fields = '\t'.join(roster_fields)
-          out.write(header_fields)
-          out.write('\n')
-          members = sorted(self.rosters[year].keys())
-          for memberid in members:
-            # mark courses
-            courseid = self.roster(year, memberid, 'course_id')
-            course_keys[courseid] = 1
-            values = '\t'.join([str(self.roster(year, memberid, f)) for f in roster_fields])
-            out.write(values)
-            out.write('\n')
-            num_rows += 1
-            if num_rows % 100 == 0:
-              print('%d roster records written for %s' % (num_rows, year))
+          dd_output.write_table(out, ROSTER_FIELDS,
+            self.roster_lines(year, course_keys), progress)
 
       user_fields = [ 'employee_id', 'teacher_id', 'school_id', 'school_code', 
         'first_name', 'last_name', 'email_address' ]
       fname =  'users_Kentfield.txt' if self.single_year else ('%susers.txt' % year)
-      num_rows = 0
-      path = os.path.join(self.output_dir, fname)
-      with open(path, 'w') as out:
+      progress = self.metrics.counter('teacher records written for %s' % year)
+      with self.open_output(fname) as out:
         files_written += 1
-        header_fields = '\t'.join(user_fields)
-        out.write(header_fields)
-        out.write('\n')
-        teachers = self.teacher_years[year].keys()
-        for userid in teachers:
-          if self.user(userid, 'school_code') == 0:
-            continue
-          values = '\t'.join([str(self.user(userid, f)) for f in user_fields])
-          out.write(values)
-          out.write('\n')
-          num_rows += 1
-          if num_rows % 100 == 0:
-            print('%d teacher records written for %s' % (num_rows, year))
+        dd_output.write_table(out, user_fields,
+          self.user_lines(year, user_fields), progress)
 
       demo_fields = [ 'ssid', 'student_id', 'school_code', 'first_name', 'last_name', 
         'birthdate', 'gender', 'parent', 'street', 'city', 'state',  'zip', 'phone_number',
@@ -620,73 +1262,191 @@ class DdImporter:
         'gate', 'primary_disability', 'nslp', 'parent_education', 'migrant_ed',
         'date_rfep', 'special_program', 'title_1' ]
       fname =  'demo_Kentfield.txt' if self.single_year else ('%sdemo.txt' % year)
-      num_rows = 0
-      path = os.path.join(self.output_dir, fname)
-      with open(path, 'w') as out:
+      progress = self.metrics.counter('demographic records written for %s' % year)
+      with self.open_output(fname) as out:
         files_written += 1
-        header_fields = '\t'.join(demo_fields)
-        out.write(header_fields)
-        out.write('\n')
-        if self.enrollments[year]:
-          students = self.enrollments[year].keys()
-          for studentid in students:
-            ssid = self.student(studentid, 'ssid')
-            if ssid == '':
-              continue
-            self.set_student(studentid, 'school_id',   self.enrollment(year, studentid, 'school_id'))
-            self.set_student(studentid, 'school_code', self.enrollment(year, studentid, 'school_code'))
-            values = '\t'.join([str(self.student(studentid, f)) for f in demo_fields])
-            out.write(values)
-            out.write('\n')
-            num_rows += 1
-            if num_rows % 100 == 0:
-              print('%d demographic records written for %s' % (num_rows, year))
+        dd_output.write_table(out, demo_fields,
+          self.demo_lines(year, demo_fields), progress)
 
     # note: can we do subject mapping?
     if len(course_keys) != 0:
       course_fields = [ 'course_id', 'abbreviation', 'name',
         'credits', 'subject_code', 'a_to_g', 'school_id', 'school_code' ]
       fname = 'courses_Kentfield.txt'
-      num_rows = 0
-      path = os.path.join(self.output_dir, fname)
-      with open(path, 'w') as out:
+      progress = self.metrics.counter('course records written')
+      with self.open_output(fname) as out:
         files_written += 1
-        header_fields = '\t'.join(course_fields)
-        out.write(header_fields)
-        out.write('\n')
-        for courseid in course_keys:
-          values = '\t'.join([str(self.course(courseid, f)) for f in course_fields])
-          out.write(values)
-          out.write('\n')
-          num_rows += 1
-          if num_rows % 100 == 0:
-            print('%d course records written' % num_rows) 
+        dd_output.write_table(out, course_fields,
+          self.course_lines(course_keys, course_fields), progress)
 
+    if self.analytic_format:
+      # an extra for the data team; the DataDirector files are written
+      # and delivered whether or not it works
+      try:
+        with self.metrics.stage('analytic'):
+          self.write_analytic_export(years, roster_years, course_keys)
+      except Exception as e:
+        print('Analytic export failed: %s' % e)
+
+    if self.roster_spool is not None:
+      self.roster_spool.close()
+    if self.store is not None:
+      self.store.close()
     return files_written != 0
 
 
+  def write_analytic_export(self, years, roster_years, course_keys):
+    # the years and courses of the output files, from the same store
+    export = dd_analytic.open_export(self.analytic_format, self.analytic_dir)
+    try:
+      for year in years:
+        export.write('students', year, self.analytic_student_rows(year))
+        if year in roster_years:
+          export.write('rosters', year, self.roster_values(year))
+        export.write('users', year, self.analytic_user_rows(year))
+      export.write('courses', None, self.analytic_course_rows(course_keys))
+    except Exception:
+      export.discard()
+      raise
+    export.close()
+
+
+  def analytic_student_rows(self, year):
+    student_fields = dd_output.fields_getter(dd_analytic.names(dd_analytic.STUDENT_COLUMNS))
+    for studentid, enrollment in self.enrollments[year].items():
+      student = self.students.get(studentid)
+      if student is None or student.ssid == '':
+        continue
+      yield (enrollment.school_id, enrollment.school_code,
+        enrollment.grade_level) + student_fields(student)
+
+
+  def analytic_user_rows(self, year):
+    user_fields = dd_output.fields_getter(dd_analytic.names(dd_analytic.USER_COLUMNS))
+    for userid in self.teacher_years[year].keys():
+      user = self.users.get(userid)
+      if user is not None and user.school_code != 0:
+        yield user_fields(user)
+
+
+  def analytic_course_rows(self, course_keys):
+    course_fields = dd_output.fields_getter(dd_analytic.names(dd_analytic.COURSE_COLUMNS))
+    for courseid in course_keys:
+      course = self.courses.get(courseid)
+      if course is not None:
+        yield course_fields(course)
+
+
+  def roster_years(self):
+    if self.roster_spool is not None:
+      return self.roster_spool.years()
+    return sorted(self.rosters.keys())
+
+
+  def roster_rows(self, year):
+    # (course_id, output line) for each roster in memberid order
+    if self.roster_spool is not None:
+      for row in self.roster_spool.rows(year):
+        yield row
+      return
+    roster_fields = dd_output.fields_getter(ROSTER_FIELDS)
+    for memberid, roster in dd_store.sorted_items(self.rosters[year]):
+      yield roster.course_id, '\t'.join(map(str, roster_fields(roster)))
+
+
+  def roster_values(self, year):
+    # the ROSTER_FIELDS of each roster in memberid order
+    if self.roster_spool is not None:
+      for courseid, values in self.roster_spool.rows(year):
+        yield values.split('\t')
+      return
+    roster_fields = dd_output.fields_getter(ROSTER_FIELDS)
+    for memberid, roster in dd_store.sorted_items(self.rosters[year]):
+      yield roster_fields(roster)
+
+
+  def roster_lines(self, year, course_keys):
+    # marks the courses rostered in year
+    for courseid, values in self.roster_rows(year):
+      course_keys[courseid] = 1
+      yield values + '\n'
+
+
+  def user_lines(self, year, fields):
+    user_fields = dd_output.fields_getter(fields)
+    missing = dd_output.empty_row(fields)
+    for userid in self.teacher_years[year].keys():
+      user = self.users.get(userid)
+      if user is None:
+        yield missing
+      elif user.school_code != 0:
+        yield dd_output.format_row(user_fields(user))
+
+
+  def demo_lines(self, year, fields):
+    # students with an ssid enrolled in year, with the school of that
+    # year's enrollment
+    enrollments = self.enrollments[year]
+    if not enrollments:
+      return
+    school_code = fields.index('school_code')
+    student_fields = dd_output.fields_getter(fields)
+    for studentid, enrollment in enrollments.items():
+      student = self.students.get(studentid)
+      if student is None or student.ssid == '':
+        continue
+      values = list(student_fields(student))
+      values[school_code] = enrollment.school_code
+      yield dd_output.format_row(values)
+
+
+  def course_lines(self, course_keys, fields):
+    course_fields = dd_output.fields_getter(fields)
+    missing = dd_output.empty_row(fields)
+    for courseid in course_keys:
+      course = self.courses.get(courseid)
+      if course is None:
+        yield missing
+      else:
+        yield dd_output.format_row(course_fields(course))
+
+
+  def new_store(self, row_bytes):
+    # a dict, or with memory_budget_mb a SpillDict; row_bytes is a rough
+    # cost of one entry, counted against the budget
+    if self.store is None:
+      return { }
+    return self.store.new_dict(row_bytes)
+
+
   def set_course(self, courseid, key, value):
-    if not courseid in self.courses:
-      self.courses[courseid] = { }
-    self.courses[courseid][key] = value
+    course = self.courses.get(courseid)
+    if course is None:
+      course = Course()
+    course.set(key, value)
+    self.courses[intern(courseid)] = course
 
 
   def course(self, courseid, key):
-    if not courseid in self.courses:
+    course = self.courses.get(courseid)
+    if course is None:
       return ''
-    return self.courses[courseid].get(key, '')
+    return course.get(key)
 
 
   def set_user(self, userid, key, value):
-    if not userid in self.users:
-      self.users[userid] = { }
-    self.users[userid][key] = value
+    user = self.users.get(userid)
+    if user is None:
+      user = User()
+    user.set(key, value)
+    self.users[intern(userid)] = user
 
 
   def user(self, userid, key):
-    if not userid in self.users:
+    user = self.users.get(userid)
+    if user is None:
       return ''
-    return self.users[userid].get(key, '')
+    return user.get(key)
 
 
   def current_student(self, studentid):
@@ -694,182 +1454,512 @@ class DdImporter:
 
 
   def set_student(self, studentid, key, value):
-    if not studentid in self.students:
-      self.students[studentid] = { }
-    self.students[studentid][key] = value
+    student = self.students.get(studentid)
+    if student is None:
+      student = Student()
+    student.set(key, value)
+    self.students[intern(studentid)] = student
 
 
   def student(self, studentid, key):
-    if not studentid in self.students:
+    student = self.students.get(studentid)
+    if student is None:
       return ''
-    return self.students[studentid].get(key, '')
+    return student.get(key)
 
 
   def set_enrollment(self, year, studentid, key, value):
     if not year in self.enrollments:
-      self.enrollments[year] = { }
-    if not studentid in self.enrollments[year]:
-      self.enrollments[year][studentid] = { }
-    self.enrollments[year][studentid][key] = value
+      self.enrollments[year] = self.new_store(150)
+    enrollment = self.enrollments[year].get(studentid)
+    if enrollment is None:
+      enrollment = Enrollment()
+    enrollment.set(key, value)
+    self.enrollments[year][intern(studentid)] = enrollment
+
+
+  def set_enrollment_years(self, years, studentid, enrollment):
+    # one enrollment record is shared by every year it applies to
+    studentid = intern(studentid)
+    for year in years:
+      if not year in self.enrollments:
+        self.enrollments[year] = self.new_store(150)
+      self.enrollments[year][studentid] = enrollment
+
 
   def enrollment(self, year, studentid, key):
-    if not year in self.enrollments:
+    enrollment = self.enrollments.get(year, { }).get(studentid)
+    if enrollment is None:
       return ''
-    if not studentid in self.enrollments[year]:
-      return ''
-    return self.enrollments[year][studentid].get(key, '')
+    return enrollment.get(key)
 
 
   def set_teacher_year(self, year, userid, key, value):
     if not year in self.teacher_years:
-      self.teacher_years[year] = { }
-    if not userid in self.teacher_years[year]:
-      self.teacher_years[year][userid] = { }
-    self.teacher_years[year][userid][key] = value
+      self.teacher_years[year] = self.new_store(100)
+    teacher_year = self.teacher_years[year].get(userid)
+    if teacher_year is None:
+      teacher_year = TeacherYear()
+    teacher_year.set(key, value)
+    self.teacher_years[year][intern(userid)] = teacher_year
 
 
   def teacher_year(self, year, userid, key):
-    if not year in self.teacher_years:
+    teacher_year = self.teacher_years.get(year, { }).get(userid)
+    if teacher_year is None:
       return ''
-    if not userid in self.teacher_years[year]:
-      return ''
-    return self.teacher_years[year][userid].get(key, '')
+    return teacher_year.get(key)
+
+
+  def add_roster(self, year, memberid, roster):
+    if self.roster_spool is not None:
+      values = '\t'.join([str(v) for v in roster.values(ROSTER_FIELDS)])
+      self.roster_spool.add(year, memberid, roster.course_id, values)
+      return
+    if not year in self.rosters:
+      self.rosters[year] = self.new_store(300)
+    self.rosters[year][memberid] = roster
 
 
   def set_roster(self, year, memberid, key, value):
     if not year in self.rosters:
-      self.rosters[year] = { }
-    if not memberid in self.rosters[year]:
-      self.rosters[year][memberid] = { }
-    self.rosters[year][memberid][key] = value
+      self.rosters[year] = self.new_store(300)
+    roster = self.rosters[year].get(memberid)
+    if roster is None:
+      roster = Roster()
+    roster.set(key, value)
+    self.rosters[year][memberid] = roster
 
 
   def roster(self, year, memberid, key):
-    if not year in self.rosters:
+    roster = self.rosters.get(year, { }).get(memberid)
+    if roster is None:
       return ''
-    if not memberid in self.rosters[year]:
-      return ''
-    return self.rosters[year][memberid].get(key, '')
+    return roster.get(key)
+
+
+  def analyze_sources_in_parallel(self, years):
+    # courses, teachers and students don't depend on each other, so each
+    # is parsed in its own worker and the partial stores merged back here
+    settings = {
+      'input_dir':        self.input_dir,
+      'single_school':    self.single_school,
+      'use_race_file':    self.use_race_file,
+      'use_program_file': self.use_program_file
+    }
+    jobs = [ (source, years, settings) for source in ['courses', 'users', 'students'] ]
+    pool = multiprocessing.Pool(min(self.analysis_workers, len(jobs)))
+    try:
+      parts = pool.map(analyze_source, jobs)
+    finally:
+      pool.close()
+      pool.join()
+    for part in parts:
+      self.merge_store(part)
+
+
+  def analyzed_state(self):
+    return {
+      'courses':            self.courses,
+      'users':              self.users,
+      'students':           self.students,
+      'enrollments':        self.enrollments,
+      'teacher_years':      self.teacher_years,
+      'rosters':            self.rosters,
+      'roster_activations': self.roster_activations
+    }
+
+
+  def merge_store(self, part):
+    for key, row in part.get('roster_activations', { }).items():
+      if not key in self.roster_activations or row < self.roster_activations[key]:
+        self.roster_activations[key] = row
+    self.courses.update(part.get('courses', { }))
+    self.users.update(part.get('users', { }))
+    self.students.update(part.get('students', { }))
+    for name in ['enrollments', 'teacher_years', 'rosters']:
+      store = getattr(self, name)
+      for year, records in part.get(name, { }).items():
+        if not year in store:
+          store[year] = { }
+        store[year].update(records)
 
 
   def process_for_single_year(self):
-    print('Analyzing course data')
-    self.analyze_course_data()
-    print('Analyzing teacher data - single year')
-    self.analyze_user_data(self.single_year)
-    print('Analyzing student demographic data - single year')
-    self.analyze_student_data(self.single_year)
+    if self.analysis_workers > 1:
+      print('Analyzing course, teacher and student data in parallel - single year')
+      with self.metrics.stage('sources'):
+        self.analyze_sources_in_parallel([ self.single_year ])
+      self.prefetch_rosters()
+    else:
+      self.prefetch_rosters()
+      print('Analyzing course data')
+      with self.metrics.stage('courses'):
+        self.analyze_course_data()
+      print('Analyzing teacher data - single year')
+      with self.metrics.stage('teachers'):
+        self.analyze_user_data([ self.single_year ])
+      print('Analyzing student demographic data - single year')
+      with self.metrics.stage('students'):
+        self.analyze_student_data([ self.single_year ])
     if self.use_race_file:
       print('Analyzing student race data')
-      self.analyze_race_data()
+      with self.metrics.stage('races'):
+        self.analyze_race_data()
     if self.use_program_file:
       print('Analyzing student program data')
-      self.analyze_program_data()
+      with self.metrics.stage('programs'):
+        self.analyze_program_data()
     print('Analyzing roster data')
-    self.analyze_roster_data()
+    with self.metrics.stage('rosters'):
+      self.analyze_roster_data()
+
+
+  def watch_stages(self):
+    # (stage, source paths function, stages it needs first, analyze) for
+    # the stages process_for_single_year or process_for_all_years runs
+    years = [ self.single_year ] if self.single_year else VALID_YEARS
+    input_path = lambda fname: lambda: [ os.path.join(self.input_dir, fname) ]
+    stages = [
+      ('courses', lambda: self.source_paths(self.reference_dir, 'courses'), [ ],
+        self.analyze_course_data),
+      ('teachers', lambda: [ os.path.join(self.reference_dir, 'dd-teachers.txt') ], [ ],
+        lambda: self.analyze_user_data(years)),
+      ('students', input_path('dd-students.txt'), [ ],
+        lambda: self.analyze_student_data(years)) ]
+    if self.single_year and self.use_race_file:
+      stages.append(('races', input_path('dd-races.txt'), [ 'students' ],
+        self.analyze_race_data))
+    if self.single_year and self.use_program_file:
+      stages.append(('programs', input_path('dd-programs.txt'), [ 'students' ],
+        self.analyze_program_data))
+    stages.append(('rosters', lambda: self.source_paths(self.input_dir, 'rosters'),
+      [ 'teachers', 'students' ], self.analyze_roster_data))
+    return stages
+
+
+  def watch_run(self, previous):
+    # Analyzes each source as soon as its files are complete and differ
+    # from previous, the (size, mtime) of the files the last delivered
+    # run read, then writes and delivers the export once every source is
+    # in.  Returns the files this run read, or previous again when one of
+    # them changed before the export was written and the run was dropped.
+    if self.input_source == 'db' or self.shard_by_school:
+      raise Exception('--watch reads the dd-*.txt files without shard_by_school')
+    print('Watching %s for source files' % self.input_dir)
+    watcher = dd_watch.SourceWatcher(self.watch_settle_seconds)
+    stages = self.watch_stages()
+    done = [ ]
+    try:
+      with self.metrics.stage('analyze'):
+        while len(done) < len(stages):
+          for name, paths, needs, analyze in stages:
+            if name in done or [ need for need in needs if not need in done ]:
+              continue
+            current = paths()
+            signatures = watcher.complete(current)
+            if not current or signatures is None:
+              continue
+            if [ path for path in current if previous.get(path) == signatures[path] ]:
+              # still the last run's file
+              continue
+            print('Analyzing %s data' % name)
+            with self.metrics.stage(name):
+              analyze()
+            self.watched.update(signatures)
+            done.append(name)
+          if len(done) < len(stages):
+            time.sleep(self.watch_interval)
+        self.report_normalization_stats()
+
+      changed = watcher.changed(self.watched)
+      if changed:
+        print('%s changed after it was analyzed; starting over' % ', '.join(changed))
+        return previous
+      self.deliver_export(self.open_checkpoints())
+    finally:
+      self.save_metrics()
+    return dict(self.watched)
 
 
   def process_for_all_years(self):
-    print('Analyzing course data')
-    self.analyze_course_data()
-    for year in VALID_YEARS:
-      print('Analyzing teacher data for #{year}')
-      self.analyze_user_data(year)
-      print('Analyzing student demographic data for #{year}')
-      self.analyze_student_data(year)
+    # each source file is read once; every valid year is assigned in that pass
+    if self.analysis_workers > 1:
+      print('Analyzing course, teacher and student data in parallel for all years')
+      with self.metrics.stage('sources'):
+        self.analyze_sources_in_parallel(VALID_YEARS)
+      self.prefetch_rosters()
+    else:
+      self.prefetch_rosters()
+      print('Analyzing course data')
+      with self.metrics.stage('courses'):
+        self.analyze_course_data()
+      print('Analyzing teacher data for all years')
+      with self.metrics.stage('teachers'):
+        self.analyze_user_data(VALID_YEARS)
+      print('Analyzing student demographic data for all years')
+      with self.metrics.stage('students'):
+        self.analyze_student_data(VALID_YEARS)
     print('Analyzing roster data')
-    self.analyze_roster_data()
+    with self.metrics.stage('rosters'):
+      self.analyze_roster_data()
+
+
+  def partition_sources(self):
+    # One pass over the source files: students are split by schoolid and
+    # every roster, race and program row follows its student to that
+    # school's shard.  Roster rows also carry their district-wide row
+    # number in a dd_row column.  Returns each student's school and
+    # position in dd-students.txt.
+    owners = { }
+    positions = { }
+    shard_files = { }
+
+    def shard_file(schoolid, fname, headers):
+      key = (schoolid, fname)
+      if not key in shard_files:
+        input_dir = os.path.join(self.shard_dir, str(schoolid), 'input')
+        if not os.path.isdir(input_dir):
+          os.makedirs(input_dir)
+        out = open(os.path.join(input_dir, fname), 'w')
+        out.write('\t'.join(headers))
+        out.write('\n')
+        shard_files[key] = out
+      return shard_files[key]
 
+    try:
+      path = os.path.join(self.input_dir, 'dd-students.txt')
+      with open(path, 'r') as f:
+        headers, lines = self.open_tsv(f, STUDENTS_HEADERS)
+        project, width = self.column_projection(headers, [ 'id', 'schoolid' ])
+        for line in lines:
+          fields = line.rstrip('\r\n').split('\t')
+          if fields == [ '' ]:
+            continue
+          fields.extend([ '' ] * (width - len(fields)))
+          studentid, schoolid = project(fields)
+          schoolid = int(schoolid)
+          if self.single_school and schoolid != self.single_school:
+            continue
+          if not studentid in owners:
+            owners[studentid] = schoolid
+            positions[studentid] = len(positions)
+          # a repeated id stays with the shard that saw it first
+          out = shard_file(owners[studentid], 'dd-students.txt', headers)
+          out.write(line.rstrip('\r\n'))
+          out.write('\n')
 
-  def process_files(self):
-    if not self.single_year:
-      self.process_for_all_years()
+      sources = [ ('dd-rosters-all.txt', STUDENT_SCHEDULES_HEADERS, 'studentid',
+        self.source_paths(self.input_dir, 'rosters')) ]
+      if self.use_race_file:
+        sources.append(('dd-races.txt', None, 'studentid',
+          [ os.path.join(self.input_dir, 'dd-races.txt') ]))
+      if self.use_program_file:
+        sources.append(('dd-programs.txt', None, 'foreignkey',
+          [ os.path.join(self.input_dir, 'dd-programs.txt') ]))
+      for fname, hdr_check, key_column, paths in sources:
+        dd_row = 0
+        for path in paths:
+          with open(path, 'r') as f:
+            headers, lines = self.open_tsv(f, hdr_check)
+            width = len(headers)
+            key_index = headers.index(key_column)
+            if fname == 'dd-rosters-all.txt':
+              headers = headers + [ 'dd_row' ]
+            for line in lines:
+              fields = line.rstrip('\r\n').split('\t')
+              if fields == [ '' ]:
+                continue
+              fields = fields[:width] + [ '' ] * (width - len(fields))
+              dd_row += 1
+              schoolid = owners.get(fields[key_index])
+              if schoolid is None:
+                continue
+              if fname == 'dd-rosters-all.txt':
+                fields.append(str(dd_row))
+              out = shard_file(schoolid, fname, headers)
+              out.write('\t'.join(fields))
+              out.write('\n')
+    finally:
+      for out in shard_files.values():
+        out.close()
+
+    return owners, positions
+
+
+  def shard_settings(self, schoolid):
+    school_dir = os.path.join(self.shard_dir, str(schoolid))
+    return {
+      'input_dir':          os.path.join(school_dir, 'input'),
+      'reference_dir':      self.input_dir,
+      'output_dir':         os.path.join(school_dir, 'datafiles'),
+      'single_school':      schoolid,
+      'use_race_file':      self.use_race_file,
+      'use_program_file':   self.use_program_file,
+      'shard_by_school':    False,
+      'analysis_workers':   1,
+      'roster_parse_workers': 1,
+      'roster_sort_budget': None,
+      # written once, by the district merge
+      'analytic_format':    None
+    }
+
+
+  def process_by_school(self):
+    print('Partitioning source files by school')
+    with self.metrics.stage('partition'):
+      owners, positions = self.partition_sources()
+    schools = sorted(set(owners.values()))
+    if self.rerun_school:
+      if not self.rerun_school in schools:
+        raise Exception('school %d has no students in dd-students.txt; schools are %s' %
+          (self.rerun_school, ', '.join([ str(schoolid) for schoolid in schools ])))
+      # the other shards keep the state saved by their last run, if they
+      # have one
+      run_schools = [ schoolid for schoolid in schools if schoolid == self.rerun_school or
+        not os.path.exists(self.shard_state_path(schoolid)) ]
+      if len(run_schools) > 1:
+        print('No saved state for schools %s; analyzing them too' %
+          ', '.join([ str(schoolid) for schoolid in run_schools if schoolid != self.rerun_school ]))
     else:
-      self.process_for_single_year()
+      run_schools = schools
+    jobs = [ (schoolid, self.shard_settings(schoolid)) for schoolid in run_schools ]
+    print('Analyzing %d school shards' % len(jobs))
+    with self.metrics.stage('shards'):
+      pool = multiprocessing.Pool(self.shard_workers)
+      try:
+        pool.map(process_shard, jobs)
+      finally:
+        pool.close()
+        pool.join()
+
+    print('Merging school shards')
+    with self.metrics.stage('merge'):
+      stale = set()
+      for schoolid in schools:
+        with open(self.shard_state_path(schoolid), 'rb') as f:
+          part = pickle.load(f)
+        stale.update(drop_moved_students(part, schoolid, owners))
+        self.merge_store(part)
+      if stale:
+        print('Dropped %d students no longer in this school in dd-students.txt from saved shard state: %s' %
+          (len(stale), ', '.join(sorted(stale)[:10]) + (' ...' if len(stale) > 10 else '')))
+      self.restore_district_order(positions)
+
+
+  def shard_state_path(self, schoolid):
+    return os.path.join(self.shard_dir, str(schoolid), 'state.pickle')
+
+
+  def restore_district_order(self, positions):
+    # Put enrollments back in dd-students.txt order, and teacher-years in
+    # serial activation order: teachers active from dd-teachers.txt first,
+    # then roster-activated teachers by the district roster row that first
+    # activated them.
+    for year in self.enrollments:
+      enrollments = self.enrollments[year]
+      studentids = sorted(enrollments.keys(), key=lambda studentid: positions[studentid])
+      self.enrollments[year] = dict([ (studentid, enrollments[studentid]) for studentid in studentids ])
+    for year in self.teacher_years:
+      teachers = self.teacher_years[year]
+      by_status = [ userid for userid in teachers if not (year, userid) in self.roster_activations ]
+      by_roster = sorted([ userid for userid in teachers if (year, userid) in self.roster_activations ],
+        key=lambda userid: self.roster_activations[(year, userid)])
+      self.teacher_years[year] = dict([ (userid, teachers[userid]) for userid in by_status + by_roster ])
+
+
+  def load_or_process_files(self):
+    # spooled rosters and spilled stores live in temp files, not in the
+    # analyzed state, and query results have no files to fingerprint
+    if (not self.input_cache_bytes or self.roster_sort_budget or self.rerun_school or
+        self.input_source == 'db' or self.store is not None):
+      self.process_files()
+      return
+
+    cache = dd_cache.InputCache(self.cache_dir, self.input_cache_bytes)
+    key = cache.key(self.input_files(), self.cache_settings())
+    state = cache.load(key)
+    if state is not None:
+      print('Inputs unchanged; using cached analysis')
+      self.restore_state(state)
+      return
+    self.process_files()
+    print('Caching analyzed inputs')
+    cache.store(key, self.analyzed_state())
+
 
+  def input_files(self):
+    return list(set(glob.glob(os.path.join(self.input_dir, 'dd-*.txt')) +
+      glob.glob(os.path.join(self.reference_dir, 'dd-*.txt'))))
+
+
+  def cache_settings(self):
+    # everything besides the input files that changes the analyzed state;
+    # the code is every dd_*.py module, since parsing, normalization and
+    # filtering are spread across them
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    code = [ (os.path.basename(path), dd_cache.file_hash(path))
+      for path in sorted(glob.glob(os.path.join(code_dir, 'dd_*.py'))) ]
+    return {
+      'code':             code,
+      'today':            self.today.isoformat(),
+      'single_year':      self.single_year,
+      'single_school':    self.single_school,
+      'use_race_file':    self.use_race_file,
+      'use_program_file': self.use_program_file,
+      'valid_years':      VALID_YEARS,
+      'excluded_courses': EXCLUDED_COURSES,
+      'co_teachers':      CO_TEACHERS
+    }
+
+
+  def restore_state(self, state):
+    for name, value in state.items():
+      setattr(self, name, value)
+
+
+  def process_files(self):
+    try:
+      if self.shard_by_school:
+        self.process_by_school()
+      elif not self.single_year:
+        self.process_for_all_years()
+      else:
+        self.process_for_single_year()
+    finally:
+      self.close_sources()
+    self.report_normalization_stats()
+
+
+  # value normalization lives in dd_normalize, where it is memoized
 
   def expression_to_period(self, expr):
-    if expr == '':
-      return ''
-    period = int(re.sub(r'[^0-9].*$', '', expr))
-    if period == 0:
-      return ''
-    # DD only allows 9 periods
-    if period > 9:
-      period = 9
-    return period
+    return dd_normalize.expression_to_period(expr)
 
 
   def term_abbreviation(self, term_abbr):
+    # a single dict lookup already, so not worth memoizing
     return TERM_ABBRS.get(term_abbr, term_abbr)
 
 
   def course_abbreviation(self, name):
-    words = name.split()
-    first_word = words[0].upper()
-    abbr = re.sub(r'[^A-Z]', '', first_word)[:4]
-    suffix = ''
-    if len(words) > 1:
-      last_word = words[-1].upper()
-      try:
-        if re.match(r'K|TK|[1-8]', last_word):
-          suffix = last_word
-      finally:
-        pass
-    return abbr + suffix
+    return dd_normalize.course_abbreviation(name)
 
 
   def split_date(self, raw_date):
-    mo = None
-    da = None
-    yr = None
-    if raw_date != '':
-      datestr = re.sub(r'-', '/', raw_date).strip()
-      m = re.match(r'(\d+)\/(\d+)\/(\d+)(\s|$)', datestr)
-      if m:
-        mo = int(m.group(1))
-        da = int(m.group(2))
-        yr = int(m.group(3))
-      else:
-        m = re.match(r'(\d+)\/(\d+)(\s|$)', datestr)
-        if m:
-          mo = int(m.group(1))
-          da = 1
-          yr = int(m.group(2))
-      if mo and da and yr:
-        if yr < 20:
-          yr += 2000
-        elif yr < 100:
-          yr += 1900
-        if mo < 1 or mo > 12 or da < 1 or da > 31 or yr < 1900 or yr > 2020:
-          mo = None
-          da = None
-          yr = None
-    return (mo, da, yr)
+    return dd_normalize.split_date(raw_date)
 
 
   def clean_date(self, raw_date):
-    mo, da, yr = self.split_date(raw_date)
-    if mo:
-      return '%02d/%02d/%04d' % (mo, da, yr)
-    return ''
+    return dd_normalize.clean_date(raw_date)
 
 
   def parse_date(self, raw_date):
-    mo, da, yr = self.split_date(raw_date)
-    if mo:
-      return date(yr, mo, da)
-    return None
+    return dd_normalize.parse_date(raw_date)
 
 
   def date_to_year_abbr(self, entrydate):
-    entrydate = self.parse_date(entrydate)
-    if not entrydate:
-      raise Exception('can\'t parse date %s' % entrydate)
-    year_number = entrydate.year - 1991
-    if entrydate.month >= 7:
-      year_number += 1
-    return self.year_number_to_year_abbr(year_number)
+    return dd_normalize.date_to_year_abbr(entrydate)
 
 
   def year_abbr_to_term(self, year):
@@ -877,12 +1967,192 @@ class DdImporter:
 
 
   def year_number_to_year_abbr(self, year_number):
-    return '%02d-%02d' % (((year_number + 90) % 100, (year_number + 91) % 100))
+    return dd_normalize.year_number_to_year_abbr(year_number)
 
 
   def term_to_year_abbr(self, termid):
-    return self.year_number_to_year_abbr(int(termid) / 100)
+    return dd_normalize.term_to_year_abbr(termid)
+
+
+  def report_normalization_stats(self):
+    for name, hits, misses, rate, entries in dd_normalize.cache_stats():
+      print('%s: %d hits, %d misses (%.1f%% hit rate), %d cached' % (
+        name, hits, misses, rate * 100, entries))
+
+
+def decode_text(data):
+  # bytes read from a source file, as open(path, 'r') would read them
+  if isinstance(data, str):
+    return data # python 2
+  return data.decode(locale.getpreferredencoding(False))
+
+
+def filter_rosters(rows, filters, students=None):
+  # Drops the rows, already through the raw-field filters, without a
+  # known period or term, and replaces the expression and term
+  # abbreviation with the period and term.  Rows read before the
+  # students were analyzed are checked against students here.  Runs in
+  # the roster parse workers as well.
+  expression_to_period = dd_normalize.expression_to_period
+  term_abbreviation = TERM_ABBRS.get
+  for (studentid, userid, schoolid, termid, school_code, expression,
+      term_abbr, courseid, sectionid, dd_row) in rows:
+    if students is not None and not studentid in students:
+      filters.count('not a current student')
+      continue
+
+    period = expression_to_period(expression)
+    if period == '':
+      filters.count('no period')
+      continue
+
+    term = term_abbreviation(term_abbr, term_abbr)
+    if term == '':
+      filters.count('no term')
+      continue
+
+    yield (studentid, userid, schoolid, termid, school_code, period, term,
+      courseid, sectionid, dd_row)
+
+
+# the roster filters of a roster parse worker process
+worker_filters = None
+
+
+def init_roster_worker(filters):
+  global worker_filters
+  worker_filters = filters
+
+
+def parse_roster_chunk(job):
+  # runs in a worker process: split, project and filter the roster rows
+  # between start and end, a newline-aligned part of the mapped file;
+  # returns the rows that pass and the rejection counts
+  path, start, end, headers = job
+  with open(path, 'rb') as f:
+    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      data = decode_text(m[start:end])
+    finally:
+      m.close()
+  filters = worker_filters
+  filters.rejected = { }
+  index = dict([ (h, i) for i, h in enumerate(headers) ])
+  indexes = [ index.get(c, len(headers)) for c in ROSTER_COLUMNS ]
+  project = operator.itemgetter(*indexes)
+  check, filter_width = filters.bind(headers)
+  width = max(max(indexes) + 1, filter_width)
+
+  def rows():
+    for line in data.split('\n'):
+      line = line.rstrip('\r')
+      if line == '':
+        continue
+      fields = line.split('\t')
+      if len(fields) < width:
+        fields.extend([ '' ] * (width - len(fields)))
+      if check(fields):
+        yield project(fields)
+  return list(filter_rosters(rows(), filters)), filters.rejected
+
+
+def analyze_source(job):
+  # runs in a worker process: analyze one source file into a fresh
+  # importer and return the part of the store it filled in
+  source, years, settings = job
+  importer = DdImporter()
+  for name, value in settings.items():
+    setattr(importer, name, value)
+  try:
+    if source == 'courses':
+      importer.analyze_course_data()
+      return { 'courses': importer.courses }
+    if source == 'users':
+      importer.analyze_user_data(years)
+      return { 'users': importer.users, 'teacher_years': importer.teacher_years }
+    if source == 'students':
+      importer.analyze_student_data(years)
+      return { 'students': importer.students, 'enrollments': importer.enrollments }
+    raise Exception('unknown source %s' % source)
+  finally:
+    # with input_source 'db' each worker has its own connection
+    importer.close_sources()
+
+
+def parse_program_code(value):
+  # a program code as analyze_program_data reads it, e.g. 122 for '0122'
+  # or ' 122'; None if it isn't a number
+  try:
+    return int(value)
+  except ValueError:
+    return None
+
+
+def drop_moved_students(part, schoolid, owners):
+  # A --school re-run merges the other shards' saved state, which can hold
+  # students since removed from dd-students.txt or moved to another school.
+  # Drops their students, enrollments and rosters from a shard's state and
+  # returns their ids.
+  stale = set([ studentid for studentid in part.get('students', { })
+    if owners.get(studentid) != schoolid ])
+  if not stale:
+    return stale
+  part['students'] = dict([ (studentid, student)
+    for studentid, student in part['students'].items() if not studentid in stale ])
+  for year, enrollments in part.get('enrollments', { }).items():
+    part['enrollments'][year] = dict([ (studentid, enrollment)
+      for studentid, enrollment in enrollments.items() if not studentid in stale ])
+  for year, rosters in part.get('rosters', { }).items():
+    # memberids are courseid-studentid, with a co-teacher id after that
+    part['rosters'][year] = dict([ (memberid, roster)
+      for memberid, roster in rosters.items()
+      if not memberid[len(roster.course_id) + 1:].split('-')[0] in stale ])
+  return stale
+
+
+def process_shard(job):
+  # runs in a worker process: analyze and write one school's shard, then
+  # save its analyzed state for the district merge
+  schoolid, settings = job
+  importer = DdImporter()
+  for name, value in settings.items():
+    setattr(importer, name, value)
+  print('Processing shard for school %d' % schoolid)
+  importer.process_files()
+  importer.output_files()
+  with open(importer.shard_state_path(schoolid), 'wb') as f:
+    pickle.dump(importer.analyzed_state(), f, pickle.HIGHEST_PROTOCOL)
 
 
 if __name__ == '__main__':
-  DdImporter().perform()
+  parser = argparse.ArgumentParser(description='DataDirector import file generator')
+  parser.add_argument('--school', type=int,
+    help='with shard_by_school, re-run only this school and re-merge the district files')
+  parser.add_argument('--watch', action='store_true',
+    help='keep running, analyzing each source file as soon as it is complete')
+  parser.add_argument('--resume', action='store_true',
+    help='pick up a failed run at its first unfinished stage')
+  args = parser.parse_args()
+  if args.school is not None and args.watch:
+    raise Exception('--school re-runs one shard of a finished run; it can\'t be used with --watch')
+
+  if args.watch:
+    # each run starts from a fresh importer, so 'auto' years and dated
+    # archive directories follow the calendar
+    previous = { }
+    while True:
+      importer = DdImporter()
+      try:
+        previous = importer.watch_run(previous)
+      except Exception:
+        traceback.print_exc()
+        # wait for a new copy of whatever failed
+        previous.update(importer.watched)
+        time.sleep(importer.watch_interval)
+  else:
+    importer = DdImporter()
+    if args.school is not None and not importer.shard_by_school:
+      raise Exception('--school re-runs one school\'s shard; it needs shard_by_school')
+    importer.rerun_school = args.school
+    importer.resume = args.resume
+    importer.perform()
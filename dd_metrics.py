@@ -0,0 +1,258 @@
+# Run metrics for the importer: stage timers, row counters and memory.
+#
+# Stages nest ('analyze.rosters' runs inside 'analyze') and each records
+# its wall time, the rows counted while it was innermost, and the peak
+# RSS sampled while it ran.  Counters replace per-N-rows progress prints
+# with one line every progress_interval seconds.  Any stage can be run
+# under cProfile or tracemalloc, with the results written to a profile
+# directory.  write() saves everything as JSON for comparing runs.
+
+from __future__ import print_function
+
+import json
+import os
+import platform
+import sys
+import threading
+import time
+
+try:
+  import resource
+except ImportError:
+  resource = None # windows
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None # python 2
+
+try:
+  import psutil
+except ImportError:
+  psutil = None
+
+# rows between clock reads in Counter.tick
+CHECK_EVERY = 256
+
+
+def current_rss():
+  # resident set size in bytes, or None when there's no way to tell
+  if psutil is not None:
+    return psutil.Process().memory_info().rss
+  try:
+    with open('/proc/self/statm', 'r') as f:
+      return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+  except (IOError, OSError, ValueError, AttributeError):
+    return None
+
+
+def peak_rss():
+  # high-water RSS of the whole process in bytes, where the OS reports it
+  if resource is None:
+    return None
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def megabytes(n):
+  return round(n / (1024.0 * 1024.0), 1) if n is not None else None
+
+
+class Counter(object):
+  # counts rows and prints '<n> <label>' at most once per interval
+  def __init__(self, label, interval):
+    self.label = label
+    self.interval = interval
+    self.count = 0
+    self.next_check = CHECK_EVERY
+    self.last_report = time.time()
+
+  def tick(self, n=1):
+    self.count += n
+    if self.count >= self.next_check:
+      self.next_check = self.count + CHECK_EVERY
+      now = time.time()
+      if now - self.last_report >= self.interval:
+        self.last_report = now
+        print('%d %s' % (self.count, self.label))
+
+  def report(self):
+    print('%d %s' % (self.count, self.label))
+
+
+class Stage(object):
+  def __init__(self, metrics, name):
+    self.metrics = metrics
+    self.name = name
+    self.started = None
+    self.seconds = None
+    self.counters = [ ]
+    self.peak_rss = None
+    self.traced_peak = None
+    self.profiler = None
+    self.tracing = False
+
+  def rows(self):
+    if not self.counters:
+      return None
+    return sum([ c.count for c in self.counters ])
+
+  def sample(self, rss):
+    if rss is not None and (self.peak_rss is None or rss > self.peak_rss):
+      self.peak_rss = rss
+
+  def __enter__(self):
+    self.metrics.enter(self)
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.metrics.exit(self)
+
+  def as_dict(self):
+    rows = self.rows()
+    return {
+      'name': self.name,
+      'seconds': round(self.seconds, 3) if self.seconds is not None else None,
+      'rows': rows,
+      'rows_per_sec': int(rows / self.seconds) if rows and self.seconds else None,
+      'peak_rss_mb': megabytes(self.peak_rss),
+      'traced_peak_mb': megabytes(self.traced_peak)
+    }
+
+
+class Metrics(object):
+  def __init__(self, progress_interval=5, profile_stages=None,
+      trace_memory_stages=None, profile_dir=None, sample_interval=0.25):
+    self.progress_interval = progress_interval
+    self.profile_stages = profile_stages or [ ]
+    self.trace_memory_stages = trace_memory_stages or [ ]
+    self.profile_dir = profile_dir
+    self.sample_interval = sample_interval
+    self.started = time.time()
+    self.stages = [ ]
+    self.active = [ ]
+    self.lock = threading.Lock()
+    self.sampler = None
+
+  def stage(self, name):
+    if self.active:
+      name = '%s.%s' % (self.active[-1].name, name)
+    return Stage(self, name)
+
+  def counter(self, label):
+    # rows ticked on the counter are credited to the innermost stage
+    counter = Counter(label, self.progress_interval)
+    if self.active:
+      self.active[-1].counters.append(counter)
+    return counter
+
+  def wants(self, stages, name):
+    return 'all' in stages or name in stages or name.split('.')[-1] in stages
+
+  def enclosing(self, stage):
+    # the active stages stage runs inside
+    with self.lock:
+      return self.active[:self.active.index(stage)]
+
+  def enter(self, stage):
+    with self.lock:
+      self.stages.append(stage)
+      self.active.append(stage)
+    self.start_sampler()
+    stage.sample(current_rss())
+    # a stage inside one that is already traced or profiled is covered by
+    # the outer trace or profile; only one of each can run at a time
+    outer = self.enclosing(stage)
+    if self.wants(self.trace_memory_stages, stage.name):
+      if tracemalloc is None:
+        print('tracemalloc needs python 3; not tracing %s' % stage.name)
+      elif not [ s for s in outer if s.tracing ] and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        stage.tracing = True
+    if self.wants(self.profile_stages, stage.name):
+      if not [ s for s in outer if s.profiler is not None ]:
+        import cProfile
+        stage.profiler = cProfile.Profile()
+        stage.profiler.enable()
+    stage.started = time.time()
+
+  def exit(self, stage):
+    stage.seconds = time.time() - stage.started
+    if stage.profiler is not None:
+      stage.profiler.disable()
+      self.save_profile(stage)
+    if stage.tracing:
+      stage.traced_peak = tracemalloc.get_traced_memory()[1]
+      self.save_trace(stage, tracemalloc.take_snapshot())
+      tracemalloc.stop()
+    stage.sample(current_rss())
+    with self.lock:
+      self.active.remove(stage)
+    for counter in stage.counters:
+      counter.report()
+    print('%s took %.1f seconds' % (stage.name, stage.seconds))
+
+  def start_sampler(self):
+    # samples RSS into every active stage until stop_sampler()
+    if self.sampler is not None or current_rss() is None:
+      return
+    self.stopping = threading.Event()
+    self.sampler = threading.Thread(target=self.sample_loop, args=(self.stopping, ))
+    self.sampler.daemon = True
+    self.sampler.start()
+
+  def stop_sampler(self):
+    if self.sampler is None:
+      return
+    self.stopping.set()
+    self.sampler.join()
+    self.sampler = None
+
+  def sample_loop(self, stopping):
+    while not stopping.wait(self.sample_interval):
+      rss = current_rss()
+      with self.lock:
+        for stage in self.active:
+          stage.sample(rss)
+
+  def profile_path(self, stage, suffix):
+    if not os.path.isdir(self.profile_dir):
+      os.makedirs(self.profile_dir)
+    return os.path.join(self.profile_dir, '%s-%d.%s' % (stage.name, os.getpid(), suffix))
+
+  def save_profile(self, stage):
+    import pstats
+    path = self.profile_path(stage, 'prof')
+    stage.profiler.dump_stats(path)
+    with open(self.profile_path(stage, 'prof.txt'), 'w') as f:
+      pstats.Stats(path, stream=f).sort_stats('cumulative').print_stats(40)
+    stage.profiler = None
+    print('Saved profile of %s to %s' % (stage.name, path))
+
+  def save_trace(self, stage, snapshot):
+    path = self.profile_path(stage, 'tracemalloc.txt')
+    with open(path, 'w') as f:
+      f.write('peak traced memory %d bytes\n' % stage.traced_peak)
+      for stat in snapshot.statistics('lineno')[:40]:
+        f.write('%s\n' % stat)
+    print('Saved allocation trace of %s to %s' % (stage.name, path))
+
+  def as_dict(self):
+    return {
+      'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+      'seconds': round(time.time() - self.started, 3),
+      'python': platform.python_version(),
+      'peak_rss_mb': megabytes(peak_rss()),
+      'stages': [ stage.as_dict() for stage in self.stages if stage.seconds is not None ]
+    }
+
+  def write(self, path):
+    dir_name = os.path.dirname(path)
+    if not os.path.isdir(dir_name):
+      os.makedirs(dir_name)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+      json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+    if os.path.exists(path):
+      os.remove(path)
+    os.rename(tmp_path, path)
@@ -0,0 +1,160 @@
+# Normalization of PowerSchool date, period, term and course values.
+#
+# The same few hundred dates, expressions and course names repeat across
+# every row, so each parser is memoized in a bounded LRU cache whose hit
+# rate can be reported with cache_stats().
+
+from collections import OrderedDict
+from datetime import date
+import re
+
+try:
+  from sys import intern
+except ImportError:
+  intern = intern # python 2 builtin
+
+DATE_MDY = re.compile(r'(\d+)\/(\d+)\/(\d+)(\s|$)')
+DATE_MY = re.compile(r'(\d+)\/(\d+)(\s|$)')
+PERIOD_SUFFIX = re.compile(r'[^0-9].*$')
+NOT_UPPER = re.compile(r'[^A-Z]')
+GRADE_SUFFIX = re.compile(r'K|TK|[1-8]')
+
+caches = [ ]
+
+
+class LruCache(object):
+  # bounded memo for a one-argument function; exceptions are not cached
+  def __init__(self, func, maxsize):
+    self.func = func
+    self.name = func.__name__
+    self.maxsize = maxsize
+    self.entries = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    caches.append(self)
+
+  def __call__(self, arg):
+    entries = self.entries
+    if arg in entries:
+      self.hits += 1
+      value = entries.pop(arg)
+      entries[arg] = value
+      return value
+    self.misses += 1
+    value = self.func(arg)
+    entries[arg] = value
+    if len(entries) > self.maxsize:
+      entries.popitem(last=False)
+    return value
+
+  def clear(self):
+    self.entries.clear()
+    self.hits = 0
+    self.misses = 0
+
+
+def memoized(maxsize):
+  def decorate(func):
+    return LruCache(func, maxsize)
+  return decorate
+
+
+def cache_stats():
+  # (name, hits, misses, hit rate, entries) for each memoized parser
+  stats = [ ]
+  for cache in caches:
+    calls = cache.hits + cache.misses
+    rate = float(cache.hits) / calls if calls else 0.0
+    stats.append((cache.name, cache.hits, cache.misses, rate, len(cache.entries)))
+  return stats
+
+
+def split_date(raw_date):
+  mo = None
+  da = None
+  yr = None
+  if raw_date != '':
+    datestr = raw_date.replace('-', '/').strip()
+    m = DATE_MDY.match(datestr)
+    if m:
+      mo = int(m.group(1))
+      da = int(m.group(2))
+      yr = int(m.group(3))
+    else:
+      m = DATE_MY.match(datestr)
+      if m:
+        mo = int(m.group(1))
+        da = 1
+        yr = int(m.group(2))
+    if mo and da and yr:
+      if yr < 20:
+        yr += 2000
+      elif yr < 100:
+        yr += 1900
+      if mo < 1 or mo > 12 or da < 1 or da > 31 or yr < 1900 or yr > 2020:
+        mo = None
+        da = None
+        yr = None
+  return (mo, da, yr)
+
+
+@memoized(16384)
+def clean_date(raw_date):
+  mo, da, yr = split_date(raw_date)
+  if mo:
+    return intern('%02d/%02d/%04d' % (mo, da, yr))
+  return ''
+
+
+@memoized(16384)
+def parse_date(raw_date):
+  mo, da, yr = split_date(raw_date)
+  if mo:
+    return date(yr, mo, da)
+  return None
+
+
+@memoized(16384)
+def date_to_year_abbr(entrydate):
+  parsed = parse_date(entrydate)
+  if not parsed:
+    raise Exception('can\'t parse date %s' % entrydate)
+  year_number = parsed.year - 1991
+  if parsed.month >= 7:
+    year_number += 1
+  return year_number_to_year_abbr(year_number)
+
+
+def year_number_to_year_abbr(year_number):
+  return '%02d-%02d' % (((year_number + 90) % 100, (year_number + 91) % 100))
+
+
+@memoized(1024)
+def term_to_year_abbr(termid):
+  return year_number_to_year_abbr(int(termid) // 100)
+
+
+@memoized(1024)
+def expression_to_period(expr):
+  if expr == '':
+    return ''
+  period = int(PERIOD_SUFFIX.sub('', expr))
+  if period == 0:
+    return ''
+  # DD only allows 9 periods
+  if period > 9:
+    period = 9
+  return period
+
+
+@memoized(4096)
+def course_abbreviation(name):
+  words = name.split()
+  first_word = words[0].upper()
+  abbr = NOT_UPPER.sub('', first_word)[:4]
+  suffix = ''
+  if len(words) > 1:
+    last_word = words[-1].upper()
+    if GRADE_SUFFIX.match(last_word):
+      suffix = last_word
+  return abbr + suffix
@@ -0,0 +1,43 @@
+# Batched serialization of the tab-separated output files.
+#
+# output_files hands write_table() a header and an iterator over the
+# formatted lines of a file.  Each record's fields come out of one
+# operator.attrgetter call rather than a getter call per field, lines
+# are collected BATCH_ROWS at a time, and each batch goes to the output
+# file in one writelines() call instead of two write() calls per row.
+# The bytes written are the same.
+
+import itertools
+import operator
+
+# lines per writelines() call
+BATCH_ROWS = 4096
+
+
+def fields_getter(fields):
+  # record -> tuple of its fields, in the order of fields
+  if len(fields) == 1:
+    getter = operator.attrgetter(fields[0])
+    return lambda record: (getter(record), )
+  return operator.attrgetter(*fields)
+
+
+def format_row(values):
+  return '\t'.join(map(str, values)) + '\n'
+
+
+def empty_row(fields):
+  # the line for a record that doesn't exist: every field ''
+  return '\t' * (len(fields) - 1) + '\n'
+
+
+def write_table(out, header_fields, lines, progress):
+  # writes the header and then lines, ticking progress once per batch
+  out.write('\t'.join(header_fields) + '\n')
+  lines = iter(lines)
+  while True:
+    batch = list(itertools.islice(lines, BATCH_ROWS))
+    if not batch:
+      break
+    out.writelines(batch)
+    progress.tick(len(batch))
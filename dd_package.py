@@ -0,0 +1,260 @@
+# Compressed zip packaging for the export files.
+#
+# Rows are streamed into zip members while output_files writes them, so
+# the export is never re-read just to be zipped.  Each member is
+# compressed on its own thread into an anonymous spool file; close()
+# lays the spooled members out behind their local headers and lets
+# zipfile write the central directory.  Members written from existing
+# files (add_files) are compressed in a thread pool.
+
+from multiprocessing.pool import ThreadPool
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+
+try:
+  from queue import Queue
+except ImportError:
+  from Queue import Queue # python 2
+
+COMPRESSION = {
+  'stored':  zipfile.ZIP_STORED,
+  'deflate': zipfile.ZIP_DEFLATED,
+  'bzip2':   getattr(zipfile, 'ZIP_BZIP2', None),
+  'lzma':    getattr(zipfile, 'ZIP_LZMA', None)
+}
+
+# bytes buffered by a writer before they are handed to its thread
+CHUNK_SIZE = 256 * 1024
+
+
+def compress_type(name):
+  compression = COMPRESSION.get(name)
+  if compression is None:
+    raise Exception('unsupported zip_compression %s' % name)
+  return compression
+
+
+def new_compressor(compression, level):
+  if compression == zipfile.ZIP_STORED:
+    return None
+  if hasattr(zipfile, '_get_compressor'):
+    return zipfile._get_compressor(compression, level)
+  # python 2 only has deflate
+  if level is None:
+    level = zlib.Z_DEFAULT_COMPRESSION
+  return zlib.compressobj(level, zlib.DEFLATED, -15)
+
+
+class ZipMember(object):
+  # one archive member, compressed into a spool file as data arrives
+  def __init__(self, arcname, compression, level):
+    self.arcname = arcname
+    self.compression = compression
+    self.compressor = new_compressor(compression, level)
+    self.spool = tempfile.TemporaryFile()
+    self.date_time = time.localtime()[:6]
+    self.crc = 0
+    self.file_size = 0
+    self.compress_size = 0
+
+  def compress(self, data):
+    self.crc = zlib.crc32(data, self.crc)
+    self.file_size += len(data)
+    if self.compressor is not None:
+      data = self.compressor.compress(data)
+    self.spool.write(data)
+
+  def finish(self):
+    if self.compressor is not None:
+      self.spool.write(self.compressor.flush())
+      self.compressor = None
+    self.compress_size = self.spool.tell()
+
+  def zip_info(self):
+    zinfo = zipfile.ZipInfo(self.arcname, self.date_time)
+    zinfo.compress_type = self.compression
+    zinfo.external_attr = 0o644 << 16
+    zinfo.CRC = self.crc & 0xffffffff
+    zinfo.file_size = self.file_size
+    zinfo.compress_size = self.compress_size
+    if self.compression == COMPRESSION['lzma']:
+      # lzma members carry an end-of-stream marker
+      zinfo.flag_bits |= 0x02
+    return zinfo
+
+  def close(self):
+    self.spool.close()
+
+
+class MemberWriter(object):
+  # file-like writer that feeds a ZipMember on a background thread
+  def __init__(self, member):
+    self.member = member
+    self.pending = [ ]
+    self.pending_bytes = 0
+    self.error = None
+    self.closed = False
+    self.queue = Queue(maxsize=8)
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def write(self, data):
+    self.pending.append(data)
+    self.pending_bytes += len(data)
+    if self.pending_bytes >= CHUNK_SIZE:
+      self.flush()
+
+  def flush(self):
+    if self.pending:
+      self.queue.put(b''.join(self.pending))
+      self.pending = [ ]
+      self.pending_bytes = 0
+
+  def run(self):
+    while True:
+      data = self.queue.get()
+      if data is None:
+        break
+      if self.error is None:
+        try:
+          self.member.compress(data)
+        except Exception as e:
+          self.error = e
+    if self.error is None:
+      try:
+        self.member.finish()
+      except Exception as e:
+        self.error = e
+
+  def close(self):
+    # returns at once; ZipPackager.close() waits for the thread
+    if not self.closed:
+      self.flush()
+      self.queue.put(None)
+      self.closed = True
+
+  def join(self):
+    self.close()
+    self.thread.join()
+    if self.error is not None:
+      raise self.error
+
+
+class TeeOutput(object):
+  # writes text to an output file and the same bytes to a zip member
+  def __init__(self, out, writer):
+    self.out = out
+    self.writer = writer
+    self.encoding = getattr(out, 'encoding', None)
+
+  def write(self, s):
+    self.out.write(s)
+    if os.linesep != '\n':
+      s = s.replace('\n', os.linesep)
+    if not isinstance(s, bytes):
+      s = s.encode(self.encoding or 'ascii')
+    self.writer.write(s)
+
+  def writelines(self, lines):
+    self.write(''.join(lines))
+
+  def close(self):
+    self.out.close()
+    self.writer.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+
+def compress_file(job):
+  path, member = job
+  with open(path, 'rb') as f:
+    while True:
+      chunk = f.read(CHUNK_SIZE)
+      if not chunk:
+        break
+      member.compress(chunk)
+  member.finish()
+  return member
+
+
+class ZipPackager(object):
+  def __init__(self, zip_path, compression='deflate', level=None, threads=None):
+    self.zip_path = zip_path
+    self.compression = compress_type(compression)
+    self.level = level
+    self.threads = threads
+    self.members = [ ]
+    self.writers = [ ]
+
+  def open_member(self, arcname):
+    member = ZipMember(arcname, self.compression, self.level)
+    writer = MemberWriter(member)
+    self.members.append(member)
+    self.writers.append(writer)
+    return writer
+
+  def add_files(self, paths):
+    # compress existing files (zipped without paths, like 'zip -j')
+    jobs = [ (path, ZipMember(os.path.basename(path), self.compression, self.level))
+      for path in paths ]
+    if not jobs:
+      return
+    pool = ThreadPool(self.threads or min(len(jobs), 4))
+    try:
+      self.members.extend(pool.map(compress_file, jobs))
+    finally:
+      pool.close()
+      pool.join()
+
+  def close(self):
+    # wait for every member, then assemble the archive
+    try:
+      for writer in self.writers:
+        writer.join()
+      with zipfile.ZipFile(self.zip_path, 'w', zipfile.ZIP_STORED, True) as zipf:
+        for member in self.members:
+          zinfo = member.zip_info()
+          zinfo.header_offset = zipf.fp.tell()
+          zipf.fp.write(zinfo.FileHeader())
+          member.spool.seek(0)
+          shutil.copyfileobj(member.spool, zipf.fp, CHUNK_SIZE)
+          zipf.filelist.append(zinfo)
+          zipf.NameToInfo[zinfo.filename] = zinfo
+          print('%s: %d bytes, %d compressed' % (member.arcname,
+            member.file_size, member.compress_size))
+        # the central directory goes after the last member
+        zipf.start_dir = zipf.fp.tell()
+    finally:
+      self.discard()
+
+  def discard(self):
+    for writer in self.writers:
+      writer.close()
+    for writer in self.writers:
+      writer.thread.join()
+    for member in self.members:
+      member.close()
+    self.members = [ ]
+    self.writers = [ ]
+
+
+def link_or_copy(src, dest_dir):
+  # hardlink into the archive, copying only when the filesystem can't link
+  dest = os.path.join(dest_dir, os.path.basename(src))
+  if os.path.exists(dest):
+    os.remove(dest)
+  try:
+    os.link(src, dest)
+  except (AttributeError, OSError):
+    shutil.copy(src, dest)
+  return dest
@@ -0,0 +1,166 @@
+# Bounded-queue pipeline stages for reading sources and writing output.
+#
+# With pipeline_depth set, each source file is read in blocks of lines
+# by a reader thread, split and projected by a parser thread, and the
+# analyze_* loop is left to build the records.  Stages are joined by
+# queues holding at most pipeline_depth blocks, so a reader that gets
+# ahead waits for its parser instead of buffering the file, and memory
+# stays flat however large the file.  File reads (slow ones, from a
+# network share) release the GIL, so they overlap parsing and record
+# building.  A source can be started before the stage that consumes it
+# (rosters, while students and teachers are analyzed): its queues fill
+# up and then wait.  Output files are written by a writer thread the
+# same way.
+
+import sys
+import threading
+
+try:
+  from queue import Queue, Empty
+except ImportError:
+  from Queue import Queue, Empty # python 2
+
+# bytes of lines read from a source file at a time, and bytes written
+# to an output file at a time
+BLOCK_SIZE = 256 * 1024
+
+END = object()
+
+
+class Failure(object):
+  # an exception raised on a stage thread, re-raised by its consumer
+  def __init__(self, exc_info):
+    self.exc_info = exc_info
+
+
+class Stage(object):
+  # Runs produce(), a generator function, on its own thread, and hands
+  # the items it yields to whoever iterates over the stage.  A Stage can
+  # be iterated once; stopping early (or an error) stops the thread.
+  def __init__(self, name, produce, depth):
+    self.queue = Queue(maxsize=depth)
+    self.stopped = False
+    self.done = False
+    self.thread = threading.Thread(target=self.run, args=(produce, ), name=name)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def run(self, produce):
+    items = produce()
+    try:
+      for item in items:
+        if self.stopped:
+          break
+        self.queue.put(item)
+    except Exception:
+      self.queue.put(Failure(sys.exc_info()))
+      return
+    finally:
+      # closes an upstream stage the generator was reading, if any
+      if hasattr(items, 'close'):
+        items.close()
+    self.queue.put(END)
+
+  def __iter__(self):
+    try:
+      while True:
+        item = self.queue.get()
+        if item is END:
+          self.done = True
+          return
+        if isinstance(item, Failure):
+          self.done = True
+          raise item.exc_info[1]
+        yield item
+    finally:
+      if not self.done:
+        self.stop()
+
+  def stop(self):
+    # drains the queue so a blocked put() returns and the thread sees
+    # it was stopped
+    self.stopped = True
+    while self.thread.is_alive():
+      try:
+        self.queue.get(timeout=0.1)
+      except Empty:
+        pass
+    self.done = True
+
+
+def read_blocks(paths):
+  # (path, lines) for each block of a file; a file's first block starts
+  # with its first line
+  for path in paths:
+    with open(path, 'r') as f:
+      while True:
+        lines = f.readlines(BLOCK_SIZE)
+        if not lines:
+          break
+        yield path, lines
+
+
+def source_stages(name, paths, parse, depth):
+  # reader and parser stages for the files in paths; parse(blocks) is a
+  # generator over the reader's blocks, yielding a list of rows for each
+  reader = Stage('%s reader' % name, lambda: read_blocks(paths), depth)
+  return Stage('%s parser' % name, lambda: parse(reader), depth)
+
+
+class Writer(object):
+  # file-like writer that hands BLOCK_SIZE chunks to a thread that
+  # writes them to out
+  def __init__(self, out, depth):
+    self.out = out
+    self.encoding = getattr(out, 'encoding', None)
+    self.pending = [ ]
+    self.pending_bytes = 0
+    self.error = None
+    self.closed = False
+    self.queue = Queue(maxsize=depth)
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def write(self, s):
+    self.pending.append(s)
+    self.pending_bytes += len(s)
+    if self.pending_bytes >= BLOCK_SIZE:
+      self.flush()
+
+  def writelines(self, lines):
+    self.write(''.join(lines))
+
+  def flush(self):
+    if self.pending:
+      self.queue.put(''.join(self.pending))
+      self.pending = [ ]
+      self.pending_bytes = 0
+
+  def run(self):
+    while True:
+      data = self.queue.get()
+      if data is None:
+        break
+      if self.error is None:
+        try:
+          self.out.write(data)
+        except Exception as e:
+          self.error = e
+
+  def close(self):
+    # waits for everything to be written
+    if not self.closed:
+      self.flush()
+      self.queue.put(None)
+      self.closed = True
+      self.thread.join()
+      self.out.close()
+    if self.error is not None:
+      raise self.error
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
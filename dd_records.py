@@ -0,0 +1,94 @@
+# Compact record types for the DdImporter model.
+#
+# Each entity is a fixed set of fields held in __slots__ instead of a
+# per-record dict, which keeps a county-sized roster in a fraction of the
+# memory.  Unset fields read back as '' just like the old nested dicts.
+
+try:
+  from sys import intern
+except ImportError:
+  intern = intern # python 2 builtin
+
+
+class Record(object):
+  __slots__ = ()
+
+  def __init__(self, *values):
+    fields = self.__slots__
+    for i, value in enumerate(values):
+      setattr(self, fields[i], value)
+    for name in fields[len(values):]:
+      setattr(self, name, '')
+
+  def get(self, key):
+    return getattr(self, key, '')
+
+  def set(self, key, value):
+    setattr(self, key, value)
+
+  def values(self, fields):
+    return [getattr(self, f, '') for f in fields]
+
+  # python 2 can't pickle __slots__ classes without these
+  def __getstate__(self):
+    return tuple(getattr(self, f) for f in self.__slots__)
+
+  def __setstate__(self, state):
+    for name, value in zip(self.__slots__, state):
+      setattr(self, name, value)
+
+  def __repr__(self):
+    return '%s(%s)' % (self.__class__.__name__,
+      ', '.join(['%s=%r' % (f, getattr(self, f)) for f in self.__slots__]))
+
+
+class Student(Record):
+  __slots__ = (
+    'ssid', 'student_id', 'first_name', 'last_name', 'gender', 'parent',
+    'street', 'city', 'state', 'zip', 'phone_number', 'parent_education',
+    'birthdate', 'date_entered_school', 'date_entered_district',
+    'first_us_entry_date', 'date_rfep', 'ethnicity', 'primary_language',
+    'language_fluency', 'gate', 'nslp', 'migrant_ed', 'special_program',
+    'title_1', 'primary_disability', 'school_id', 'school_code' )
+
+
+class User(Record):
+  __slots__ = (
+    'employee_id', 'teacher_id', 'school_id', 'school_code',
+    'first_name', 'last_name', 'email_address' )
+
+
+class Course(Record):
+  __slots__ = (
+    'course_id', 'abbreviation', 'name', 'credits', 'subject_code',
+    'a_to_g', 'school_id', 'school_code' )
+
+
+class Enrollment(Record):
+  __slots__ = ( 'school_id', 'school_code', 'grade_level' )
+
+
+class TeacherYear(Record):
+  __slots__ = ( 'active', )
+
+
+class Roster(Record):
+  __slots__ = (
+    'ssid', 'student_id', 'teacher_id', 'employee_id', 'school_id',
+    'school_code', 'grade_level', 'period', 'term', 'course_id', 'section_id' )
+
+  # rosters are the bulk of the model, so skip the generic setattr loop
+  def __init__(self, ssid='', student_id='', teacher_id='', employee_id='',
+      school_id='', school_code='', grade_level='', period='', term='',
+      course_id='', section_id=''):
+    self.ssid        = ssid
+    self.student_id  = student_id
+    self.teacher_id  = teacher_id
+    self.employee_id = employee_id
+    self.school_id   = school_id
+    self.school_code = school_code
+    self.grade_level = grade_level
+    self.period      = period
+    self.term        = term
+    self.course_id   = course_id
+    self.section_id  = section_id
@@ -0,0 +1,90 @@
+# External merge sort for roster output.
+#
+# Roster rows are formatted as they are analyzed and buffered per year.
+# Whenever the buffered rows pass the memory budget they are sorted by
+# memberid and spilled as a run file; writing a year k-way merges its runs.
+# A memberid seen more than once keeps its last row, the same as assigning
+# into the in-memory rosters dict.
+
+import heapq
+import os
+import shutil
+import tempfile
+
+# rough per-row cost of the buffered tuple and its strings
+ROW_OVERHEAD = 200
+
+
+class RosterSpool(object):
+  def __init__(self, base_dir, budget_bytes):
+    self.budget_bytes = budget_bytes
+    self.tmp_dir = tempfile.mkdtemp(prefix='roster-runs-', dir=base_dir)
+    self.buffers = { }
+    self.runs = { }
+    self.buffered_bytes = 0
+    self.num_runs = 0
+
+  def add(self, year, memberid, courseid, line):
+    if not year in self.buffers:
+      self.buffers[year] = [ ]
+    self.buffers[year].append((memberid, courseid, line))
+    self.buffered_bytes += len(memberid) + len(line) + ROW_OVERHEAD
+    if self.buffered_bytes >= self.budget_bytes:
+      self.spill()
+
+  def years(self):
+    return sorted(set(self.buffers.keys()) | set(self.runs.keys()))
+
+  def spill(self):
+    for year, rows in self.buffers.items():
+      if not rows:
+        continue
+      path = os.path.join(self.tmp_dir, 'run-%05d.txt' % self.num_runs)
+      self.num_runs += 1
+      with open(path, 'w') as f:
+        for memberid, courseid, line in self.sorted_rows(rows):
+          f.write('%s\t%s\t%s\n' % (memberid, courseid, line))
+      if not year in self.runs:
+        self.runs[year] = [ ]
+      self.runs[year].append(path)
+    self.buffers = { }
+    self.buffered_bytes = 0
+
+  def sorted_rows(self, rows):
+    # the sort is stable, so the last row for a memberid is last in its group
+    rows.sort(key=lambda row: row[0])
+    last = len(rows) - 1
+    for i, row in enumerate(rows):
+      if i == last or rows[i + 1][0] != row[0]:
+        yield row
+
+  def read_run(self, path, run_number):
+    with open(path, 'r') as f:
+      for line in f:
+        memberid, courseid, line = line.rstrip('\n').split('\t', 2)
+        yield (memberid, run_number, courseid, line)
+
+  def rows(self, year):
+    # (courseid, line) in memberid order, merged across all runs
+    sources = [ ]
+    for run_number, path in enumerate(self.runs.get(year, [ ])):
+      sources.append(self.read_run(path, run_number))
+    buffered = self.buffers.get(year, [ ])
+    if buffered:
+      run_number = len(sources)
+      sources.append([ (memberid, run_number, courseid, line)
+        for memberid, courseid, line in self.sorted_rows(buffered) ])
+
+    # ties on memberid come out in run order, so keep the last of each
+    pending = None
+    for row in heapq.merge(*sources):
+      if pending is not None and pending[0] != row[0]:
+        yield pending[2], pending[3]
+      pending = row
+    if pending is not None:
+      yield pending[2], pending[3]
+
+  def close(self):
+    shutil.rmtree(self.tmp_dir, ignore_errors=True)
+    self.buffers = { }
+    self.runs = { }
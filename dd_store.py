@@ -0,0 +1,236 @@
+# Dict-like stores for the importer's analyzed state, under a memory budget.
+#
+# Without memory_budget_mb the importer keeps students, users, courses,
+# enrollments, teacher-years and rosters in plain dicts.  With it, each
+# of them is a SpillDict: an ordinary dict until the estimated size of
+# all of them passes the budget, then a table in one scratch SQLite file
+# (WAL journal, no fsyncs) under the data directory.  After the spill,
+# writes are buffered and inserted executemany() batches at a time,
+# reads are lookups on the key index, keys() and items() come back in
+# insertion order like a dict's, and sorted_items() comes back in key
+# order from the index, so output needs no sort in memory.
+#
+# Records read back from the file are copies, so a record that changes
+# has to be stored again; the importer's set_* methods do that.
+
+from __future__ import print_function
+
+import collections
+import os
+import pickle
+import sqlite3
+import threading
+
+# writes buffered per store before they are inserted
+BATCH_ROWS = 5000
+
+# rows fetched per round trip while iterating
+FETCH_ROWS = 1000
+
+# keys per "key IN (...)" lookup, under SQLite's parameter limit
+LOOKUP_KEYS = 500
+
+
+class SpillStore(object):
+  # the budget, the SQLite file and every SpillDict sharing them
+  def __init__(self, base_dir, budget_bytes):
+    self.base_dir = base_dir
+    self.budget_bytes = budget_bytes
+    self.estimated_bytes = 0
+    self.dicts = [ ]
+    self.path = None
+    self.connection = None
+    # the parser thread of a pipelined source reads stores as well
+    self.lock = threading.RLock()
+
+  def spilled(self):
+    return self.connection is not None
+
+  def new_dict(self, row_bytes):
+    # row_bytes is a rough per-entry cost of the key, record and dict slot
+    d = SpillDict(self, 'store%d' % len(self.dicts), row_bytes)
+    self.dicts.append(d)
+    if self.spilled():
+      d.spill()
+    return d
+
+  def grow(self, n):
+    self.estimated_bytes += n
+    if self.estimated_bytes > self.budget_bytes and not self.spilled():
+      self.spill()
+
+  def spill(self):
+    if not os.path.isdir(self.base_dir):
+      os.makedirs(self.base_dir)
+    self.path = os.path.join(self.base_dir, 'store-%d.sqlite' % os.getpid())
+    self.remove_files()
+    print('Analyzed state passed the memory budget; moving it to %s' % self.path)
+    self.connection = sqlite3.connect(self.path, check_same_thread=False)
+    self.connection.execute('PRAGMA journal_mode=WAL')
+    self.connection.execute('PRAGMA synchronous=OFF')
+    # page cache in KB, a quarter of the budget
+    self.connection.execute('PRAGMA cache_size=-%d' % max(2048, self.budget_bytes // 4096))
+    for d in self.dicts:
+      d.spill()
+
+  def remove_files(self):
+    for suffix in [ '', '-wal', '-shm' ]:
+      if os.path.exists(self.path + suffix):
+        os.remove(self.path + suffix)
+
+  def close(self):
+    if self.connection is not None:
+      self.connection.close()
+      self.connection = None
+      self.remove_files()
+
+
+def dump(value):
+  return sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+def load(data):
+  return pickle.loads(bytes(data))
+
+
+class SpillDict(object):
+  # the parts of the dict interface the importer uses
+  def __init__(self, store, table, row_bytes):
+    self.store = store
+    self.table = table
+    self.row_bytes = row_bytes
+    # every entry, until the store spills
+    self.memory = { }
+    # entries written since the last batch insert, after it spills
+    self.pending = None
+
+  def spill(self):
+    with self.store.lock:
+      self.store.connection.execute('CREATE TABLE %s (seq INTEGER PRIMARY KEY, '
+        'key TEXT NOT NULL UNIQUE, value BLOB NOT NULL)' % self.table)
+      self.pending = collections.OrderedDict()
+      if self.memory:
+        self.pending.update(self.memory)
+        self.flush()
+      self.memory = None
+
+  def flush(self):
+    # inserts the pending entries, in the order they were first written,
+    # and updates the ones already in the table
+    if not self.pending:
+      return
+    with self.store.lock:
+      connection = self.store.connection
+      items = list(self.pending.items())
+      existing = set()
+      for i in range(0, len(items), LOOKUP_KEYS):
+        keys = [ key for key, value in items[i:i + LOOKUP_KEYS] ]
+        existing.update([ row[0] for row in connection.execute(
+          'SELECT key FROM %s WHERE key IN (%s)' % (self.table, ','.join([ '?' ] * len(keys))),
+          keys) ])
+      connection.executemany('INSERT INTO %s (key, value) VALUES (?, ?)' % self.table,
+        [ (key, dump(value)) for key, value in items if not key in existing ])
+      connection.executemany('UPDATE %s SET value = ? WHERE key = ?' % self.table,
+        [ (dump(value), key) for key, value in items if key in existing ])
+      connection.commit()
+      self.pending = collections.OrderedDict()
+
+  def __setitem__(self, key, value):
+    if self.memory is not None:
+      if not key in self.memory:
+        self.memory[key] = value
+        self.store.grow(self.row_bytes)
+      else:
+        self.memory[key] = value
+      return
+    self.pending[key] = value
+    if len(self.pending) >= BATCH_ROWS:
+      self.flush()
+
+  # reads take local references to memory and pending, which another
+  # thread's spill() or flush() may replace
+
+  def get(self, key, default=None):
+    memory = self.memory
+    if memory is not None:
+      return memory.get(key, default)
+    value = self.pending.get(key)
+    if value is not None:
+      return value
+    with self.store.lock:
+      row = self.store.connection.execute('SELECT value FROM %s WHERE key = ?' % self.table,
+        (key, )).fetchone()
+    if row is None:
+      return default
+    return load(row[0])
+
+  def __getitem__(self, key):
+    value = self.get(key)
+    if value is None:
+      raise KeyError(key)
+    return value
+
+  def __contains__(self, key):
+    memory = self.memory
+    if memory is not None:
+      return key in memory
+    if key in self.pending:
+      return True
+    with self.store.lock:
+      return self.store.connection.execute('SELECT 1 FROM %s WHERE key = ?' % self.table,
+        (key, )).fetchone() is not None
+
+  def __len__(self):
+    if self.memory is not None:
+      return len(self.memory)
+    self.flush()
+    with self.store.lock:
+      return self.store.connection.execute('SELECT COUNT(*) FROM %s' % self.table).fetchone()[0]
+
+  def update(self, other):
+    for key, value in other.items():
+      self[key] = value
+
+  def query(self, columns, order):
+    # rows of columns in order ('seq' or 'key'), a page at a time, with
+    # no statement left open while the caller writes to other stores
+    self.flush()
+    sql = 'SELECT %s, %s FROM %s %%s ORDER BY %s LIMIT %d' % (
+      order, columns, self.table, order, FETCH_ROWS)
+    rows = [ ]
+    while True:
+      with self.store.lock:
+        if not rows:
+          rows = self.store.connection.execute(sql % '').fetchall()
+        else:
+          rows = self.store.connection.execute(sql % ('WHERE %s > ?' % order),
+            (rows[-1][0], )).fetchall()
+      if not rows:
+        break
+      for row in rows:
+        yield row[1:]
+
+  def keys(self):
+    if self.memory is not None:
+      return self.memory.keys()
+    return (key for key, in self.query('key', 'seq'))
+
+  def __iter__(self):
+    return iter(self.keys())
+
+  def items(self):
+    if self.memory is not None:
+      return self.memory.items()
+    return ((key, load(value)) for key, value in self.query('key, value', 'seq'))
+
+  def sorted_items(self):
+    if self.memory is not None:
+      return sorted(self.memory.items(), key=lambda item: item[0])
+    return ((key, load(value)) for key, value in self.query('key, value', 'key'))
+
+
+def sorted_items(d):
+  # (key, value) of a dict or SpillDict in key order
+  if isinstance(d, SpillDict):
+    return d.sorted_items()
+  return sorted(d.items(), key=lambda item: item[0])
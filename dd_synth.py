@@ -0,0 +1,267 @@
+from __future__ import print_function
+
+# Synthetic PowerSchool extract for trying out and benchmarking the importer.
+#
+# Writes dd-students.txt, dd-teachers.txt, dd-courses-all.txt,
+# dd-rosters-all.txt, dd-races.txt and dd-programs.txt in the column
+# order of the importer's *_HEADERS lists (the races and programs files
+# with their header row, the rest without), sized by the number of
+# students.  Rows are written as they are generated, so a 1M student
+# extract needs little more memory than a 1k one.  The same seed gives
+# the same files under Python 2 and 3.
+#
+#   python dd_synth.py 10000 /tmp/extract --year 16-17
+#
+# A handful of rows in each file are the kind the importer is meant to
+# reject: dropped sections, attendance courses, period 0, inactive staff.
+# Extracts covering more than one year (--years) are meant for
+# school_year = None, like the real multi-year PowerSchool export.
+
+import argparse
+import os
+import random
+
+FIRST_NAMES = [
+  'Olivia', 'Liam', 'Emma', 'Noah', 'Ava', 'Mateo', 'Sofia', 'Lucas',
+  'Mia', 'Ethan', 'Isabella', 'Leo', 'Chloe', 'Daniel', 'Camila', 'Kai',
+  'Harper', 'Diego', 'Aria', 'Ryan', 'Zoe', 'Nathan', 'Maya', 'Owen' ]
+
+LAST_NAMES = [
+  'Smith', 'Garcia', 'Nguyen', 'Johnson', 'Martinez', 'Lee', 'Brown',
+  'Lopez', 'Kim', 'Davis', 'Hernandez', 'Wilson', 'Chen', 'Anderson',
+  'Gonzalez', 'Taylor', 'Patel', 'Thomas', 'Ramirez', 'Moore' ]
+
+STREETS = [ 'Main St', 'Oak Ave', 'College Ave', 'Woodland Rd', 'Poplar Ave',
+  'Laurel Grove', 'Sir Francis Drake Blvd', 'Evergreen Dr' ]
+
+CITIES = [ ('Kentfield', '94904'), ('Greenbrae', '94904'), ('Larkspur', '94939'),
+  ('Ross', '94957'), ('San Anselmo', '94960') ]
+
+LANGUAGES = [ '00', '00', '00', '00', '01', '01', '07', '11', '21' ]
+
+FLUENCIES = [ 'EO', 'EO', 'EO', 'EO', 'IFEP', 'EL', 'RFEP', '' ]
+
+RACE_CODES = [ '100', '201', '202', '204', '299', '400', '600', '700', '700', '700' ]
+
+DISABILITIES = [ '210', '240', '250', '280', '290', '320' ]
+
+SUBJECTS = [
+  ('Math', 'MA'), ('English Language Arts', 'EN'), ('Science', 'SC'),
+  ('Social Studies', 'SS'), ('Spanish', 'FL'), ('Art', 'AR'),
+  ('Music', 'MU'), ('PE', 'PE'), ('Library', 'LB'), ('Tech', 'TE') ]
+
+GRADE_NAMES = [ 'K', '1', '2', '3', '4', '5', '6', '7', '8' ]
+
+# termid suffix and term abbreviation; None is the full year, e.g. '16-17'
+TERMS = [ ('00', None), ('01', 'S1'), ('02', 'S2'), ('10', 'HT 1'), ('11', 'HT 2') ]
+
+# lead teachers with co-teachers in CO_TEACHERS, and their co-teachers
+CO_TEACHER_IDS = [ '804', '4636', '597', '1913' ]
+
+STUDENTS_PER_SCHOOL = 500
+STUDENTS_PER_TEACHER = 22
+COURSES_PER_SCHOOL = 60
+SECTIONS_PER_STUDENT = 7
+
+
+class Synth(object):
+  def __init__(self, num_students, out_dir, year='16-17', num_years=1, seed=1):
+    self.num_students = num_students
+    self.out_dir = out_dir
+    self.num_years = num_years
+    self.rng = random.Random(seed)
+    self.year_numbers = [ self.year_number(year) - i for i in range(num_years) ]
+    self.year_numbers.reverse()
+    self.schools = [ (101 + i, '%07d' % (2165000 + 11 * i))
+      for i in range(max(1, num_students // STUDENTS_PER_SCHOOL)) ]
+    self.num_teachers = max(len(self.schools) * 4, num_students // STUDENTS_PER_TEACHER)
+    self.courses = { }
+    self.teachers = { }
+    self.rows = { }
+
+  def year_number(self, year):
+    # '16-17' -> 26, the hundreds of that year's PowerSchool termids
+    return (int(year[:2]) + 10) % 100
+
+  def year_abbr(self, year_number):
+    return '%02d-%02d' % ((year_number + 90) % 100, (year_number + 91) % 100)
+
+  def start_year(self, year_number):
+    return 1990 + year_number
+
+  # rng.random() is the same on every Python; choice() and randint() aren't
+  def pick(self, seq):
+    return seq[int(self.rng.random() * len(seq))]
+
+  def number(self, lo, hi):
+    return lo + int(self.rng.random() * (hi - lo + 1))
+
+  def chance(self, p):
+    return self.rng.random() < p
+
+  def date(self, yr, lo_month=1, hi_month=12):
+    return '%02d/%02d/%04d' % (self.number(lo_month, hi_month), self.number(1, 28), yr)
+
+  def open(self, fname, headers=None):
+    f = open(os.path.join(self.out_dir, fname), 'w')
+    if headers is not None:
+      f.write('\t'.join(headers) + '\n')
+    self.rows[f.name] = 0
+    return f
+
+  def write(self, f, fields):
+    f.write('\t'.join(fields) + '\n')
+    self.rows[f.name] += 1
+
+  def generate(self):
+    if not os.path.isdir(self.out_dir):
+      os.makedirs(self.out_dir)
+    self.write_courses()
+    self.write_teachers()
+    self.write_students()
+    return dict([ (os.path.basename(path), n) for path, n in self.rows.items() ])
+
+  def write_courses(self):
+    with self.open('dd-courses-all.txt') as f:
+      # numbered across the district, so no two schools share one
+      n = 0
+      for schoolid, school_code in self.schools:
+        courses = self.courses[schoolid] = [ ]
+        for i in range(COURSES_PER_SCHOOL):
+          subject, credittype = SUBJECTS[i % len(SUBJECTS)]
+          grade = GRADE_NAMES[(i // len(SUBJECTS)) % len(GRADE_NAMES)]
+          course_number = '%04d' % (n * 7 + 11)
+          n += 1
+          courses.append(course_number)
+          self.write(f, [ course_number, '%s %s' % (subject, grade), '1',
+            credittype, '', str(schoolid), school_code ])
+      # attendance, rejected by EXCLUDED_COURSES
+      schoolid, school_code = self.schools[0]
+      self.write(f, [ 'AAAA', 'Attendance', '0', '', '', str(schoolid), school_code ])
+
+  def write_teachers(self):
+    ids = [ str(100 + i) for i in range(self.num_teachers) ]
+    ids.extend([ userid for userid in CO_TEACHER_IDS if not userid in ids ])
+    with self.open('dd-teachers.txt') as f:
+      for i, userid in enumerate(ids):
+        schoolid, school_code = self.schools[i % len(self.schools)]
+        self.teachers.setdefault(schoolid, [ ]).append(userid)
+        first_name = self.pick(FIRST_NAMES)
+        last_name = self.pick(LAST_NAMES)
+        # a few have left, or are staff without DataDirector access
+        status = '2' if self.chance(0.05) else '1'
+        staffstatus = '2' if self.chance(0.1) else '1'
+        self.write(f, [ userid, 'T%05d' % int(userid), str(schoolid), school_code,
+          first_name, last_name,
+          '%s.%s%s@kentfieldschools.org' % (first_name[0].lower(), last_name.lower(), userid),
+          status, staffstatus ])
+
+  def write_students(self):
+    students = self.open('dd-students.txt')
+    rosters = self.open('dd-rosters-all.txt')
+    races = self.open('dd-races.txt', [ 'studentid', 'racecd' ])
+    programs = self.open('dd-programs.txt', [ 'foreignkey', 'user_defined_text',
+      'user_defined_text2', 'custom', 'user_defined_date', 'user_defined_date2' ])
+    try:
+      for i in range(self.num_students):
+        self.write_student(i, students, rosters, races, programs)
+    finally:
+      for f in (students, rosters, races, programs):
+        f.close()
+
+  def write_student(self, i, students, rosters, races, programs):
+    studentid = str(10000 + i)
+    schoolid, school_code = self.schools[i % len(self.schools)]
+    last_year = self.year_numbers[-1]
+    start = self.start_year(last_year)
+    grade = self.number(0, 8)
+
+    # 0 = active in every year; 2 = left during the latest year
+    enroll_status = '2' if self.chance(0.04) else '0'
+    if enroll_status == '0':
+      entrydate = self.date(start, 8, 9)
+    else:
+      entrydate = self.date(start, 8, 12)
+    district_year = start - self.number(0, grade)
+    hispanic = self.chance(0.25)
+    city, zip_code = self.pick(CITIES)
+    fluency = self.pick(FLUENCIES)
+    disability = self.pick(DISABILITIES) if self.chance(0.1) else ''
+    mother_first = self.pick(FIRST_NAMES) if self.chance(0.9) else ''
+    last_name = self.pick(LAST_NAMES)
+
+    self.write(students, [
+      studentid, str(20000 + i),
+      '' if self.chance(0.01) else '%010d' % (3000000000 + i),
+      str(schoolid), self.pick(FIRST_NAMES), last_name,
+      self.date(start - 5 - grade), '1' if hispanic else '0',
+      self.pick('MF'), enroll_status, str(grade),
+      mother_first, last_name if mother_first else '',
+      self.pick(FIRST_NAMES), last_name,
+      '%d %s' % (self.number(1, 999), self.pick(STREETS)), city, 'CA', zip_code,
+      '415-%03d-%04d' % (self.number(200, 999), self.number(0, 9999)),
+      self.date(district_year, 8, 9), self.date(district_year, 8, 9), entrydate, '',
+      school_code, str(self.number(10, 15)), self.pick(LANGUAGES), fluency,
+      self.date(start - 1) if fluency == 'RFEP' else '',
+      self.date(district_year, 8, 9) if fluency in ('EL', 'RFEP') else '',
+      'Yes' if self.chance(0.08) else '', 'Yes' if self.chance(0.01) else '',
+      disability, '1' if self.chance(0.15) else '',
+      '500' if hispanic else self.pick(RACE_CODES) ])
+
+    self.write(races, [ studentid, self.pick(RACE_CODES) ])
+    if self.chance(0.3):
+      self.write_program(programs, studentid, disability)
+
+    # students who left only have the latest year's schedule
+    years = self.year_numbers if enroll_status == '0' else [ last_year ]
+    courses = self.courses[schoolid]
+    teachers = self.teachers[schoolid]
+    for year_number in years:
+      year_grade = max(grade - (last_year - year_number), 0)
+      for section in range(SECTIONS_PER_STUDENT):
+        term_code, term_abbr = self.pick(TERMS)
+        if term_abbr is None:
+          term_abbr = self.year_abbr(year_number)
+        termid = '%d%s' % (year_number, term_code)
+        course_number = self.pick(courses)
+        userid = self.pick(teachers)
+        sectionid = str(year_number * 10000 + self.number(0, 9999))
+        expression = '%d(A)' % (section + 1)
+        if self.chance(0.02):
+          # dropped section
+          sectionid = '-' + sectionid
+        elif self.chance(0.01):
+          course_number = 'AAAA'
+          expression = '0(A)'
+        elif self.chance(0.01):
+          userid = self.pick(CO_TEACHER_IDS[::2])
+        self.write(rosters, [ studentid, userid, str(schoolid), termid,
+          '', 'T%05d' % int(userid), school_code, str(year_grade),
+          expression, term_abbr, course_number, str(section + 1), sectionid ])
+
+  def write_program(self, programs, studentid, disability):
+    if disability:
+      code = '144'
+      custom = '\x11\x04\x03\x12\x00\x03%s' % disability
+    else:
+      code = self.pick([ '122', '127', '135', '175', '190' ])
+      custom = ''
+    start = self.date(self.start_year(self.year_numbers[0]) - 1)
+    # most programs are open ended; some ended before this year
+    end = '' if self.chance(0.8) else self.date(self.start_year(self.year_numbers[0]) - 1)
+    self.write(programs, [ studentid, code, '', custom, start, end ])
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Synthetic PowerSchool extract generator')
+  parser.add_argument('students', type=int, help='number of students, e.g. 1000 to 1000000')
+  parser.add_argument('out_dir', help='directory to write the dd-*.txt files to')
+  parser.add_argument('--year', default='16-17', help='latest school year (default 16-17)')
+  parser.add_argument('--years', type=int, default=1,
+    help='number of school years of schedules, ending with --year')
+  parser.add_argument('--seed', type=int, default=1)
+  args = parser.parse_args()
+
+  rows = Synth(args.students, args.out_dir, args.year, args.years, args.seed).generate()
+  for fname in sorted(rows.keys()):
+    print('%s: %d rows' % (fname, rows[fname]))
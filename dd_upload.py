@@ -0,0 +1,145 @@
+# WebDAV delivery of the packaged zip.
+#
+# One easywebdav client (and its requests session) is kept for every
+# attempt, so retries and the verification requests reuse the same
+# keep-alive connection.  The zip is streamed from disk with a progress
+# callback and an md5 computed on the way out; a failed attempt is
+# retried with exponential backoff, and a finished PUT is checked with
+# HEAD (or PROPFIND, for servers that don't answer HEAD).
+
+import hashlib
+import os
+import re
+import time
+
+import easywebdav
+import requests
+
+# status codes worth another attempt; anything else is a real refusal
+RETRY_CODES = ( 408, 423, 429, 500, 502, 503, 504 )
+
+MD5_HEX = re.compile(r'^[0-9a-f]{32}$')
+
+
+class ProgressReader(object):
+  # file wrapper that hashes and reports what the request body has read
+  def __init__(self, f, size, progress=None):
+    self.f = f
+    self.size = size
+    self.progress = progress
+    self.md5 = hashlib.md5()
+    self.sent = 0
+
+  def __len__(self):
+    # lets requests send a Content-Length instead of chunking
+    return self.size
+
+  def read(self, size=-1):
+    data = self.f.read(size)
+    if data:
+      self.md5.update(data)
+      self.sent += len(data)
+      if self.progress is not None:
+        self.progress(self.sent, self.size)
+    return data
+
+  def tell(self):
+    return self.f.tell()
+
+  def seek(self, offset, whence=0):
+    # a rewind (e.g. to resend after an auth challenge) restarts the hash
+    self.f.seek(offset, whence)
+    if self.f.tell() == 0:
+      self.md5 = hashlib.md5()
+      self.sent = 0
+
+  def hexdigest(self):
+    return self.md5.hexdigest()
+
+
+def retryable(e):
+  if isinstance(e, easywebdav.OperationFailed):
+    return e.actual_code in RETRY_CODES
+  return isinstance(e, (requests.exceptions.RequestException, IOError))
+
+
+def remote_md5(headers):
+  # the md5 the server reports for a file, if it reports one
+  checksum = headers.get('OC-Checksum', '')
+  for part in checksum.split():
+    if part.upper().startswith('MD5:'):
+      return part[4:].lower()
+  etag = headers.get('ETag', '').strip('"').lower()
+  if MD5_HEX.match(etag):
+    return etag
+  return None
+
+
+class WebDavUploader(object):
+  def __init__(self, host, protocol, path, username, password,
+      use_digest_auth=False, retries=5, retry_delay=2, timeout=120, port=0):
+    if use_digest_auth:
+      auth = requests.auth.HTTPDigestAuth(username, password)
+    else:
+      auth = (username, password)
+    self.webdav = easywebdav.connect(host, port=port, protocol=protocol,
+      verify_ssl=True, auth=auth, path=path)
+    self.use_digest_auth = use_digest_auth
+    self.retries = max(retries, 1)
+    self.retry_delay = retry_delay
+    self.timeout = timeout
+
+  def send(self, method, remote_path, expected, **kwargs):
+    resp = self.webdav._send(method, remote_path, expected,
+      timeout=self.timeout, **kwargs)
+    # read the body so the connection goes back to the pool
+    resp.content
+    return resp
+
+  def upload(self, local_path, remote_path, progress=None):
+    # returns the md5 of what was sent; raises once retries are used up
+    delay = self.retry_delay
+    attempt = 1
+    while True:
+      try:
+        return self.put(local_path, remote_path, progress)
+      except Exception as e:
+        if attempt >= self.retries or not retryable(e):
+          raise
+        print('Upload attempt %d failed: %s' % (attempt, e))
+        print('Retrying in %d seconds' % delay)
+        time.sleep(delay)
+        delay *= 2
+        attempt += 1
+
+  def put(self, local_path, remote_path, progress):
+    size = os.path.getsize(local_path)
+    if self.use_digest_auth:
+      # get the digest challenge out of the way before streaming the body
+      self.send('HEAD', remote_path, (200, 404))
+    with open(local_path, 'rb') as f:
+      reader = ProgressReader(f, size, progress)
+      resp = self.send('PUT', remote_path, (200, 201, 204), data=reader)
+    print('Upload response was %d' % resp.status_code)
+    if reader.sent != size:
+      raise IOError('sent %d of %d bytes' % (reader.sent, size))
+    self.verify(remote_path, size, reader.hexdigest())
+    return reader.hexdigest()
+
+  def verify(self, remote_path, size, md5):
+    try:
+      resp = self.send('HEAD', remote_path, 200)
+      remote_size = int(resp.headers.get('Content-Length', -1))
+      checksum = remote_md5(resp.headers)
+    except easywebdav.OperationFailed as e:
+      if e.actual_code not in (403, 405, 501):
+        raise
+      files = self.webdav.ls(remote_path)
+      remote_size = files[0].size if files else -1
+      checksum = None
+    if remote_size != size:
+      raise IOError('remote file has %d bytes, expected %d' % (remote_size, size))
+    if checksum is not None and checksum != md5:
+      raise IOError('remote md5 %s does not match %s' % (checksum, md5))
+    print('Verified %d bytes on server, md5 %s%s' % (size, md5,
+      '' if checksum is None else ' (matched)'))
@@ -0,0 +1,45 @@
+# Completion detection for source files as AutoSend drops them.
+#
+# A file counts as complete once its size and modification time have
+# held for settle_seconds: an upload in progress keeps growing, or at
+# least keeps touching the file.  In watch mode (dd_importer.py --watch)
+# the importer polls its sources with a SourceWatcher and analyzes each
+# one as soon as it is complete, instead of waiting for the last school's
+# upload before parsing anything.
+
+import os
+import time
+
+
+def signature(path):
+  # (size, mtime), or None if the file isn't there
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+  return (st.st_size, st.st_mtime)
+
+
+class SourceWatcher(object):
+  def __init__(self, settle_seconds):
+    self.settle_seconds = settle_seconds
+    # path -> (signature, time it was first seen with that signature)
+    self.seen = { }
+
+  def complete(self, paths):
+    # { path: signature } once every file in paths is complete, else None
+    now = time.time()
+    signatures = { }
+    for path in paths:
+      current = signature(path)
+      seen = self.seen.get(path)
+      if seen is None or seen[0] != current:
+        seen = self.seen[path] = (current, now)
+      if current is None or now - seen[1] < self.settle_seconds:
+        return None
+      signatures[path] = current
+    return signatures
+
+  def changed(self, signatures):
+    # the paths whose files no longer match signatures
+    return [ path for path in sorted(signatures) if signature(path) != signatures[path] ]
@@ -0,0 +1,189 @@
+from __future__ import print_function
+
+# Minimal stand-in WebDAV server for trying out uploads locally.
+#
+# Stores PUT bodies under a directory and answers GET, HEAD (with an md5
+# ETag) and PROPFIND for them.  --fail N answers the first N PUTs with a
+# 503 after reading the body, to exercise the retry path, and --corrupt N
+# stores the first N PUT bodies with their last byte changed, to exercise
+# the md5 check.  --digest user:password requires digest authentication.
+# Point app_config at it with webdav_host = 'localhost', webdav_port =
+# 8080 and webdav_protocol = 'http'.
+#
+#   python dd_webdav_server.py /tmp/webdav --port 8080 --fail 1
+#
+# make_server() builds the same server for the tests; port 0 picks a
+# free one.
+
+import argparse
+import hashlib
+import os
+import re
+import uuid
+
+try:
+  from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+  from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer # python 2
+
+PROPFIND_RESPONSE = '''<?xml version="1.0" encoding="utf-8"?>
+<D:multistatus xmlns:D="DAV:">
+<D:response>
+<D:href>%s</D:href>
+<D:propstat><D:prop><D:getcontentlength>%d</D:getcontentlength></D:prop>
+<D:status>HTTP/1.1 200 OK</D:status></D:propstat>
+</D:response>
+</D:multistatus>
+'''
+
+DIGEST_REALM = 'datadirector'
+
+DIGEST_FIELD = re.compile(r'(\w+)=(?:"([^"]*)"|([^\s,]*))')
+
+
+def md5_hex(s):
+  return hashlib.md5(s.encode('utf-8')).hexdigest()
+
+
+class WebDavHandler(BaseHTTPRequestHandler):
+  # keep-alive, so clients can reuse their connection
+  protocol_version = 'HTTP/1.1'
+  root = '.'
+  failures = 0
+  corruptions = 0
+  # (username, password) to require digest authentication
+  digest_auth = None
+  nonce = uuid.uuid4().hex
+  # PUTs received, including refused ones
+  puts = 0
+
+  def local_path(self):
+    name = os.path.basename(self.path.split('?')[0].rstrip('/'))
+    return os.path.join(self.root, name)
+
+  def reply(self, code, body=b'', headers={ }):
+    self.send_response(code)
+    for key, value in headers.items():
+      self.send_header(key, value)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    if self.command != 'HEAD':
+      self.wfile.write(body)
+
+  def file_info(self, path):
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+      data = f.read()
+    h.update(data)
+    return data, '"%s"' % h.hexdigest()
+
+  def authorized(self):
+    # true if digest authentication isn't required or the request's
+    # Authorization is valid; otherwise replies 401 with a challenge
+    if self.digest_auth is None:
+      return True
+    header = self.headers.get('Authorization', '')
+    if header.startswith('Digest '):
+      fields = dict([ (key, quoted or bare) for key, quoted, bare in
+        DIGEST_FIELD.findall(header[7:]) ])
+      username, password = self.digest_auth
+      ha1 = md5_hex('%s:%s:%s' % (username, DIGEST_REALM, password))
+      ha2 = md5_hex('%s:%s' % (self.command, fields.get('uri', '')))
+      expected = md5_hex('%s:%s:%s:%s:%s:%s' % (ha1, self.nonce, fields.get('nc', ''),
+        fields.get('cnonce', ''), fields.get('qop', ''), ha2))
+      if fields.get('username') == username and fields.get('nonce') == self.nonce and \
+          fields.get('response') == expected:
+        return True
+    self.reply(401, headers={ 'WWW-Authenticate':
+      'Digest realm="%s", nonce="%s", qop="auth", algorithm=MD5' % (DIGEST_REALM, self.nonce) })
+    return False
+
+  def do_PUT(self):
+    length = int(self.headers.get('Content-Length', 0))
+    data = self.rfile.read(length)
+    cls = self.__class__
+    cls.puts += 1
+    if not self.authorized():
+      return
+    if cls.failures > 0:
+      cls.failures -= 1
+      self.reply(503)
+      return
+    if cls.corruptions > 0 and data:
+      cls.corruptions -= 1
+      data = data[:-1] + (b'x' if data[-1:] != b'x' else b'y')
+    path = self.local_path()
+    existed = os.path.exists(path)
+    with open(path, 'wb') as f:
+      f.write(data)
+    self.reply(204 if existed else 201)
+
+  def do_GET(self):
+    if not self.authorized():
+      return
+    path = self.local_path()
+    if not os.path.isfile(path):
+      self.reply(404)
+      return
+    data, etag = self.file_info(path)
+    self.reply(200, data, { 'ETag': etag })
+
+  def do_HEAD(self):
+    if not self.authorized():
+      return
+    path = self.local_path()
+    if not os.path.isfile(path):
+      self.reply(404)
+      return
+    data, etag = self.file_info(path)
+    self.send_response(200)
+    self.send_header('ETag', etag)
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+
+  def do_PROPFIND(self):
+    length = int(self.headers.get('Content-Length', 0))
+    if length:
+      self.rfile.read(length)
+    if not self.authorized():
+      return
+    path = self.local_path()
+    if not os.path.isfile(path):
+      self.reply(404)
+      return
+    body = PROPFIND_RESPONSE % (self.path, os.path.getsize(path))
+    self.reply(207, body.encode('utf-8'),
+      { 'Content-Type': 'application/xml; charset=utf-8' })
+
+
+def make_server(root, port=0, fail=0, corrupt=0, digest_auth=None):
+  # an HTTPServer on localhost with a handler class of its own, so its
+  # counters aren't shared; server_address[1] is the port it got
+  if not os.path.isdir(root):
+    os.makedirs(root)
+  class Handler(WebDavHandler):
+    pass
+  Handler.root = root
+  Handler.failures = fail
+  Handler.corruptions = corrupt
+  Handler.digest_auth = digest_auth
+  Handler.nonce = uuid.uuid4().hex
+  return HTTPServer(('localhost', port), Handler)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Stand-in WebDAV server')
+  parser.add_argument('root', help='directory to store uploads in')
+  parser.add_argument('--port', type=int, default=8080)
+  parser.add_argument('--fail', type=int, default=0,
+    help='answer the first N PUTs with 503')
+  parser.add_argument('--corrupt', type=int, default=0,
+    help='store the first N PUT bodies damaged')
+  parser.add_argument('--digest', metavar='USER:PASSWORD',
+    help='require digest authentication')
+  args = parser.parse_args()
+
+  digest_auth = tuple(args.digest.split(':', 1)) if args.digest else None
+  server = make_server(args.root, args.port, args.fail, args.corrupt, digest_auth)
+  print('Serving WebDAV on port %d from %s' % (server.server_address[1], args.root))
+  server.serve_forever()
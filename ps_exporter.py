@@ -0,0 +1,293 @@
+from __future__ import print_function
+
+# Python port of ps_exporter.rb: the same PowerSchool queries, run
+# through any DB-API driver (cx_Oracle for PowerSchool itself).
+#
+# DdImporter reads query rows straight from here when input_source is
+# 'db', without writing and re-parsing the dd-*.txt files.  Run as a
+# script, it writes those files to source_dir like the Ruby exporter.
+# A file whose query lacks some of the columns the importer checks its
+# header for (the student query has no ca_gate ... ethnicity) is written
+# without a header, as the importer then reads it by column order, which
+# is the order of the query.
+# Rows are fetched fetchmany() batches at a time, and values are
+# normalized the way the Ruby exporter writes them: numbers as
+# integers, LOBs read, NULL as '' and '"' as "'".
+
+from decimal import Decimal
+import importlib
+import os
+import re
+
+try:
+  text_type = unicode # python 2
+except NameError:
+  text_type = str
+
+QUERIES = {
+  'student_query': ''' SELECT st.ID,
+  st.Student_Number,
+  st.State_StudentNumber,
+  st.SchoolID,
+  st.First_Name,
+  st.Last_Name,
+  TO_CHAR(st.DOB, 'MM/DD/YYYY') AS DOB,
+  st.FedEthnicity,
+  st.Gender,
+  st.Enroll_Status,
+  st.Grade_Level,
+  mf.Value AS Mother_First,
+  st.Mother,
+  ff.Value AS Father_First,
+  st.Father,
+  st.Street,
+  st.City,
+  st.State,
+  st.Zip,
+  st.Home_Phone,
+  TO_CHAR(st.SchoolEntryDate, 'MM/DD/YYYY') AS SchoolEntryDate,
+  TO_CHAR(st.DistrictEntryDate, 'MM/DD/YYYY') AS DistrictEntryDate,
+  TO_CHAR(st.EntryDate, 'MM/DD/YYYY') AS EntryDate,
+  TO_CHAR(st.ExitDate, 'MM/DD/YYYY') AS ExitDate,
+  sch.Alternate_School_Number,
+  pe.Value AS CA_ParentEd,
+  pl.Value AS CA_PrimaryLanguage,
+  el.Value AS CA_ELAStatus,
+  rfep.Value AS CA_DateRFEP,
+  fs.Value AS CA_FirstUSASchooling
+  FROM Students st
+  LEFT OUTER JOIN Schools sch ON sch.School_Number=st.SchoolID
+  LEFT OUTER JOIN CustomText mf ON (mf.FieldNo={{Mother_First}} AND mf.KeyNo=st.DCID)
+  LEFT OUTER JOIN CustomText ff ON (ff.FieldNo={{Father_First}} AND ff.KeyNo=st.DCID)
+  LEFT OUTER JOIN CustomText pe ON (pe.FieldNo={{CA_ParentEd}} AND pe.KeyNo=st.DCID)
+  LEFT OUTER JOIN CustomText pl ON (pl.FieldNo={{CA_PrimaryLanguage}} AND pl.KeyNo=st.DCID)
+  LEFT OUTER JOIN CustomText el ON (el.FieldNo={{CA_ELAStatus}} AND el.KeyNo=st.DCID)
+  LEFT OUTER JOIN CustomText rfep ON (rfep.FieldNo={{CA_DateRFEP}} AND rfep.KeyNo=st.DCID)
+  LEFT OUTER JOIN CustomText fs ON (fs.FieldNo={{CA_FirstUSASchooling}} AND fs.KeyNo=st.DCID) ''',
+
+  'teacher_query': '''
+  SELECT t.ID, t.TeacherNumber, t.SchoolID,
+  sch.Alternate_School_Number,
+  t.First_Name, t.Last_Name, t.Email_Addr,
+  t.Status, t.StaffStatus
+  FROM Teachers t
+  LEFT OUTER JOIN Schools sch ON sch.School_Number=t.schoolID ''',
+
+  'school_query': ''' SELECT sch.Name, sch.School_Number,
+  sch.Low_Grade, sch.High_Grade, sch.Alternate_School_Number
+  FROM Schools sch ''',
+
+  'course_query': ''' SELECT c.Course_Number, c.Course_Name, c.Credit_Hours,
+  c.CreditType, cl.Value AS CA_CourseLevel,
+  c.SchoolID, sch.Alternate_School_Number
+  FROM Courses c
+  LEFT OUTER JOIN Schools sch ON sch.School_Number=c.SchoolID
+  LEFT OUTER JOIN CustomText cl ON (cl.FieldNo={{CA_CourseLevel:300}} AND cl.KeyNo=c.ID) ''',
+
+  'roster_query': ''' SELECT
+  cc.StudentID,
+  cc.TeacherID, cc.SchoolID, cc.TermID,
+  st.State_StudentNumber, f.TeacherNumber,
+  sch.Alternate_School_Number, st.Grade_Level,
+  cc.Expression, t.Abbreviation,
+  cc.Course_Number, cc.Section_Number, cc.SectionID
+  FROM cc
+  LEFT OUTER JOIN Students st ON st.ID=cc.StudentID
+  LEFT OUTER JOIN Teachers f ON f.ID=cc.TeacherID
+  LEFT OUTER JOIN Schools sch ON sch.School_Number=cc.SchoolID
+  LEFT OUTER JOIN Terms t ON (t.ID=ABS(cc.TermID)) ''',
+
+  'roster_query_reenrollments': ''' SELECT
+  cc.StudentID,
+  cc.TeacherID, cc.SchoolID, cc.TermID,
+  st.State_StudentNumber, f.TeacherNumber,
+  sch.Alternate_School_Number, re.Grade_Level,
+  cc.Expression, t.Abbreviation,
+  cc.Course_Number, cc.Section_Number, cc.SectionID
+  FROM cc
+  LEFT OUTER JOIN Students st ON st.ID=cc.StudentID
+  LEFT OUTER JOIN Teachers f ON f.ID=cc.TeacherID
+  LEFT OUTER JOIN Schools sch ON sch.School_Number=cc.SchoolID
+  LEFT OUTER JOIN Terms t ON (t.ID=ABS(cc.TermID))
+  LEFT OUTER JOIN ReEnrollments re ON
+  (re.StudentID=st.ID AND re.EntryDate<=cc.DateEnrolled AND re.ExitDate>=cc.DateLeft) ''',
+
+  'reenrollment_query': ''' SELECT
+  re.StudentID,
+  st.State_StudentNumber, re.SchoolID,
+  sch.Alternate_School_Number, re.Grade_Level,
+  TO_CHAR(re.EntryDate, 'MM/DD/YYYY') AS EntryDate,
+  TO_CHAR(re.ExitDate, 'MM/DD/YYYY') AS ExitDate
+  FROM ReEnrollments re
+  LEFT OUTER JOIN Students st ON st.ID=re.StudentID
+  LEFT OUTER JOIN Schools sch ON sch.School_Number=re.SchoolID ''',
+
+  'program_query': ''' SELECT
+  FOREIGNKEY,
+  CUSTOM,
+  USER_DEFINED_TEXT,
+  USER_DEFINED_TEXT2,
+  TO_CHAR(USER_DEFINED_DATE, 'MM/DD/YYYY') AS USER_DEFINED_DATE,
+  TO_CHAR(USER_DEFINED_DATE2, 'MM/DD/YYYY') AS USER_DEFINED_DATE2
+  FROM VirtualTablesData2
+  WHERE RELATED_TO_TABLE='StudentProgram' ''',
+
+  'race_query': ''' SELECT
+  STUDENTID, RACECD FROM StudentRace '''
+}
+
+# query and dd-*.txt file for each kind of importer source, in the order
+# the Ruby exporter runs them
+EXPORTS = [
+  ('schools',        'school_query',       'dd-schools.txt'),
+  ('teachers',       'teacher_query',      'dd-teachers.txt'),
+  ('courses',        'course_query',       'dd-courses-all.txt'),
+  ('students',       'student_query',      'dd-students.txt'),
+  ('reenrollments',  'reenrollment_query', 'dd-reenrollments.txt'),
+  ('races',          'race_query',         'dd-races.txt'),
+  ('programs',       'program_query',      'dd-programs.txt'),
+  ('rosters',        'roster_query',       'dd-rosters-all.txt')
+]
+
+SOURCE_QUERIES = dict([ (kind, query_name) for kind, query_name, fname in EXPORTS ])
+
+CUSTOM_FIELD = re.compile(r'\{\{([^}]+)\}\}')
+
+
+def normalize_value(value):
+  if value is None:
+    return ''
+  if isinstance(value, (float, Decimal)):
+    return str(int(value))
+  if hasattr(value, 'read'):
+    # BFILE, BLOB and CLOB
+    value = value.read()
+  if isinstance(value, str):
+    pass
+  elif isinstance(value, text_type):
+    value = value.encode('utf-8') # python 2 unicode
+  elif isinstance(value, bytes):
+    value = value.decode('utf-8') # python 3 bytes
+  else:
+    value = str(value)
+  return value.replace('"', "'")
+
+
+def connect(driver, connect_args):
+  # connect_args are keyword arguments if a dict, else positional ones
+  module = importlib.import_module(driver)
+  if isinstance(connect_args, dict):
+    return module.connect(**connect_args)
+  return module.connect(*connect_args)
+
+
+class PsExporter(object):
+  def __init__(self, connection, batch_size=1000):
+    self.connection = connection
+    self.batch_size = batch_size
+    self.custom_fields = { }
+
+  def close(self):
+    self.connection.close()
+
+  def year_abbr_to_term(self, year):
+    return '%02d00' % ((int(year.split('-')[0]) + 10) % 100)
+
+  def custom_field_number(self, field):
+    # FieldsTable ID of a custom field, 'Name' or 'Name:FileNo'; 0 if unknown
+    if ':' in field:
+      field, fileno = field.split(':')
+    else:
+      fileno = '100'
+    key = '%s:%s' % (field.lower(), fileno)
+    if not key in self.custom_fields:
+      cursor = self.connection.cursor()
+      try:
+        cursor.execute("SELECT ID FROM FieldsTable WHERE FileNo=%s AND REGEXP_LIKE(Name,'^%s$','i')"
+          % (fileno, field))
+        row = cursor.fetchone()
+      finally:
+        cursor.close()
+      self.custom_fields[key] = int(row[0]) if row else 0
+    return self.custom_fields[key]
+
+  def sql(self, query_name, min_termid=None):
+    sql = CUSTOM_FIELD.sub(lambda m: str(self.custom_field_number(m.group(1))),
+      QUERIES[query_name])
+    if query_name == 'roster_query' and min_termid is not None:
+      sql += ' WHERE ABS(cc.TermID)>=%s' % min_termid
+    return sql
+
+  def query(self, query_name, min_termid=None):
+    # (column names, iterator over rows as lists of strings)
+    cursor = self.connection.cursor()
+    # how many rows a driver like cx_Oracle prefetches per round trip
+    cursor.arraysize = self.batch_size
+    cursor.execute(self.sql(query_name, min_termid))
+    names = [ d[0] for d in cursor.description ]
+
+    def rows():
+      try:
+        while True:
+          batch = cursor.fetchmany(self.batch_size)
+          if not batch:
+            break
+          for row in batch:
+            yield [ normalize_value(value) for value in row ]
+      finally:
+        cursor.close()
+    return names, rows()
+
+  def source_rows(self, kind, single_year=None):
+    # the query behind one kind of dd-*.txt source file
+    min_termid = None
+    if kind == 'rosters' and single_year:
+      min_termid = self.year_abbr_to_term(single_year)
+    return self.query(SOURCE_QUERIES[kind], min_termid)
+
+  def export(self, kind, path, single_year=None, reads_as_header=None):
+    # reads_as_header(kind, names) is whether the importer would take
+    # names for the header row of the file; if not, none is written
+    print('processing %s...' % kind)
+    names, rows = self.source_rows(kind, single_year)
+    num_rows = 0
+    with open(path, 'w') as f:
+      if reads_as_header is None or reads_as_header(kind, names):
+        f.write('\t'.join(names))
+        f.write('\n')
+      else:
+        print(' no header: the importer reads %s by column order' % kind)
+      for row in rows:
+        f.write('\t'.join(row))
+        f.write('\n')
+        num_rows += 1
+    print(' %d rows written to %s' % (num_rows, path))
+    return num_rows != 0
+
+  def export_all(self, input_dir, single_year=None, reads_as_header=None):
+    if not os.path.isdir(input_dir):
+      os.makedirs(input_dir)
+    for kind, query_name, fname in EXPORTS:
+      if self.export(kind, os.path.join(input_dir, fname), single_year, reads_as_header):
+        # the district-wide file replaces the per-school ones
+        if kind in ('courses', 'rosters'):
+          for school in ('bacich', 'kent'):
+            path = os.path.join(input_dir, 'dd-%s-%s.txt' % (kind, school))
+            if os.path.exists(path):
+              os.remove(path)
+
+
+if __name__ == '__main__':
+  import app_config
+  from dd_importer import DdImporter
+
+  # the same year the importer would run for, including 'auto', and the
+  # headers it reads
+  importer = DdImporter()
+  exporter = PsExporter(connect(app_config.db_driver, app_config.db_connect_args),
+    getattr(app_config, 'db_batch_size', 1000))
+  try:
+    exporter.export_all(os.path.realpath(app_config.source_dir), importer.single_year,
+      importer.reads_as_header)
+  finally:
+    exporter.close()
@@ -0,0 +1,18 @@
+# Settings the tests import dd_importer with.  Each test points its
+# importer at directories of its own.
+
+import tempfile
+
+school_year = '16-17'
+source_dir = tempfile.gettempdir()
+output_base_dir = tempfile.gettempdir()
+do_uploads = False
+zip_file_name = 'datadirector'
+username = 'user'
+password = 'password'
+sftp_host = 'localhost'
+sftp_path = '/'
+webdav_host = 'localhost'
+webdav_protocol = 'http'
+webdav_path = '/'
+webdav_use_digest_auth = False
@@ -0,0 +1,135 @@
+# ps_exporter against a small PowerSchool schema in SQLite, run as a
+# script (dd-*.txt files the importer then reads) and with input_source
+# 'db'; both must give the importer the same students and rosters.
+
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dd_importer
+import ps_exporter
+
+SCHEMA = '''
+CREATE TABLE FieldsTable (ID, FileNo, Name);
+CREATE TABLE CustomText (FieldNo, KeyNo, Value);
+CREATE TABLE Schools (Name, School_Number, Low_Grade, High_Grade, Alternate_School_Number);
+CREATE TABLE Students (DCID, ID, Student_Number, State_StudentNumber, SchoolID,
+  First_Name, Last_Name, DOB, FedEthnicity, Gender, Enroll_Status, Grade_Level,
+  Mother, Father, Street, City, State, Zip, Home_Phone, SchoolEntryDate,
+  DistrictEntryDate, EntryDate, ExitDate);
+CREATE TABLE Teachers (ID, TeacherNumber, SchoolID, First_Name, Last_Name,
+  Email_Addr, Status, StaffStatus);
+CREATE TABLE Courses (ID, Course_Number, Course_Name, Credit_Hours, CreditType, SchoolID);
+CREATE TABLE cc (StudentID, TeacherID, SchoolID, TermID, Expression,
+  Course_Number, Section_Number, SectionID, DateEnrolled, DateLeft);
+CREATE TABLE Terms (ID, Abbreviation);
+CREATE TABLE ReEnrollments (StudentID, SchoolID, Grade_Level, EntryDate, ExitDate);
+CREATE TABLE StudentRace (StudentID, RaceCD);
+CREATE TABLE VirtualTablesData2 (Related_To_Table, ForeignKey, Custom,
+  User_Defined_Text, User_Defined_Text2, User_Defined_Date, User_Defined_Date2);
+
+INSERT INTO FieldsTable VALUES (1, 100, 'MOTHER_FIRST');
+INSERT INTO FieldsTable VALUES (2, 100, 'CA_PRIMARYLANGUAGE');
+INSERT INTO CustomText VALUES (1, 11, 'Ann');
+INSERT INTO CustomText VALUES (2, 11, '01');
+INSERT INTO Schools VALUES ('Bacich', 101, 0, 4, 1001);
+INSERT INTO Schools VALUES ('Kent', 102, 5, 8, 1002);
+INSERT INTO Students VALUES (11, 1000, 50000, 900000, 101, 'Ada', 'Lovelace',
+  '04/08/2009', 0, 'F', 0, 2, 'Mom', 'Dad', '1 Main St', 'Kentfield', 'CA',
+  '94904', '415-555-0000', '08/20/2016', '08/20/2014', '08/20/2016', '06/15/2017');
+INSERT INTO Students VALUES (12, 1001, 50001, 900001, 102, 'Alan', 'Turing',
+  '06/23/2004', 0, 'M', 0, 7, 'Mom', 'Dad', '2 Main St', 'Kentfield', 'CA',
+  '94904', '415-555-0001', '08/20/2016', '08/20/2012', '08/20/2016', '06/15/2017');
+INSERT INTO Teachers VALUES (1, 'T1', 101, 'Grace', 'Hopper', 'gh@example.org', 1, 1);
+INSERT INTO Teachers VALUES (2, 'T2', 102, 'Edsger', 'Dijkstra', 'ed@example.org', 1, 1);
+INSERT INTO Courses VALUES (1, '0007', 'English Language Arts', 1, 'MA', 101);
+INSERT INTO Courses VALUES (2, '1015', 'Math 7', 1, 'MA', 102);
+INSERT INTO Terms VALUES (2600, '16-17');
+INSERT INTO cc VALUES (1000, 1, 101, 2600, '1(A)', '0007', '1', 10, NULL, NULL);
+INSERT INTO cc VALUES (1001, 2, 102, 2600, '3(A)', '1015', '2', 20, NULL, NULL);
+'''
+
+
+def connect(path):
+  # ps_exporter.connect() driver: SQLite with the two Oracle functions
+  # the queries use
+  connection = sqlite3.connect(path)
+  connection.create_function('REGEXP_LIKE', 3,
+    lambda s, pattern, flags: 1 if re.search(pattern, s or '', re.I if 'i' in flags else 0) else 0)
+  connection.create_function('TO_CHAR', 2, lambda value, fmt: value)
+  return connection
+
+
+class PsExporterTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.db_path = os.path.join(self.tmp_dir, 'powerschool.db')
+    connection = sqlite3.connect(self.db_path)
+    connection.executescript(SCHEMA)
+    connection.commit()
+    connection.close()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def importer(self, name):
+    importer = dd_importer.DdImporter()
+    importer.data_dir = os.path.join(self.tmp_dir, name)
+    importer.input_dir = importer.reference_dir = os.path.join(importer.data_dir, 'input')
+    importer.output_dir = os.path.join(importer.data_dir, 'datafiles')
+    return importer
+
+  def output(self, importer):
+    importer.process_files()
+    importer.output_files()
+    files = { }
+    for fname in sorted(os.listdir(importer.output_dir)):
+      with open(os.path.join(importer.output_dir, fname), 'r') as f:
+        files[fname] = f.read()
+    return files
+
+  def test_script_mode_files_read_by_importer(self):
+    importer = self.importer('files')
+    exporter = ps_exporter.PsExporter(connect(self.db_path), batch_size=1)
+    try:
+      exporter.export_all(importer.input_dir, '16-17', importer.reads_as_header)
+    finally:
+      exporter.close()
+
+    # the student query lacks ca_gate ... ethnicity, so no header
+    with open(os.path.join(importer.input_dir, 'dd-students.txt'), 'r') as f:
+      self.assertTrue(f.readline().startswith('1000\t50000\t900000\t101\t'))
+    with open(os.path.join(importer.input_dir, 'dd-teachers.txt'), 'r') as f:
+      self.assertTrue(f.readline().startswith('ID\tTeacherNumber\t'))
+
+    files = self.output(importer)
+    demo = files['demo_Kentfield.txt'].splitlines()
+    self.assertEqual(len(demo), 3)
+    self.assertIn('Lovelace', demo[1] + demo[2])
+    self.assertIn('Turing', demo[1] + demo[2])
+    self.assertEqual(len(files['rosters_Kentfield.txt'].splitlines()), 3)
+
+  def test_db_source_matches_script_mode(self):
+    importer = self.importer('files')
+    exporter = ps_exporter.PsExporter(connect(self.db_path))
+    try:
+      exporter.export_all(importer.input_dir, '16-17', importer.reads_as_header)
+    finally:
+      exporter.close()
+    expected = self.output(importer)
+
+    importer = self.importer('db')
+    importer.input_source = 'db'
+    importer.db_driver = __name__
+    importer.db_connect_args = [ self.db_path ]
+    self.assertEqual(self.output(importer), expected)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,101 @@
+# dd_upload.WebDavUploader against the stand-in server of
+# dd_webdav_server.py, started on a free port for each test.
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import easywebdav
+
+import dd_upload
+import dd_webdav_server
+
+
+class WebDavUploadTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.root = os.path.join(self.tmp_dir, 'webdav')
+    self.local_path = os.path.join(self.tmp_dir, 'datadirector.zip')
+    self.data = os.urandom(200000)
+    with open(self.local_path, 'wb') as f:
+      f.write(self.data)
+    self.server = None
+
+  def tearDown(self):
+    if self.server is not None:
+      self.server.shutdown()
+      self.server.server_close()
+      self.thread.join()
+    shutil.rmtree(self.tmp_dir)
+
+  def start(self, **options):
+    self.server = dd_webdav_server.make_server(self.root, 0, **options)
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def uploader(self, password='password', **options):
+    return dd_upload.WebDavUploader('localhost', 'http', '/', 'user', password,
+      retry_delay=0, timeout=10, port=self.server.server_address[1], **options)
+
+  def uploaded(self):
+    with open(os.path.join(self.root, 'datadirector.zip'), 'rb') as f:
+      return f.read()
+
+  def puts(self):
+    return self.server.RequestHandlerClass.puts
+
+  def test_put(self):
+    self.start()
+    md5 = self.uploader().upload(self.local_path, 'datadirector.zip')
+    self.assertEqual(md5, hashlib.md5(self.data).hexdigest())
+    self.assertEqual(self.uploaded(), self.data)
+    self.assertEqual(self.puts(), 1)
+
+  def test_retry_after_503(self):
+    self.start(fail=1)
+    self.uploader(retries=2).upload(self.local_path, 'datadirector.zip')
+    self.assertEqual(self.uploaded(), self.data)
+    self.assertEqual(self.puts(), 2)
+
+  def test_503_with_no_retries_left(self):
+    self.start(fail=2)
+    with self.assertRaises(easywebdav.OperationFailed) as raised:
+      self.uploader(retries=2).upload(self.local_path, 'datadirector.zip')
+    self.assertEqual(raised.exception.actual_code, 503)
+    self.assertEqual(self.puts(), 2)
+
+  def test_md5_mismatch(self):
+    self.start(corrupt=1)
+    with self.assertRaises(IOError) as raised:
+      self.uploader(retries=1).upload(self.local_path, 'datadirector.zip')
+    self.assertIn('md5', str(raised.exception))
+
+  def test_md5_mismatch_retried(self):
+    self.start(corrupt=1)
+    self.uploader(retries=2).upload(self.local_path, 'datadirector.zip')
+    self.assertEqual(self.uploaded(), self.data)
+    self.assertEqual(self.puts(), 2)
+
+  def test_digest_auth(self):
+    self.start(digest_auth=('user', 'password'))
+    self.uploader(use_digest_auth=True).upload(self.local_path, 'datadirector.zip')
+    self.assertEqual(self.uploaded(), self.data)
+
+  def test_digest_auth_refused(self):
+    self.start(digest_auth=('user', 'password'))
+    with self.assertRaises(easywebdav.OperationFailed) as raised:
+      self.uploader(password='wrong', use_digest_auth=True, retries=3).upload(
+        self.local_path, 'datadirector.zip')
+    self.assertEqual(raised.exception.actual_code, 401)
+    self.assertFalse(os.path.exists(os.path.join(self.root, 'datadirector.zip')))
+
+
+if __name__ == '__main__':
+  unittest.main()